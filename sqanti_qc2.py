@@ -6,21 +6,30 @@
 __author__  = "etseng@pacb.com"
 __version__ = '7.3.2'  # Python 3.7
 
-import os, re, sys, subprocess, timeit, glob, copy
-import shutil
+import os, re, sys, subprocess, timeit, glob
 import distutils.spawn
-import itertools
 import bisect
 import argparse
 import math
-from collections import defaultdict, Counter, namedtuple
+from array import array
+from collections import defaultdict, Counter, namedtuple, ChainMap
 from csv import DictWriter, DictReader
-from multiprocessing import Process
+import multiprocessing
 
 utilitiesPath =  os.path.dirname(os.path.realpath(__file__))+"/utilities/" 
 sys.path.insert(0, utilitiesPath)
-from rt_switching import rts
+from rt_switching import rts_junctions, SpliceJunctions
+from rts_cache import open_rts_cache
 from indels_annot import calc_indels_from_sam
+from genome_index import IndexedGenome, reverse_complement
+from ref_cache import ref_cache_key, ref_cache_filename, load_ref_cache, write_ref_cache
+from exon_compare import merge_exons
+from transcript_compare import compare_to_refs, ChainMemo
+from transcript_coords import TranscriptCoordinateMapper
+from ref_index import JunctionIndex, ChainIndex, GeneIndex, RefSweep, RefExonIndex, chain_key
+from run_profile import RunProfile, StageTimer
+from incremental import fingerprint, file_signature, fasta_fingerprints, changed_ids, write_fasta_subset, merge_sam, load_state, write_state, \
+    ClassRowStore, load_class_rows, save_class_rows, remove_stale_class_rows
 
 
 try:
@@ -31,6 +40,12 @@ except ImportError:
     print("Unable to import Biopython! Please make sure Biopython is installed.", file=sys.stderr)
     sys.exit(-1)
 
+try:
+    import numpy as np
+except ImportError:
+    print("Unable to import numpy! Please make sure numpy is installed.", file=sys.stderr)
+    sys.exit(-1)
+
 try:
     from bx.intervals import Interval, IntervalTree
 except ImportError:
@@ -54,7 +69,6 @@ except ImportError:
     sys.exit(-1)
 
 try:
-    from cupcake.tofu.compare_junctions import compare_junctions
     from cupcake.tofu.filter_away_subset import read_count_file
     from cupcake.io.BioReaders import GMAPSAMReader
     from cupcake.io.GFF import collapseGFFReader, write_collapseGFF_format
@@ -93,6 +107,12 @@ seqid_rex1 = re.compile('PB\.(\d+)\.(\d+)$')
 seqid_rex2 = re.compile('PB\.(\d+)\.(\d+)\|\S+')
 seqid_fusion = re.compile("PBfusion\.(\d+)")
 
+# timing and memory of the pipeline stages, written next to the .params.txt
+run_profile = RunProfile()
+
+# GMST sequence ID example: PB.2.1 gene_4|GeneMark.hmm|264_aa|+|888|1682
+gmst_rex = re.compile('(\S+\t\S+\|GeneMark.hmm)\|(\d+)_aa\|(\S)\|(\d+)\|(\d+)')
+
 
 FIELDS_JUNC = ['isoform', 'chrom', 'strand', 'junction_number', 'genomic_start_coord',
                    'genomic_end_coord', 'transcript_coord', 'junction_category',
@@ -121,9 +141,6 @@ if os.system(RSCRIPTPATH + " --version")!=0:
     print("Rscript executable not found! Abort!", file=sys.stderr)
     sys.exit(-1)
 
-SPLIT_ROOT_DIR = 'splits/'
-
-
 class genePredReader(object):
     def __init__(self, filename):
         self.f = open(filename)
@@ -139,6 +156,15 @@ class genePredReader(object):
 
 
 class genePredRecord(object):
+    """
+    Compact genePred record: exon starts/ends are stored as int arrays and the
+    exon Intervals and junctions are derived on demand, so that millions of
+    reference and query records don't each carry lists of Python objects.
+    """
+    __slots__ = ('id', 'chrom', 'strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd',
+                 'exonCount', 'exonStarts', 'exonEnds', 'gene', 'length',
+                 '_merged_exons', '_splice_sites')
+
     def __init__(self, id, chrom, strand, txStart, txEnd, cdsStart, cdsEnd, exonCount, exonStarts, exonEnds, gene=None):
         self.id = id
         self.chrom = chrom
@@ -148,24 +174,59 @@ class genePredRecord(object):
         self.cdsStart = cdsStart       # 1-based start
         self.cdsEnd = cdsEnd           # 1-based end
         self.exonCount = exonCount
-        self.exonStarts = exonStarts   # 0-based starts
-        self.exonEnds = exonEnds       # 1-based ends
+        self.exonStarts = array('l', exonStarts)   # 0-based starts
+        self.exonEnds = array('l', exonEnds)       # 1-based ends
         self.gene = gene
 
-        self.length = 0
-        self.exons = []
+        self.length = sum(self.exonEnds) - sum(self.exonStarts)
 
-        for s,e in zip(exonStarts, exonEnds):
-            self.length += e-s
-            self.exons.append(Interval(s, e))
+        # derived structures used when comparing against other records, computed once on first use
+        self._merged_exons = None
+        self._splice_sites = None
 
-        # junctions are stored (1-based last base of prev exon, 1-based first base of next exon)
-        self.junctions = [(self.exonEnds[i],self.exonStarts[i+1]) for i in range(self.exonCount-1)]
+    @property
+    def exons(self):
+        return [Interval(s, e) for s,e in zip(self.exonStarts, self.exonEnds)]
+
+    @property
+    def junctions(self):
+        # junctions are (1-based last base of prev exon, 1-based first base of next exon)
+        return list(zip(self.exonEnds[:-1], self.exonStarts[1:]))
 
     @property
     def segments(self):
         return self.exons
 
+    @property
+    def merged_exons(self):
+        """
+        sorted, disjoint exons as [start, end] (see exon_compare.merge_exons) for exonic overlap computation
+        """
+        if self._merged_exons is None:
+            self._merged_exons = merge_exons(self.exons)
+        return self._merged_exons
+
+    @property
+    def splice_sites(self):
+        """
+        set of all exon starts and ends
+        """
+        if self._splice_sites is None:
+            self._splice_sites = frozenset(self.exonStarts).union(self.exonEnds)
+        return self._splice_sites
+
+    def count_overlapping_exons(self, start, end):
+        """
+        :return: number of exons overlapping [start, end), same as len(IntervalTree(exons).find(start, end))
+        """
+        return bisect.bisect_left(self.exonStarts, end) - bisect.bisect_right(self.exonEnds, start)
+
+    def as_fields(self):
+        """
+        :return: tuple of constructor arguments, used to cache/re-create the record
+        """
+        return (self.id, self.chrom, self.strand, self.txStart, self.txEnd, self.cdsStart, self.cdsEnd,
+                self.exonCount, self.exonStarts, self.exonEnds, self.gene)
 
     @classmethod
     def from_line(cls, line):
@@ -183,33 +244,21 @@ class genePredRecord(object):
                   gene=raw[11] if len(raw)>=12 else None,
                   )
 
-    def get_splice_site(self, genome_dict, i):
-        """
-        Return the donor-acceptor site (ex: GTAG) for the i-th junction
-        :param i: 0-based junction index
-        :param genome_dict: dict of chrom --> SeqRecord
-        :return: splice site pattern, ex: "GTAG", "GCAG" etc
-        """
-        assert 0 <= i < self.exonCount-1
-
-        d = self.exonEnds[i]
-        a = self.exonStarts[i+1]
-
-        seq_d = genome_dict[self.chrom].seq[d:d+2]
-        seq_a = genome_dict[self.chrom].seq[a-2:a]
-
-        if self.strand == '+':
-            return (str(seq_d)+str(seq_a)).upper()
-        else:
-            return (str(seq_a.reverse_complement())+str(seq_d.reverse_complement())).upper()
-
-
 
 class myQueryTranscripts:
+    __slots__ = ('id', 'tss_diff', 'tts_diff', 'tss_gene_diff', 'tts_gene_diff', 'genes', 'AS_genes',
+                 'transcripts', 'num_exons', 'length', 'str_class', 'chrom', 'strand', 'subtype',
+                 'RT_switching', 'canonical', 'min_samp_cov', 'min_cov', 'min_cov_pos', 'sd',
+                 'proteinID', 'ORFlen', 'CDS_start', 'CDS_end', 'coding', 'CDS_genomic_start',
+                 'CDS_genomic_end', 'is_NMD', 'FL', 'FL_dict', 'nIndels', 'nIndelsJunc', 'isoExp',
+                 'geneExp', 'refLen', 'refExons', 'refStart', 'refEnd', 'q_splicesite_hit',
+                 'q_exon_overlap', 'FSM_class', 'bite', 'percAdownTTS', 'seqAdownTTS', 'dist_cage',
+                 'within_cage', 'within_polya_site', 'dist_polya_site', 'polyA_motif', 'polyA_dist')
+
     def __init__(self, id, tss_diff, tts_diff, num_exons, length, str_class, subtype=None,
                  genes=None, transcripts=None, chrom=None, strand=None, bite ="NA",
                  RT_switching ="????", canonical="NA", min_cov ="NA",
-                 min_cov_pos ="NA", min_samp_cov="NA", sd ="NA", FL ="NA", FL_dict={},
+                 min_cov_pos ="NA", min_samp_cov="NA", sd ="NA", FL ="NA", FL_dict=None,
                  nIndels ="NA", nIndelsJunc ="NA", proteinID=None,
                  ORFlen="NA", CDS_start="NA", CDS_end="NA",
                  CDS_genomic_start="NA", CDS_genomic_end="NA", is_NMD="NA",
@@ -252,7 +301,7 @@ class myQueryTranscripts:
         self.CDS_genomic_end = CDS_genomic_end      # 1-based genomic coordinate of CDS end - strand aware
         self.is_NMD      = is_NMD                   # (TRUE,FALSE) for NMD if is coding, otherwise "NA"
         self.FL          = FL                       # count for a single sample
-        self.FL_dict     = FL_dict                  # dict of sample -> FL count
+        self.FL_dict     = FL_dict if FL_dict is not None else {}  # dict of sample -> FL count
         self.nIndels     = nIndels
         self.nIndelsJunc = nIndelsJunc
         self.isoExp      = isoExp
@@ -378,6 +427,9 @@ class myQueryTranscripts:
             d["FL."+sample] = count
         return d
 
+# what is kept in memory for each isoform once its classification row is written
+IsoformBrief = namedtuple('IsoformBrief', ['gene', 'CDS_genomic_start', 'CDS_genomic_end'])
+
 class myQueryProteins:
 
     def __init__(self, cds_start, cds_end, orf_length, proteinID="NA"):
@@ -409,21 +461,21 @@ def rewrite_sam_for_fusion_ids(sam_filename):
     return sam_filename
 
 
-def write_collapsed_GFF_with_CDS(isoforms_info, input_gff, output_gff):
+def write_collapsed_GFF_with_CDS(isoforms_brief, input_gff, output_gff):
     """
     Augment a collapsed GFF with CDS information
     *NEW* Also, change the "gene_id" field to use the classification result
-    :param isoforms_info: dict of id -> QueryTranscript
+    :param isoforms_brief: dict of id -> IsoformBrief
     :param input_gff:  input GFF filename
     :param output_gff: output GFF filename
     """
     with open(output_gff, 'w') as f:
         reader = collapseGFFReader(input_gff)
         for r in reader:
-            r.geneid = isoforms_info[r.seqid].geneName()  # set the gene name
+            r.geneid = isoforms_brief[r.seqid].gene  # set the gene name
 
-            s = isoforms_info[r.seqid].CDS_genomic_start  # could be 'NA'
-            e = isoforms_info[r.seqid].CDS_genomic_end    # could be 'NA'
+            s = isoforms_brief[r.seqid].CDS_genomic_start  # could be 'NA'
+            e = isoforms_brief[r.seqid].CDS_genomic_end    # could be 'NA'
             r.cds_exons = []
             if s!='NA' and e!='NA': # has ORF prediction for this isoform
                 if r.strand == '+':
@@ -433,12 +485,8 @@ def write_collapsed_GFF_with_CDS(isoforms_info, input_gff, output_gff):
                     assert e < s
                     s, e = e, s
                     s = s - 1 # make it 0-based
-                for i,exon in enumerate(r.ref_exons):
-                    if exon.end > s: break
-                r.cds_exons = [Interval(s, min(e,exon.end))]
-                for exon in r.ref_exons[i+1:]:
-                    if exon.start > e: break
-                    r.cds_exons.append(Interval(exon.start, min(e, exon.end)))
+                mapper = TranscriptCoordinateMapper([x.start for x in r.ref_exons], [x.end for x in r.ref_exons], r.strand)
+                r.cds_exons = [Interval(a, b) for a, b in mapper.clip_to_exons(s, e)]
             write_collapseGFF_format(f, r)
 
 def get_corr_filenames(args, dir=None):
@@ -457,9 +505,151 @@ def get_class_junc_filenames(args, dir=None):
     outputJuncPath = outputPathPrefix + "_junctions.txt"
     return outputClassPath, outputJuncPath
 
-def correctionPlusORFpred(args, genome_dict):
+def align_isoforms(args, input_fasta, output_sam):
+    """
+    Align the isoform sequences to the genome with the chosen aligner
+    """
+    n_cpu = max(1, args.cpus)
+    if args.aligner_choice == "gmap":
+        print("****Aligning reads with GMAP...", file=sys.stdout)
+        cmd = GMAP_CMD.format(cpus=n_cpu,
+                              dir=os.path.dirname(args.gmap_index),
+                              name=os.path.basename(args.gmap_index),
+                              sense=args.sense,
+                              i=input_fasta,
+                              o=output_sam)
+    elif args.aligner_choice == "minimap2":
+        print("****Aligning reads with Minimap2...", file=sys.stdout)
+        cmd = MINIMAP2_CMD.format(cpus=n_cpu,
+                                  sense=args.sense,
+                                  g=args.genome,
+                                  i=input_fasta,
+                                  o=output_sam)
+    elif args.aligner_choice == "deSALT":
+        print("****Aligning reads with deSALT...", file=sys.stdout)
+        cmd = DESALT_CMD.format(cpus=n_cpu,
+                                dir=args.gmap_index,
+                                i=input_fasta,
+                                o=output_sam)
+    with run_profile.stage('alignment'):
+        if subprocess.check_call(cmd, shell=True)!=0:
+            print("ERROR running alignment cmd: {0}".format(cmd), file=sys.stderr)
+            sys.exit(-1)
+
+
+def align_isoforms_incremental(args, prev_state, new_state):
+    """
+    Only align the isoforms that are new or whose sequence changed since the previous run,
+    the alignments of the other isoforms are taken from the previous corrected SAM.
+    """
+    align_key = fingerprint(args.aligner_choice, getattr(args, 'sense', None), file_signature(args.genome), args.gmap_index)
+    isoform_fps = fasta_fingerprints(args.isoforms)
+    new_state['align_key'] = align_key
+    new_state['isoform_fp'] = isoform_fps
+
+    if prev_state.get('align_key') != align_key or not os.path.exists(corrSAM):
+        align_isoforms(args, args.isoforms, corrSAM)
+        return
+
+    to_align = changed_ids(isoform_fps, prev_state['isoform_fp'])
+    n_removed = len(set(prev_state['isoform_fp']).difference(isoform_fps))
+    print("Incremental run: {0} of {1} isoforms are new or changed, {2} were removed.".format(len(to_align), len(isoform_fps), n_removed), file=sys.stdout)
+    if len(to_align) == 0 and n_removed == 0:
+        return
+
+    delta_fasta = os.path.splitext(corrSAM)[0] + ".delta.fasta"
+    delta_sam = os.path.splitext(corrSAM)[0] + ".delta.sam"
+    if len(to_align) > 0:
+        write_fasta_subset(args.isoforms, to_align, delta_fasta)
+        align_isoforms(args, delta_fasta, delta_sam)
+        os.remove(delta_fasta)
+    merge_sam(corrSAM, set(isoform_fps).difference(to_align), delta_sam if len(to_align) > 0 else None, corrSAM)
+    if len(to_align) > 0:
+        os.remove(delta_sam)
+
+
+def read_orf_fasta(orf_filename, orfDict, keep_ids=None, fout=None):
+    """
+    Read the ORFs of a previous run (as written by trim_gmst_orfs) into orfDict
+    :param keep_ids: if given, only read the ORFs of these isoforms
+    :param fout: if given, copy the ORF records to this handle
+    """
+    for r in SeqIO.parse(open(orf_filename), 'fasta'):
+        if keep_ids is not None and r.id not in keep_ids:
+            continue
+        # now process ORFs into myQueryProtein objects
+        m = gmst_rex.match(r.description)
+        if m is None:
+            print("Expected GMST output IDs to be of format '<pbid> gene_4|GeneMark.hmm|<orf>_aa|<strand>|<cds_start>|<cds_end>' but instead saw: {0}! Abort!".format(r.description), file=sys.stderr)
+            sys.exit(-1)
+        orf_length = int(m.group(2))
+        cds_start = int(m.group(4))
+        cds_end = int(m.group(5))
+        orfDict[r.id] = myQueryProteins(cds_start, cds_end, orf_length, proteinID=r.id)
+        if fout is not None:
+            fout.write(">{0}\n{1}\n".format(r.description, r.seq))
+
+
+def trim_gmst_orfs(gmst_faa, orfDict, fout):
+    """
+    Modifying ORF sequences by removing sequence before ATG, add the ORFs to orfDict and write them to <fout>
+    """
+    for r in SeqIO.parse(open(gmst_faa), 'fasta'):
+        m = gmst_rex.match(r.description)
+        if m is None:
+            print("Expected GMST output IDs to be of format '<pbid> gene_4|GeneMark.hmm|<orf>_aa|<strand>|<cds_start>|<cds_end>' but instead saw: {0}! Abort!".format(r.description), file=sys.stderr)
+            sys.exit(-1)
+        id_pre = m.group(1)
+        orf_length = int(m.group(2))
+        orf_strand = m.group(3)
+        cds_start = int(m.group(4))
+        cds_end = int(m.group(5))
+        pos = r.seq.find('M')
+        if pos!=-1:
+            # must modify both the sequence ID and the sequence
+            orf_length -= pos
+            cds_start += pos*3
+            newid = "{0}|{1}_aa|{2}|{3}|{4}".format(id_pre, orf_length, orf_strand, cds_start, cds_end)
+            newseq = str(r.seq)[pos:]
+            orfDict[r.id] = myQueryProteins(cds_start, cds_end, orf_length, proteinID=newid)
+            fout.write(">{0}\n{1}\n".format(newid, newseq))
+        else:
+            new_rec = r
+            orfDict[r.id] = myQueryProteins(cds_start, cds_end, orf_length, proteinID=r.id)
+            fout.write(">{0}\n{1}\n".format(new_rec.description, new_rec.seq))
+
+
+def get_incremental_state_filename(args):
+    return os.path.join(args.dir, args.output + "_incremental.pkl")
+
+
+def get_incremental_rows_prefix(args):
+    return os.path.join(args.dir, args.output + "_incremental_rows")
+
+
+def classification_key(args):
+    """
+    (--incremental) fingerprint of the global inputs of the classification. If it changes, all isoforms are re-classified.
+    """
+    return fingerprint(__version__,
+                       file_signature(args.annotation), args.min_ref_len, args.geneid,
+                       file_signature(args.genome),
+                       args.window, args.sites,
+                       [file_signature(f) for f in sorted(glob.glob(args.coverage))] if args.coverage is not None else None,
+                       file_signature(args.cage_peak),
+                       file_signature(args.polyA_peak),
+                       file_signature(args.polyA_motif_list),
+                       file_signature(args.phyloP_bed))
+
+
+def correctionPlusORFpred(args, genome_dict, prev_state=None, new_state=None):
     """
     Use the reference genome to correct the sequences (unless a pre-corrected GTF is given)
+    :param prev_state: (--incremental) state of the previous run, None if there is none
+    :param new_state: (--incremental) dict to record the fingerprints of this run, None if not incremental
+
+    With --incremental, existing corrected files are never re-used as they are: only new or changed
+    isoforms are aligned and only new or changed corrected sequences go through GMST.
     """
     global corrORF
     global corrGTF
@@ -468,53 +658,37 @@ def correctionPlusORFpred(args, genome_dict):
 
     corrGTF, corrSAM, corrFASTA, corrORF = get_corr_filenames(args)
 
-    n_cpu = max(1, args.cpus // args.chunks)
+    incremental = new_state is not None
+    if prev_state is None:
+        prev_state = {}
 
     # Step 1. IF GFF or GTF is provided, make it into a genome-based fasta
     #         IF sequence is provided, align as SAM then correct with genome
-    if os.path.exists(corrFASTA):
+    if os.path.exists(corrFASTA) and not incremental:
         print("Error corrected FASTA {0} already exists. Using it...".format(corrFASTA), file=sys.stderr)
     else:
         if not args.gtf:
-            if os.path.exists(corrSAM):
+            if incremental:
+                align_isoforms_incremental(args, prev_state, new_state)
+            elif os.path.exists(corrSAM):
                 print("Aligned SAM {0} already exists. Using it...".format(corrSAM), file=sys.stderr)
             else:
-                if args.aligner_choice == "gmap":
-                    print("****Aligning reads with GMAP...", file=sys.stdout)
-                    cmd = GMAP_CMD.format(cpus=n_cpu,
-                                          dir=os.path.dirname(args.gmap_index),
-                                          name=os.path.basename(args.gmap_index),
-                                          sense=args.sense,
-                                          i=args.isoforms,
-                                          o=corrSAM)
-                elif args.aligner_choice == "minimap2":
-                    print("****Aligning reads with Minimap2...", file=sys.stdout)
-                    cmd = MINIMAP2_CMD.format(cpus=n_cpu,
-                                              sense=args.sense,
-                                              g=args.genome,
-                                              i=args.isoforms,
-                                              o=corrSAM)
-                elif args.aligner_choice == "deSALT":
-                    print("****Aligning reads with deSALT...", file=sys.stdout)
-                    cmd = DESALT_CMD.format(cpus=n_cpu,
-                                            dir=args.gmap_index,
-                                            i=args.isoforms,
-                                            o=corrSAM)
-                if subprocess.check_call(cmd, shell=True)!=0:
-                    print("ERROR running alignment cmd: {0}".format(cmd), file=sys.stderr)
-                    sys.exit(-1)
+                align_isoforms(args, args.isoforms, corrSAM)
 
             # if is fusion - go in and change the IDs to reflect PBfusion.X.1, PBfusion.X.2...
             if args.is_fusion:
                 corrSAM = rewrite_sam_for_fusion_ids(corrSAM)
             # error correct the genome (input: corrSAM, output: corrFASTA)
-            err_correct(args.genome, corrSAM, corrFASTA, genome_dict=genome_dict)
+            with run_profile.stage('err_correct'):
+                err_correct(args.genome, corrSAM, corrFASTA, genome_dict=genome_dict)
             # convert SAM to GFF --> GTF
-            convert_sam_to_gff3(corrSAM, corrGTF+'.tmp', source=os.path.basename(args.genome).split('.')[0])  # convert SAM to GFF3
+            with run_profile.stage('convert_sam_to_gff3'):
+                convert_sam_to_gff3(corrSAM, corrGTF+'.tmp', source=os.path.basename(args.genome).split('.')[0])  # convert SAM to GFF3
             cmd = "{p} {o}.tmp -T -o {o}".format(o=corrGTF, p=GFFREAD_PROG)
-            if subprocess.check_call(cmd, shell=True)!=0:
-                print("ERROR running cmd: {0}".format(cmd), file=sys.stderr)
-                sys.exit(-1)
+            with run_profile.stage('gffread'):
+                if subprocess.check_call(cmd, shell=True)!=0:
+                    print("ERROR running cmd: {0}".format(cmd), file=sys.stderr)
+                    sys.exit(-1)
         else:
             print("Skipping aligning of sequences because GTF file was provided.", file=sys.stdout)
 
@@ -533,7 +707,8 @@ def correctionPlusORFpred(args, genome_dict):
             # GFF to GTF (in case the user provides gff instead of gtf)
             corrGTF_tpm = corrGTF+".tmp"
             try:
-                subprocess.call([GFFREAD_PROG, args.isoforms , '-T', '-o', corrGTF_tpm])
+                with run_profile.stage('gffread'):
+                    subprocess.call([GFFREAD_PROG, args.isoforms , '-T', '-o', corrGTF_tpm])
             except (RuntimeError, TypeError, NameError):
                 sys.stderr.write('ERROR: File %s without GTF/GFF format.\n' % args.isoforms)
                 raise SystemExit(1)
@@ -546,7 +721,7 @@ def correctionPlusORFpred(args, genome_dict):
                         if line[0] != "#":
                             chrom = line.split("\t")[0]
                             type = line.split("\t")[2]
-                            if chrom not in list(genome_dict.keys()):
+                            if chrom not in genome_dict:
                                 sys.stderr.write("\nERROR: gtf \"%s\" chromosome not found in genome reference file.\n" % (chrom))
                                 sys.exit()
                             elif type in ('transcript', 'exon'):
@@ -557,7 +732,8 @@ def correctionPlusORFpred(args, genome_dict):
                 sys.stdout.write("\nIndels will be not calculated since you ran SQANTI2 without alignment step (SQANTI2 with gtf format as transcriptome input).\n")
 
             # GTF to FASTA
-            subprocess.call([GFFREAD_PROG, corrGTF, '-g', args.genome, '-w', corrFASTA])
+            with run_profile.stage('gffread'):
+                subprocess.call([GFFREAD_PROG, corrGTF, '-g', args.genome, '-w', corrFASTA])
 
     # ORF generation
     print("**** Predicting ORF sequences...", file=sys.stdout)
@@ -567,56 +743,43 @@ def correctionPlusORFpred(args, genome_dict):
     if not os.path.exists(gmst_dir):
         os.makedirs(gmst_dir)
 
-    # sequence ID example: PB.2.1 gene_4|GeneMark.hmm|264_aa|+|888|1682
-    gmst_rex = re.compile('(\S+\t\S+\|GeneMark.hmm)\|(\d+)_aa\|(\S)\|(\d+)\|(\d+)')
     orfDict = {}  # GMST seq id --> myQueryProteins object
     if args.skipORF:
         print("WARNING: Skipping ORF prediction because user requested it. All isoforms will be non-coding!", file=sys.stderr)
-    elif os.path.exists(corrORF):
+    elif os.path.exists(corrORF) and not incremental:
         print("ORF file {0} already exists. Using it....".format(corrORF), file=sys.stderr)
-        for r in SeqIO.parse(open(corrORF), 'fasta'):
-            # now process ORFs into myQueryProtein objects
-            m = gmst_rex.match(r.description)
-            if m is None:
-                print("Expected GMST output IDs to be of format '<pbid> gene_4|GeneMark.hmm|<orf>_aa|<strand>|<cds_start>|<cds_end>' but instead saw: {0}! Abort!".format(r.description), file=sys.stderr)
-                sys.exit(-1)
-            orf_length = int(m.group(2))
-            cds_start = int(m.group(4))
-            cds_end = int(m.group(5))
-            orfDict[r.id] = myQueryProteins(cds_start, cds_end, orf_length, proteinID=r.id)
+        read_orf_fasta(corrORF, orfDict)
     else:
-        cur_dir = os.path.abspath(os.getcwd())
-        os.chdir(args.dir)
-        cmd = GMST_CMD.format(i=corrFASTA, o=gmst_pre)
-        if subprocess.check_call(cmd, shell=True, cwd=gmst_dir)!=0:
-            print("ERROR running GMST cmd: {0}".format(cmd), file=sys.stderr)
-            sys.exit(-1)
-        os.chdir(cur_dir)
-        # Modifying ORF sequences by removing sequence before ATG
-        with open(corrORF, "w") as f:
-            for r in SeqIO.parse(open(gmst_pre+'.faa'), 'fasta'):
-                m = gmst_rex.match(r.description)
-                if m is None:
-                    print("Expected GMST output IDs to be of format '<pbid> gene_4|GeneMark.hmm|<orf>_aa|<strand>|<cds_start>|<cds_end>' but instead saw: {0}! Abort!".format(r.description), file=sys.stderr)
-                    sys.exit(-1)
-                id_pre = m.group(1)
-                orf_length = int(m.group(2))
-                orf_strand = m.group(3)
-                cds_start = int(m.group(4))
-                cds_end = int(m.group(5))
-                pos = r.seq.find('M')
-                if pos!=-1:
-                    # must modify both the sequence ID and the sequence
-                    orf_length -= pos
-                    cds_start += pos*3
-                    newid = "{0}|{1}_aa|{2}|{3}|{4}".format(id_pre, orf_length, orf_strand, cds_start, cds_end)
-                    newseq = str(r.seq)[pos:]
-                    orfDict[r.id] = myQueryProteins(cds_start, cds_end, orf_length, proteinID=newid)
-                    f.write(">{0}\n{1}\n".format(newid, newseq))
-                else:
-                    new_rec = r
-                    orfDict[r.id] = myQueryProteins(cds_start, cds_end, orf_length, proteinID=r.id)
-                    f.write(">{0}\n{1}\n".format(new_rec.description, new_rec.seq))
+        gmst_input = corrFASTA
+        keep_ids = set()  # isoforms whose ORF is taken from the previous run (--incremental)
+        n_predict = None
+        if incremental:
+            orf_fps = fasta_fingerprints(corrFASTA)
+            new_state['orf_fp'] = orf_fps
+            if 'orf_fp' in prev_state and os.path.exists(corrORF):
+                to_predict = changed_ids(orf_fps, prev_state['orf_fp'])
+                keep_ids = set(orf_fps).difference(to_predict)
+                n_predict = len(to_predict)
+                print("Incremental run: predicting ORFs for {0} of {1} isoforms.".format(n_predict, len(orf_fps)), file=sys.stdout)
+                gmst_input = os.path.join(gmst_dir, "GMST_delta.fasta")
+                write_fasta_subset(corrFASTA, to_predict, gmst_input)
+
+        with open(corrORF+'.tmp', 'w') as f:
+            if len(keep_ids) > 0:
+                read_orf_fasta(corrORF, orfDict, keep_ids=keep_ids, fout=f)
+            if n_predict != 0:
+                with run_profile.stage('GMST'):
+                    cur_dir = os.path.abspath(os.getcwd())
+                    os.chdir(args.dir)
+                    cmd = GMST_CMD.format(i=gmst_input, o=gmst_pre)
+                    if subprocess.check_call(cmd, shell=True, cwd=gmst_dir)!=0:
+                        print("ERROR running GMST cmd: {0}".format(cmd), file=sys.stderr)
+                        sys.exit(-1)
+                    os.chdir(cur_dir)
+                    trim_gmst_orfs(gmst_pre+'.faa', orfDict, f)
+        if gmst_input != corrFASTA:
+            os.remove(gmst_input)
+        os.replace(corrORF+'.tmp', corrORF)
 
     if len(orfDict) == 0:
         print("WARNING: All input isoforms were predicted as non-coding", file=sys.stderr)
@@ -629,13 +792,27 @@ def reference_parser(args, genome_chroms):
     Read the reference GTF file
     :param args:
     :param genome_chroms: list of chromosome names from the genome fasta, used for sanity checking
-    :return: (refs_1exon_by_chr, refs_exons_by_chr, junctions_by_chr, junctions_by_gene)
+    :return: (refs_1exon_by_chr, refs_exons_by_chr, chains_by_chr, exons_by_chr, junctions_by_chr, genes_by_junction, gene_index)
+
+    The reference indexes are cached (see utilities/ref_cache.py) keyed by the annotation checksum,
+    --min_ref_len and --geneid, so later runs against the same annotation skip the parsing.
     """
     global referenceFiles
 
     referenceFiles = os.path.join(args.dir, "refAnnotation_"+args.output+".genePred")
     print("**** Parsing Reference Transcriptome....", file=sys.stdout)
 
+    cache_file = None
+    if not args.no_ref_cache:
+        cache_dir = args.ref_cache_dir if args.ref_cache_dir is not None else os.path.dirname(args.annotation)
+        cache_key = ref_cache_key(args.annotation, args.min_ref_len, args.geneid, cache_dir)
+        cache_file = ref_cache_filename(cache_dir, args.annotation, cache_key)
+        reference = load_ref_cache(cache_file, cache_key, referenceFiles)
+        if reference is not None:
+            print("Using cached reference annotation {0}.".format(cache_file), file=sys.stdout)
+            check_reference_chroms(reference, genome_chroms)
+            return reference
+
     if os.path.exists(referenceFiles):
         print("{0} already exists. Using it.".format(referenceFiles), file=sys.stdout)
     else:
@@ -648,10 +825,9 @@ def reference_parser(args, genome_chroms):
     ## parse reference annotation
     # 1. ignore all miRNAs (< 200 bp)
     # 2. separately store single exon and multi-exon references
-    refs_1exon_by_chr = defaultdict(lambda: IntervalTree()) #
-    refs_exons_by_chr = defaultdict(lambda: IntervalTree())
+    refs_1exon_list_by_chr = defaultdict(lambda: [])
+    refs_exons_list_by_chr = defaultdict(lambda: [])
     # store donors as the exon end (1-based) and acceptor as the exon start (0-based)
-    # will convert the sets to sorted list later
     junctions_by_chr = defaultdict(lambda: {'donors': set(), 'acceptors': set(), 'da_pairs': set()})
     # dict of gene name --> set of junctions (don't need to record chromosome)
     junctions_by_gene = defaultdict(lambda: set())
@@ -661,13 +837,13 @@ def reference_parser(args, genome_chroms):
     for r in genePredReader(referenceFiles):
         if r.length < args.min_ref_len: continue # ignore miRNAs
         if r.exonCount == 1:
-            refs_1exon_by_chr[r.chrom].insert(r.txStart, r.txEnd, r)
+            refs_1exon_list_by_chr[r.chrom].append(r)
             known_5_3_by_gene[r.gene]['begin'].add(r.txStart)
             known_5_3_by_gene[r.gene]['end'].add(r.txEnd)
         else:
-            refs_exons_by_chr[r.chrom].insert(r.txStart, r.txEnd, r)
+            refs_exons_list_by_chr[r.chrom].append(r)
             # only store junctions for multi-exon transcripts
-            for d, a in r.junctions:
+            for d, a in zip(r.exonEnds[:-1], r.exonStarts[1:]):
                 junctions_by_chr[r.chrom]['donors'].add(d)
                 junctions_by_chr[r.chrom]['acceptors'].add(a)
                 junctions_by_chr[r.chrom]['da_pairs'].add((d,a))
@@ -675,23 +851,58 @@ def reference_parser(args, genome_chroms):
             known_5_3_by_gene[r.gene]['begin'].add(r.txStart)
             known_5_3_by_gene[r.gene]['end'].add(r.txEnd)
 
-    # check that all genes' chromosomes are in the genome file
+    reference = build_reference_index(refs_1exon_list_by_chr, refs_exons_list_by_chr, junctions_by_chr,
+                                      junctions_by_gene, known_5_3_by_gene)
+    if cache_file is not None and write_ref_cache(cache_file, cache_key, reference, referenceFiles):
+        print("Reference annotation cached to {0}.".format(cache_file), file=sys.stdout)
+
+    check_reference_chroms(reference, genome_chroms)
+    return reference
+
+
+def build_reference_index(refs_1exon_list_by_chr, refs_exons_list_by_chr, junctions_by_chr, junctions_by_gene, known_5_3_by_gene):
+    """
+    Build the (cacheable) reference lookup structures from the parsed reference.
+    References are sorted by start for the classification sweep (see RefSweep).
+    :return: (refs_1exon_by_chr, refs_exons_by_chr, chains_by_chr, exons_by_chr, junctions_by_chr, genes_by_junction, gene_index)
+    """
+    refs_1exon_by_chr = {}
+    refs_exons_by_chr = {}
+    chains_by_chr = {}
+    exons_by_chr = {}
+    for chrom, refs in refs_1exon_list_by_chr.items():
+        refs_1exon_by_chr[chrom] = sorted(refs, key=lambda r: r.txStart)
+    for chrom, refs in refs_exons_list_by_chr.items():
+        refs_exons_by_chr[chrom] = sorted(refs, key=lambda r: r.txStart)
+        chains_by_chr[chrom] = ChainIndex(refs_exons_by_chr[chrom])
+        exons_by_chr[chrom] = RefExonIndex(refs_exons_by_chr[chrom])
+
+    # sorted arrays for nearest-site and range queries + hash sets for membership
+    junctions_by_chr = dict((k, JunctionIndex(v['donors'], v['acceptors'], v['da_pairs'])) for k,v in junctions_by_chr.items())
+
+    # inverted index of junctions_by_gene: junction --> set of genes using it
+    genes_by_junction = defaultdict(set)
+    for gene, junctions in junctions_by_gene.items():
+        for junction in junctions:
+            genes_by_junction[junction].add(gene)
+
+    # sorted transcript starts/ends and span of every gene
+    gene_index = GeneIndex(known_5_3_by_gene)
+
+    return refs_1exon_by_chr, refs_exons_by_chr, chains_by_chr, exons_by_chr, junctions_by_chr, dict(genes_by_junction), gene_index
+
+
+def check_reference_chroms(reference, genome_chroms):
+    """
+    Warn about reference chromosomes that are not in the genome file.
+    :param reference: as returned by build_reference_index
+    """
+    refs_1exon_by_chr, refs_exons_by_chr = reference[:2]
     ref_chroms = set(refs_1exon_by_chr.keys()).union(list(refs_exons_by_chr.keys()))
     diff = ref_chroms.difference(genome_chroms)
     if len(diff) > 0:
         print("WARNING: ref annotation contains chromosomes not in genome: {0}\n".format(",".join(diff)), file=sys.stderr)
 
-    # convert the content of junctions_by_chr to sorted list
-    for k in junctions_by_chr:
-        junctions_by_chr[k]['donors'] = list(junctions_by_chr[k]['donors'])
-        junctions_by_chr[k]['donors'].sort()
-        junctions_by_chr[k]['acceptors'] = list(junctions_by_chr[k]['acceptors'])
-        junctions_by_chr[k]['acceptors'].sort()
-        junctions_by_chr[k]['da_pairs'] = list(junctions_by_chr[k]['da_pairs'])
-        junctions_by_chr[k]['da_pairs'].sort()
-
-    return dict(refs_1exon_by_chr), dict(refs_exons_by_chr), dict(junctions_by_chr), dict(junctions_by_gene), dict(known_5_3_by_gene)
-
 
 def isoforms_parser(args):
     """
@@ -778,12 +989,17 @@ def expression_parser(expressionFile):
     return exp_dict
 
 
-def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends_by_gene, trec, genome_dict, nPolyA):
+def transcriptsKnownSpliceSites(sweep_1exon, sweep_exons, mono_exon_hits, chains_by_chr, gene_index, chain_memo, trec, genome_dict, nPolyA):
     """
-    :param refs_1exon_by_chr: dict of single exon references (chr -> IntervalTree)
-    :param refs_exons_by_chr: dict of multi exon references (chr -> IntervalTree)
+    :param sweep_1exon: RefSweep of the single exon references of trec's chromosome (None if there are none)
+    :param sweep_exons: RefSweep of the multi exon references of trec's chromosome (None if there are none)
+    :param mono_exon_hits: for a single exon trec, multi exon references with an exon overlapping it (see RefExonIndex.mono_exon_hits),
+                           None if there are no multi exon references on trec's chromosome
+    :param chains_by_chr: dict of intron chain index of the multi exon references (chr -> ChainIndex)
+    :param gene_index: GeneIndex of the reference genes
+    :param chain_memo: ChainMemo of the comparisons of the intron chains seen so far
     :param trec: id record (genePredRecord) to be compared against reference
-    :param genome_dict: dict of genome (chrom --> SeqRecord)
+    :param genome_dict: IndexedGenome
     :param nPolyA: window size to look for polyA
     :return: myQueryTranscripts object that indicates the best reference hit
     """
@@ -796,33 +1012,13 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
     def gene_overlap(ref1, ref2):
         if ref1==ref2: return True  # same gene, diff isoforms
         # return True if the two reference genes overlap
-        s1, e1 = min(start_ends_by_gene[ref1]['begin']), max(start_ends_by_gene[ref1]['end'])
-        s2, e2 = min(start_ends_by_gene[ref2]['begin']), max(start_ends_by_gene[ref2]['end'])
+        s1, e1 = gene_index.span(ref1)
+        s2, e2 = gene_index.span(ref2)
         if s1 <= s2:
             return e1 <= s2
         else:
             return e2 <= s1
 
-    def calc_splicesite_agreement(query_exons, ref_exons):
-        q_sites = {}
-        for e in query_exons:
-            q_sites[e.start] = 0
-            q_sites[e.end] = 0
-        for e in ref_exons:
-            if e.start in q_sites: q_sites[e.start] = 1
-            if e.end in q_sites: q_sites[e.end] = 1
-        return sum(q_sites.values())
-
-    def calc_exon_overlap(query_exons, ref_exons):
-        q_bases = {}
-        for e in query_exons:
-            for b in range(e.start, e.end): q_bases[b] = 0
-
-        for e in ref_exons:
-            for b in range(e.start, e.end):
-                if b in q_bases: q_bases[b] = 1
-        return sum(q_bases.values())
-
     def get_diff_tss_tts(trec, ref):
         if trec.strand == '+':
             diff_tss = trec.txStart - ref.txStart
@@ -838,14 +1034,12 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
         # add the nearest start/end site for that gene (all isoforms of the gene)
         nearest_start_diff, nearest_end_diff = float('inf'), float('inf')
         for ref_gene in isoform_hit.genes:
-            for x in start_ends_by_gene[ref_gene]['begin']:
-                d = trec.txStart - x
-                if abs(d) < abs(nearest_start_diff):
-                    nearest_start_diff = d
-            for x in start_ends_by_gene[ref_gene]['end']:
-                d = trec.txEnd - x
-                if abs(d) < abs(nearest_end_diff):
-                    nearest_end_diff = d
+            d = gene_index.nearest_begin_diff(ref_gene, trec.txStart)
+            if abs(d) < abs(nearest_start_diff):
+                nearest_start_diff = d
+            d = gene_index.nearest_end_diff(ref_gene, trec.txEnd)
+            if abs(d) < abs(nearest_end_diff):
+                nearest_end_diff = d
 
         if trec.strand == '+':
             isoform_hit.tss_gene_diff = nearest_start_diff if nearest_start_diff!=float('inf') else 'NA'
@@ -863,14 +1057,12 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
         internal_fragment --- all junctions agree but trec has less 5' and 3' exons
         """
         # check intron retention
-        ref_exon_tree = IntervalTree()
-        for i,e in enumerate(ref.exons): ref_exon_tree.insert(e.start, e.end, i)
-        for e in trec.exons:
-            if len(ref_exon_tree.find(e.start, e.end)) > 1: # multiple ref exons covered
+        for s, e in zip(trec.exonStarts, trec.exonEnds):
+            if ref.count_overlapping_exons(s, e) > 1: # multiple ref exons covered
                 return "intron_retention"
 
-        agree_front = trec.junctions[0]==ref.junctions[0]
-        agree_end   = trec.junctions[-1]==ref.junctions[-1]
+        agree_front = trec.exonEnds[0]==ref.exonEnds[0] and trec.exonStarts[1]==ref.exonStarts[1]
+        agree_end   = trec.exonEnds[-2]==ref.exonEnds[-2] and trec.exonStarts[-1]==ref.exonStarts[-1]
         if agree_front:
             if agree_end:
                 return "complete"
@@ -887,10 +1079,10 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
     # Intra-priming: calculate percentage of "A"s right after the end
     if trec.strand == "+":
         pos_TTS = trec.exonEnds[-1]
-        seq_downTTS = str(genome_dict[trec.chrom].seq[pos_TTS:pos_TTS+nPolyA]).upper()
+        seq_downTTS = genome_dict.fetch(trec.chrom, pos_TTS, pos_TTS+nPolyA).upper()
     else: # id on - strand
         pos_TTS = trec.exonStarts[0]
-        seq_downTTS = str(genome_dict[trec.chrom].seq[pos_TTS-nPolyA:pos_TTS].reverse_complement()).upper()
+        seq_downTTS = genome_dict.fetch_oriented(trec.chrom, pos_TTS-nPolyA, pos_TTS, '-').upper()
 
     percA = float(seq_downTTS.count('A'))/nPolyA*100
 
@@ -919,15 +1111,25 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
         hits_by_gene = defaultdict(lambda: [])  # gene --> list of hits
         best_by_gene = {}  # gene --> best isoform_hit
 
-        if trec.chrom in refs_exons_by_chr:
-            for ref in refs_exons_by_chr[trec.chrom].find(trec.txStart, trec.txEnd):
+        if sweep_exons is not None:
+            for ref in sweep_exons.overlapping(trec.txStart, trec.txEnd):
                 hits_by_gene[ref.gene].append(ref)
-        if trec.chrom in refs_1exon_by_chr:
-            for ref in refs_1exon_by_chr[trec.chrom].find(trec.txStart, trec.txEnd):
+        if sweep_1exon is not None:
+            for ref in sweep_1exon.overlapping(trec.txStart, trec.txEnd):
                 hits_by_gene[ref.gene].append(ref)
 
         if len(hits_by_gene) == 0: return isoform_hit
 
+        # full-splice and incomplete-splice matches by intron chain lookup,
+        # only the other multi-exon refs need the pairwise junction comparison
+        chain_matches = chains_by_chr[trec.chrom].match_types(trec) if trec.chrom in chains_by_chr else {}
+
+        # match type, splice-site agreement, exonic overlap and TSS/TTS differences against all same strand refs at once
+        same_strand = [ref for refs in hits_by_gene.values() for ref in refs if ref.strand == trec.strand]
+        # (isoforms sharing the intron chain re-use the chain-only parts)
+        memo_entry = chain_memo.lookup((trec.chrom,) + chain_key(trec), trec)
+        comparisons = dict(zip(same_strand, compare_to_refs(trec, same_strand, chain_matches, memo_entry)))
+
         for ref_gene in hits_by_gene:
             isoform_hit = myQueryTranscripts(id=trec.id, tts_diff="NA", tss_diff="NA", \
                                              num_exons=trec.exonCount,
@@ -945,10 +1147,12 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                     isoform_hit.AS_genes.add(ref.gene)
                     continue
 
+                match_type, q_sp_hit, q_ex_overlap, diff_tss, diff_tts = comparisons[ref]
+
                 #if trec.id.startswith('PB.102.9'):
                 #    pdb.set_trace()
                 if ref.exonCount == 1: # mono-exonic reference, handle specially here
-                    if calc_exon_overlap(trec.exons, ref.exons) > 0 and cat_ranking[isoform_hit.str_class] < cat_ranking["geneOverlap"]:
+                    if q_ex_overlap > 0 and cat_ranking[isoform_hit.str_class] < cat_ranking["geneOverlap"]:
                         isoform_hit = myQueryTranscripts(trec.id, "NA", "NA", trec.exonCount, trec.length,
                                                             "geneOverlap",
                                                              subtype="mono-exon",
@@ -961,17 +1165,11 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                                                              refStart=ref.txStart,
                                                              refEnd=ref.txEnd,
                                                              q_splicesite_hit=0,
-                                                             q_exon_overlap=calc_exon_overlap(trec.exons, ref.exons),
+                                                             q_exon_overlap=q_ex_overlap,
                                                              percAdownTTS=str(percA),
                                                              seqAdownTTS=seq_downTTS)
 
                 else: # multi-exonic reference
-                    match_type = compare_junctions(trec, ref, internal_fuzzy_max_dist=0, max_5_diff=999999, max_3_diff=999999)
-
-                    if match_type not in ('exact', 'subset', 'partial', 'concordant', 'super', 'nomatch'):
-                        raise Exception("Unknown match category {0}!".format(match_type))
-
-                    diff_tss, diff_tts = get_diff_tss_tts(trec, ref)
                     #has_overlap = gene_overlap(isoform_hit.genes[-1], ref.gene) if len(isoform_hit.genes) >= 1 else Fals
                     # #############################
                     # SQANTI's full-splice_match
@@ -994,8 +1192,8 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                                                              refExons= ref.exonCount,
                                                              refStart=ref.txStart,
                                                              refEnd=ref.txEnd,
-                                                             q_splicesite_hit=calc_splicesite_agreement(trec.exons, ref.exons),
-                                                             q_exon_overlap=calc_exon_overlap(trec.exons, ref.exons),
+                                                             q_splicesite_hit=q_sp_hit,
+                                                             q_exon_overlap=q_ex_overlap,
                                                              percAdownTTS=str(percA),
                                                              seqAdownTTS=seq_downTTS)
                     # #######################################################
@@ -1020,16 +1218,14 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                                                              refExons= ref.exonCount,
                                                              refStart=ref.txStart,
                                                              refEnd=ref.txEnd,
-                                                             q_splicesite_hit=calc_splicesite_agreement(trec.exons, ref.exons),
-                                                             q_exon_overlap=calc_exon_overlap(trec.exons, ref.exons),
+                                                             q_splicesite_hit=q_sp_hit,
+                                                             q_exon_overlap=q_ex_overlap,
                                                              percAdownTTS=str(percA),
                                                              seqAdownTTS=seq_downTTS)
                     # #######################################################
                     # Some kind of junction match that isn't ISM/FSM
                     # #######################################################
-                    elif match_type in ('partial', 'concordant', 'super'):
-                        q_sp_hit = calc_splicesite_agreement(trec.exons, ref.exons)
-                        q_ex_overlap = calc_exon_overlap(trec.exons, ref.exons)
+                    elif match_type in ('partial', 'super'):
                         q_exon_d = abs(trec.exonCount - ref.exonCount)
                         if cat_ranking[isoform_hit.str_class] < cat_ranking["anyKnownJunction"] or \
                                 (isoform_hit.str_class=='anyKnownJunction' and q_sp_hit > isoform_hit.q_splicesite_hit) or \
@@ -1046,15 +1242,15 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                                                              refExons=ref.exonCount,
                                                              refStart=ref.txStart,
                                                              refEnd=ref.txEnd,
-                                                             q_splicesite_hit=calc_splicesite_agreement(trec.exons, ref.exons),
-                                                             q_exon_overlap=calc_exon_overlap(trec.exons, ref.exons),
+                                                             q_splicesite_hit=q_sp_hit,
+                                                             q_exon_overlap=q_ex_overlap,
                                                              percAdownTTS=str(percA),
                                                              seqAdownTTS=seq_downTTS)
                     else: # must be nomatch
                         assert match_type == 'nomatch'
                         # at this point, no junction overlap, but may be a single splice site (donor or acceptor) match?
                         # also possibly just exonic (no splice site) overlap
-                        if cat_ranking[isoform_hit.str_class] < cat_ranking["anyKnownSpliceSite"] and calc_splicesite_agreement(trec.exons, ref.exons) > 0:
+                        if cat_ranking[isoform_hit.str_class] < cat_ranking["anyKnownSpliceSite"] and q_sp_hit > 0:
                             isoform_hit = myQueryTranscripts(trec.id, "NA", "NA", trec.exonCount, trec.length,
                                                              str_class="anyKnownSpliceSite",
                                                              subtype="no_subcategory",
@@ -1066,14 +1262,13 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                                                              refExons=ref.exonCount,
                                                              refStart=ref.txStart,
                                                              refEnd=ref.txEnd,
-                                                             q_splicesite_hit=calc_splicesite_agreement(trec.exons, ref.exons),
-                                                             q_exon_overlap=calc_exon_overlap(trec.exons,
-                                                                                              ref.exons),
+                                                             q_splicesite_hit=q_sp_hit,
+                                                             q_exon_overlap=q_ex_overlap,
                                                              percAdownTTS=str(percA),
                                                              seqAdownTTS=seq_downTTS)
 
                         if isoform_hit.str_class=="": # still not hit yet, check exonic overlap
-                            if cat_ranking[isoform_hit.str_class] < cat_ranking["geneOverlap"] and calc_exon_overlap(trec.exons, ref.exons) > 0:
+                            if cat_ranking[isoform_hit.str_class] < cat_ranking["geneOverlap"] and q_ex_overlap > 0:
                                 isoform_hit = myQueryTranscripts(trec.id, "NA", "NA", trec.exonCount, trec.length,
                                                                  str_class="geneOverlap",
                                                                  subtype="no_subcategory",
@@ -1085,8 +1280,8 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                                                                  refExons=ref.exonCount,
                                                                  refStart=ref.txStart,
                                                                  refEnd=ref.txEnd,
-                                                                 q_splicesite_hit=calc_splicesite_agreement(trec.exons, ref.exons),
-                                                                 q_exon_overlap=calc_exon_overlap(trec.exons, ref.exons),
+                                                                 q_splicesite_hit=q_sp_hit,
+                                                                 q_exon_overlap=q_ex_overlap,
                                                                  percAdownTTS=str(percA),
                                                                  seqAdownTTS=seq_downTTS)
 
@@ -1105,7 +1300,7 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
         # cat_ranking = {'full-splice_match': 5, 'incomplete-splice_match': 4, 'anyKnownJunction': 3, 'anyKnownSpliceSite': 2,
         #                    'geneOverlap': 1, '': 0}
 
-        best_by_gene.sort(key=lambda x: (x.score,x.iso_hit.q_splicesite_hit+(x.iso_hit.q_exon_overlap)*1./sum(e.end-e.start for e in trec.exons)+calc_overlap(x.rStart,x.rEnd,trec.txStart,trec.txEnd)*1./(x.rEnd-x.rStart)-abs(trec.exonCount-x.iso_hit.refExons)), reverse=True)  # sort by (ranking score, overlap)
+        best_by_gene.sort(key=lambda x: (x.score,x.iso_hit.q_splicesite_hit+(x.iso_hit.q_exon_overlap)*1./trec.length+calc_overlap(x.rStart,x.rEnd,trec.txStart,trec.txEnd)*1./(x.rEnd-x.rStart)-abs(trec.exonCount-x.iso_hit.refExons)), reverse=True)  # sort by (ranking score, overlap)
         isoform_hit = best_by_gene[0].iso_hit
         cur_start, cur_end = best_by_gene[0].rStart, best_by_gene[0].rEnd
         for t in best_by_gene[1:]:
@@ -1118,8 +1313,8 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
     ########### UNSPLICED TRANSCRIPTS ###########
     ##***************************************####
     else: # single exon id
-        if trec.chrom in refs_1exon_by_chr:
-            for ref in refs_1exon_by_chr[trec.chrom].find(trec.txStart, trec.txEnd):
+        if sweep_1exon is not None:
+            for ref in sweep_1exon.overlapping(trec.txStart, trec.txEnd):
                 if ref.strand != trec.strand:
                     # opposite strand, just record it in AS_genes
                     isoform_hit.AS_genes.add(ref.gene)
@@ -1141,27 +1336,25 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                 elif abs(diff_tss)+abs(diff_tts) < isoform_hit.get_total_diff():
                     isoform_hit.modify(ref.id, ref.gene, diff_tss, diff_tts, ref.length, ref.exonCount)
 
-        if isoform_hit.str_class == "" and trec.chrom in refs_exons_by_chr:
+        if isoform_hit.str_class == "" and mono_exon_hits is not None:
             # no hits to single exon genes, let's see if it hits multi-exon genes
             # (1) if it overlaps with a ref exon and is contained in an exon, we call it ISM
             # (2) else, if it is completely within a ref gene start-end region, we call it NIC by intron retention
-            for ref in refs_exons_by_chr[trec.chrom].find(trec.txStart, trec.txEnd):
-                if calc_exon_overlap(trec.exons, ref.exons) == 0:   # no exonic overlap, skip!
-                    continue
+            # (only refs with exonic overlap are in mono_exon_hits)
+            for ref, within_ref_exon in mono_exon_hits:
                 if ref.strand != trec.strand:
                     # opposite strand, just record it in AS_genes
                     isoform_hit.AS_genes.add(ref.gene)
                     continue
                 diff_tss, diff_tts = get_diff_tss_tts(trec, ref)
 
-                for e in ref.exons:
-                    if e.start <= trec.txStart < trec.txEnd <= e.end:
-                        isoform_hit.str_class = "incomplete-splice_match"
-                        isoform_hit.subtype = "mono-exon"
-                        isoform_hit.modify(ref.id, ref.gene, diff_tss, diff_tts, ref.length, ref.exonCount)
-                        # this is as good a match as it gets, we can stop the search here
-                        get_gene_diff_tss_tts(isoform_hit)
-                        return isoform_hit
+                if within_ref_exon:
+                    isoform_hit.str_class = "incomplete-splice_match"
+                    isoform_hit.subtype = "mono-exon"
+                    isoform_hit.modify(ref.id, ref.gene, diff_tss, diff_tts, ref.length, ref.exonCount)
+                    # this is as good a match as it gets, we can stop the search here
+                    get_gene_diff_tss_tts(isoform_hit)
+                    return isoform_hit
 
                 # if we haven't exited here, then ISM hit is not found yet
                 # instead check if it's NIC by intron retention
@@ -1170,11 +1363,10 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                     isoform_hit.str_class = "novel_in_catalog"
                     isoform_hit.subtype = "mono-exon"
                     # check for intron retention
-                    if len(ref.junctions) > 0:
-                        for (d,a) in ref.junctions:
-                            if trec.txStart < d < a < trec.txEnd:
-                                isoform_hit.subtype = "mono-exon_by_intron_retention"
-                                break
+                    for d, a in zip(ref.exonEnds[:-1], ref.exonStarts[1:]):
+                        if trec.txStart < d < a < trec.txEnd:
+                            isoform_hit.subtype = "mono-exon_by_intron_retention"
+                            break
                     isoform_hit.modify("novel", ref.gene, 'NA', 'NA', ref.length, ref.exonCount)
                     get_gene_diff_tss_tts(isoform_hit)
                     return isoform_hit
@@ -1183,21 +1375,20 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
                 isoform_hit.genes.append(ref.gene)
 
     get_gene_diff_tss_tts(isoform_hit)
-    isoform_hit.genes.sort(key=lambda x: start_ends_by_gene[x]['begin'])
+    isoform_hit.genes.sort(key=gene_index.start)
     return isoform_hit
 
 
-def novelIsoformsKnownGenes(isoforms_hit, trec, junctions_by_chr, junctions_by_gene, start_ends_by_gene):
+def novelIsoformsKnownGenes(isoforms_hit, trec, junctions_by_chr, genes_by_junction, gene_index):
     """
     At this point: definitely not FSM or ISM, see if it is NIC, NNC, or fusion
     :return isoforms_hit: updated isoforms hit (myQueryTranscripts object)
     """
+    junction_index = junctions_by_chr[trec.chrom]
+
     def has_intron_retention():
-        for e in trec.exons:
-            m = bisect.bisect_left(junctions_by_chr[trec.chrom]['da_pairs'], (e.start, e.end))
-            if m < len(junctions_by_chr[trec.chrom]['da_pairs']) and e.start <= junctions_by_chr[trec.chrom]['da_pairs'][m][0] < junctions_by_chr[trec.chrom]['da_pairs'][m][1] < e.end:
-                return True
-        return False
+        # any known intron within one of the query exons
+        return any(junction_index.introns.has_intron_within(s, e) for s, e in zip(trec.exonStarts, trec.exonEnds))
 
     ref_genes = list(set(isoforms_hit.genes))
 
@@ -1211,14 +1402,14 @@ def novelIsoformsKnownGenes(isoforms_hit, trec, junctions_by_chr, junctions_by_g
     isoforms_hit.transcripts = ["novel"]
     if len(ref_genes) == 1:
         # hits exactly one gene, must be either NIC or NNC
-        ref_gene_junctions = junctions_by_gene[ref_genes[0]]
+        ref_gene = ref_genes[0]
         # 1. check if all donors/acceptor sites are known (regardless of which ref gene it came from)
         # 2. check if this query isoform uses a subset of the junctions from the single ref hit
         all_junctions_known = True
         all_junctions_in_hit_ref = True
-        for d,a in trec.junctions:
-            all_junctions_known = all_junctions_known and (d in junctions_by_chr[trec.chrom]['donors']) and (a in junctions_by_chr[trec.chrom]['acceptors'])
-            all_junctions_in_hit_ref = all_junctions_in_hit_ref and ((d,a) in ref_gene_junctions)
+        for d,a in zip(trec.exonEnds[:-1], trec.exonStarts[1:]):
+            all_junctions_known = all_junctions_known and junction_index.has_known_sites(d, a)
+            all_junctions_in_hit_ref = all_junctions_in_hit_ref and (ref_gene in genes_by_junction.get((d,a), ()))
         if all_junctions_known:
             isoforms_hit.str_class="novel_in_catalog"
             if all_junctions_in_hit_ref:
@@ -1229,19 +1420,11 @@ def novelIsoformsKnownGenes(isoforms_hit, trec, junctions_by_chr, junctions_by_g
             isoforms_hit.str_class="novel_not_in_catalog"
             isoforms_hit.subtype = "at_least_one_novel_splicesite"
     else: # see if it is fusion
-        # list of a ref junctions from all genes, including potential shared junctions
-        # NOTE: some ref genes could be mono-exonic so no junctions
-        all_ref_junctions = list(itertools.chain(junctions_by_gene[ref_gene] for ref_gene in ref_genes if ref_gene in junctions_by_gene))
-
-        # (junction index) --> number of refs that have this junction
-        junction_ref_hit = dict((i, all_ref_junctions.count(junc)) for i,junc in enumerate(trec.junctions))
-
-        # if the same query junction appears in more than one of the hit references, it is not a fusion
-        if max(junction_ref_hit.values()) > 1:
-            isoforms_hit.str_class = "moreJunctions"
-        else:
-            isoforms_hit.str_class = "fusion"
-            isoforms_hit.subtype = "mono-exon" if trec.exonCount==1 else "multi-exon"
+        # NOTE: every multi-gene hit is a fusion. The check that a query junction shared by more than one
+        #       of the hit genes is not a fusion ("moreJunctions") never triggered before (it counted junctions
+        #       in a list of sets), and sqanti_filter2.py and the R report do not know that category.
+        isoforms_hit.str_class = "fusion"
+        isoforms_hit.subtype = "mono-exon" if trec.exonCount==1 else "multi-exon"
 
     if has_intron_retention():
         isoforms_hit.subtype = "intron_retention"
@@ -1267,14 +1450,9 @@ def associationOverlapping(isoforms_hit, trec, junctions_by_chr):
         # check if it is anti-sense to a known gene, otherwise it's genic_intron or intergenic
         if len(isoforms_hit.AS_genes) == 0 and trec.chrom in junctions_by_chr:
             # no hit even on opp strand
-            # see if it is completely contained within a junction
-            da_pairs = junctions_by_chr[trec.chrom]['da_pairs']
-            i = bisect.bisect_left(da_pairs, (trec.txStart, trec.txEnd))
-            while i < len(da_pairs) and da_pairs[i][0] <= trec.txStart:
-                if da_pairs[i][0] <= trec.txStart <= trec.txStart <= da_pairs[i][1]:
-                    isoforms_hit.str_class = "genic_intron"
-                    break
-                i += 1
+            # see if it is completely contained within a known intron
+            if junctions_by_chr[trec.chrom].introns.has_intron_around(trec.txStart, trec.txEnd):
+                isoforms_hit.str_class = "genic_intron"
         else:
             # hits one or more genes on the opposite strand
             isoforms_hit.str_class = "antisense"
@@ -1294,90 +1472,372 @@ def associationOverlapping(isoforms_hit, trec, junctions_by_chr):
     return isoforms_hit
 
 
-def write_junctionInfo(trec, junctions_by_chr, accepted_canonical_sites, indelInfo, genome_dict, fout, covInf=None, covNames=None, phyloP_reader=None):
+def annotate_junctions(chrom, junctions, junctions_by_chr, genome_dict, accepted_canonical_sites, covInf=None, covNames=None, phyloP_reader=None):
     """
-    :param trec: query isoform genePredRecord
-    :param junctions_by_chr: dict of chr -> {'donors': <sorted list of donors>, 'acceptors': <sorted list of acceptors>, 'da_pairs': <sorted list of junctions>}
+    Build the table of unique junctions of one chromosome: every attribute of a junction row that does not
+    depend on the isoform is computed once per junction, however many isoforms share it.
+    :param junctions: iterable of (strand, d, a) junctions (1-based donor exon end, 0-based acceptor exon start)
+    :param junctions_by_chr: dict of chr -> JunctionIndex
+    :param genome_dict: IndexedGenome
     :param accepted_canonical_sites: list of accepted canonical splice sites
-    :param indelInfo: indels near junction information, dict of pbid --> list of junctions near indel (in Interval format)
-    :param genome_dict: genome fasta dict
-    :param fout: DictWriter handle
     :param covInf: (optional) junction coverage information, dict of (chrom,strand) -> (0-based start,1-based end) -> dict of {sample -> unique read count}
     :param covNames: (optional) list of sample names for the junction coverage information
-    :param phyloP_reader: (optional) dict of (chrom,0-based coord) --> phyloP score
-
-    Write a record for each junction in query isoform
+    :param phyloP_reader: (optional) LazyBEDPointReader of phyloP scores
+    :return: dict of (strand, d, a) --> dict of the junction fields (see write_junctionInfo)
     """
-    def find_closest_in_list(lst, pos):
-        i = bisect.bisect_left(lst, pos)
-        if i == 0:
-            return lst[0]-pos
-        elif i == len(lst):
-            return lst[-1]-pos
+    juncs = list(set(junctions))
+    if len(juncs) == 0:
+        return {}
+    junction_index = junctions_by_chr[chrom]
+    donors = np.fromiter((d for strand,d,a in juncs), dtype=np.int64, count=len(juncs))
+    acceptors = np.fromiter((a for strand,d,a in juncs), dtype=np.int64, count=len(juncs))
+
+    # NOTE: donor just means the start, not adjusted for strand
+    # find the closest junction start site and the closest junction end site
+    min_diff_s = (-junction_index.closest_donor_diffs(donors)).tolist()
+    min_diff_e = junction_index.closest_acceptor_diffs(acceptors).tolist()
+
+    seq_d = genome_dict.fetch_batch(chrom, donors.tolist(), 2)
+    seq_a = genome_dict.fetch_batch(chrom, (acceptors-2).tolist(), 2)
+
+    table = {}
+    for i, (strand, d, a) in enumerate(juncs):
+        splice_site = seq_d[i] + seq_a[i]
+        if strand == '+':
+            splice_site = splice_site.upper()
         else:
-            a, b = lst[i-1]-pos, lst[i]-pos
-            if abs(a) < abs(b): return a
-            else: return b
+            splice_site = reverse_complement(splice_site).upper()
 
-    if trec.chrom not in junctions_by_chr:
+        # if phyloP score dict exists, give the triplet score of (last base in donor exon), donor site -- similarly for acceptor
+        phyloP_start, phyloP_end = 'NA', 'NA'
+        if phyloP_reader is not None:
+            phyloP_start = ",".join([str(phyloP_reader.get_pos(chrom, x)) for x in (d-1, d, d+1)])
+            phyloP_end = ",".join([str(phyloP_reader.get_pos(chrom, x)) for x in (a-1, a, a+1)])
+
+        row = {"chrom": chrom,
+               "strand": strand,
+               "genomic_start_coord": d+1,  # write out as 1-based start
+               "genomic_end_coord": a,      # already is 1-based end
+               "transcript_coord": "?????",  # this is where the exon ends w.r.t to id sequence, ToDo: implement later
+               "junction_category": "known" if (d, a) in junction_index else "novel",
+               "start_site_category": "known" if min_diff_s[i]==0 else "novel",
+               "end_site_category": "known" if min_diff_e[i]==0 else "novel",
+               "diff_to_Ref_start_site": min_diff_s[i],
+               "diff_to_Ref_end_site": min_diff_e[i],
+               "bite_junction": "TRUE" if (min_diff_s[i]==0 or min_diff_e[i]==0) else "FALSE",
+               "splice_site": splice_site,
+               "canonical": "canonical" if splice_site in accepted_canonical_sites else "non_canonical",
+               "RTS_junction": "????", # First write ???? in _tmp, later is TRUE/FALSE
+               "phyloP_start": phyloP_start,
+               "phyloP_end": phyloP_end,
+               "sample_with_cov": "NA",
+               "total_coverage": "NA"}
+
+        if covInf is not None:
+            sample_cov = covInf[(chrom, strand)].get((d, a), {})  # sample -> unique count for this junction
+            row["sample_with_cov"] = sum(cov!=0 for cov in sample_cov.values())
+            row["total_coverage"] = sum(sample_cov.values())
+            for sample in covNames:
+                row[sample] = sample_cov.get(sample, 0)
+
+        table[(strand, d, a)] = row
+    return table
+
+
+def write_junctionInfo(trec, junction_table, indelInfo, fout):
+    """
+    :param trec: query isoform genePredRecord
+    :param junction_table: unique junctions of trec's chromosome (see annotate_junctions), None if no known junctions on the chromosome
+    :param indelInfo: indels near junction information, dict of pbid --> list of junctions near indel (in Interval format)
+    :param fout: DictWriter handle
+
+    Write a record for each junction in query isoform. A record only holds the isoform specific fields
+    and refers to the (shared) junction fields of junction_table.
+    """
+    if junction_table is None:
         # nothing to do
         return
 
+    indel_junctions = None
+    if indelInfo is not None:
+        indel_junctions = set((sj.start, sj.end) for sj in indelInfo[trec.id]) if trec.id in indelInfo else set()
+
     # go through each trec junction
-    for junction_index, (d, a) in enumerate(trec.junctions):
-        # NOTE: donor just means the start, not adjusted for strand
-        # find the closest junction start site
-        min_diff_s = -find_closest_in_list(junctions_by_chr[trec.chrom]['donors'], d)
-        # find the closest junction end site
-        min_diff_e = find_closest_in_list(junctions_by_chr[trec.chrom]['acceptors'], a)
+    for junction_index, (d, a) in enumerate(zip(trec.exonEnds[:-1], trec.exonStarts[1:])):
+        indel_near_junction = "NA"
+        if indel_junctions is not None:
+            indel_near_junction = "TRUE" if (d,a) in indel_junctions else "FALSE"
 
-        splice_site = trec.get_splice_site(genome_dict, junction_index)
+        qj = {'isoform': trec.id,
+              'junction_number': "junction_"+str(junction_index+1),
+              "indel_near_junct": indel_near_junction}
 
-        indel_near_junction = "NA"
-        if indelInfo is not None:
-            indel_near_junction = "TRUE" if (trec.id in indelInfo and Interval(d,a) in indelInfo[trec.id]) else "FALSE"
+        fout.writerow(ChainMap(qj, junction_table[(trec.strand, d, a)]))
 
-        sample_cov = defaultdict(lambda: 0)  # sample -> unique count for this junction
-        if covInf is not None:
-            sample_cov = covInf[(trec.chrom, trec.strand)][(d,a)]
 
-        # if phyloP score dict exists, give the triplet score of (last base in donor exon), donor site -- similarly for acceptor
-        phyloP_start, phyloP_end = 'NA', 'NA'
-        if phyloP_reader is not None:
-            phyloP_start = ",".join([str(x) for x in [phyloP_reader.get_pos(trec.chrom, d-1), phyloP_reader.get_pos(trec.chrom, d), phyloP_reader.get_pos(trec.chrom, d+1)]])
-            phyloP_end = ",".join([str(x) for x in [phyloP_reader.get_pos(trec.chrom, a-1), phyloP_reader.get_pos(trec.chrom, a),
-                                              phyloP_reader.get_pos(trec.chrom, a+1)]])
+class RowBuffer(list):
+    """
+    In-memory stand-in for a DictWriter: collects the rows passed to writerow().
+    Used by classification workers, the rows are written out by the parent process.
+    """
+    def writerow(self, row):
+        self.append(row)
 
-        qj = {'isoform': trec.id,
-              'junction_number': "junction_"+str(junction_index+1),
-              "chrom": trec.chrom,
-              "strand": trec.strand,
-              "genomic_start_coord": d+1,  # write out as 1-based start
-              "genomic_end_coord": a,      # already is 1-based end
-              "transcript_coord": "?????",  # this is where the exon ends w.r.t to id sequence, ToDo: implement later
-              "junction_category": "known" if ((d,a) in junctions_by_chr[trec.chrom]['da_pairs']) else "novel",
-              "start_site_category": "known" if min_diff_s==0 else "novel",
-              "end_site_category": "known" if min_diff_e==0 else "novel",
-              "diff_to_Ref_start_site": min_diff_s,
-              "diff_to_Ref_end_site": min_diff_e,
-              "bite_junction": "TRUE" if (min_diff_s==0 or min_diff_e==0) else "FALSE",
-              "splice_site": splice_site,
-              "canonical": "canonical" if splice_site in accepted_canonical_sites else "non_canonical",
-              "RTS_junction": "????", # First write ???? in _tmp, later is TRUE/FALSE
-              "indel_near_junct": indel_near_junction,
-              "phyloP_start": phyloP_start,
-              "phyloP_end": phyloP_end,
-              "sample_with_cov": sum(cov!=0 for cov in sample_cov.values()) if covInf is not None else "NA",
-              "total_coverage": sum(sample_cov.values()) if covInf is not None else "NA"}
 
-        if covInf is not None:
-            for sample in covNames:
-                qj[sample] = sample_cov[sample]
+# Shared state of the classification stage. It is set by isoformClassification before the
+# worker pool is forked, so workers see the reference, genome and annotation sources
+# copy-on-write instead of re-loading or receiving pickled copies of them.
+classification_ctx = {}
+
+
+def make_classification_buckets(isoforms_by_chr, target_size):
+    """
+    Partition the isoforms into buckets of about <target_size> records, keeping the classification order.
+    A chromosome is only split between loci (where no earlier isoform extends past the next start),
+    and consecutive small chromosomes/scaffolds are packed together into one bucket.
+    :param isoforms_by_chr: dict of chrom --> list of genePredRecord sorted by txStart
+    :return: list of buckets (list of genePredRecord)
+    """
+    buckets = []
+    cur = []
+    for chrom, records in isoforms_by_chr.items():
+        max_end = None
+        for rec in records:
+            if len(cur) >= target_size and (max_end is None or rec.txStart >= max_end):
+                buckets.append(cur)
+                cur = []
+            cur.append(rec)
+            max_end = rec.txEnd if max_end is None else max(max_end, rec.txEnd)
+    if len(cur) > 0:
+        buckets.append(cur)
+    return buckets
 
-        fout.writerow(qj)
 
+def init_classification_worker():
+    # the LazyBEDPointReader seeks in an open file, so each process needs its own handle
+    if classification_ctx['args'].phyloP_bed is not None:
+        classification_ctx['phyloP_reader'] = LazyBEDPointReader(classification_ctx['args'].phyloP_bed)
 
-def isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_by_chr, junctions_by_chr, junctions_by_gene, start_ends_by_gene, genome_dict, indelsJunc, orfDict):
+
+def isoform_class_fingerprint(rec, orf, indel_junctions):
+    """
+    (--incremental) fingerprint of everything the classification of one isoform depends on,
+    other than the global inputs (reference, genome, peak/coverage files...).
+    :param orf: myQueryProteins of the isoform or None
+    :param indel_junctions: list of junctions near indels (Interval) or None if indels are not computed
+    """
+    return fingerprint(rec.as_fields(),
+                       (orf.cds_start, orf.cds_end, orf.orf_length, orf.proteinID) if orf is not None else None,
+                       [(j.start, j.end) for j in indel_junctions] if indel_junctions is not None else None)
+
+
+def classify_bucket(bucket_index):
+    """
+    Classify all isoforms of one bucket (see make_classification_buckets)
+    With --incremental, isoforms whose fingerprint did not change re-use the rows of the previous run.
+    :return: bucket_index, list of (isoform id, fingerprint or None, classification row (dict) or None, list of junction rows),
+             timing/memory of the bucket (see StageTimer)
+    """
+    timer = StageTimer()
+    chain_memo = classification_ctx['chain_memo']
+    memo_hits, memo_misses = chain_memo.hits, chain_memo.misses
+    records = classification_ctx['buckets'][bucket_index]
+    junctions_by_chr = classification_ctx['junctions_by_chr']
+    class_cache = classification_ctx['class_cache']
+    if classification_ctx['incremental']:
+        orfDict, indelsJunc = classification_ctx['orfDict'], classification_ctx['indelsJunc']
+        fps = [isoform_class_fingerprint(rec, orfDict.get(rec.id),
+                                         None if indelsJunc is None else indelsJunc.get(rec.id, [])) for rec in records]
+    else:
+        fps = [None] * len(records)
+    if class_cache is not None:
+        cached = [class_cache.get(rec.id, fp) for rec, fp in zip(records, fps)]
+        to_classify = [rec for rec, c in zip(records, cached) if c is None]
+    else:
+        cached = [None] * len(records)
+        to_classify = records
+
+    # annotate the unique junctions of the bucket once, per chromosome. Buckets are only split between loci,
+    # so all the isoforms sharing a junction are in the same bucket and each junction is annotated once per run.
+    ctx = classification_ctx
+    junction_table_by_chr = {}
+    for chrom in set(rec.chrom for rec in to_classify):
+        if chrom in junctions_by_chr:
+            junction_table_by_chr[chrom] = annotate_junctions(chrom,
+                                                              ((rec.strand, d, a) for rec in to_classify if rec.chrom == chrom for d, a in zip(rec.exonEnds[:-1], rec.exonStarts[1:])),
+                                                              junctions_by_chr, ctx['genome_dict'], ctx['accepted_canonical_sites'],
+                                                              covInf=ctx['SJcovInfo'], covNames=ctx['SJcovNames'], phyloP_reader=ctx['phyloP_reader'])
+
+    # the bucket's isoforms are sorted by start within each chromosome: sweep them against the sorted references
+    ref_sweeps = {}  # chrom --> (RefSweep of single exon refs, RefSweep of multi exon refs)
+    mono_exon_hits = {}  # single exon isoform id --> multi exon refs overlapping it (see RefExonIndex.mono_exon_hits)
+    for chrom in set(rec.chrom for rec in to_classify):
+        ref_sweeps[chrom] = tuple(RefSweep(refs_by_chr[chrom]) if chrom in refs_by_chr else None
+                                  for refs_by_chr in (classification_ctx['refs_1exon_by_chr'], classification_ctx['refs_exons_by_chr']))
+        if chrom in classification_ctx['exons_by_chr']:
+            mono = [rec for rec in to_classify if rec.chrom == chrom and rec.exonCount == 1]
+            hits = classification_ctx['exons_by_chr'][chrom].mono_exon_hits([(rec.txStart, rec.txEnd) for rec in mono])
+            mono_exon_hits.update(zip((rec.id for rec in mono), hits))
+
+    results = []
+    for rec, fp, c in zip(records, fps, cached):
+        if c is not None:
+            class_row, junc_rows = c
+            results.append((rec.id, fp, dict(class_row), junc_rows))
+            continue
+        junc_rows = RowBuffer()
+        isoform_hit = classify_isoform(rec, junc_rows, junction_table_by_chr.get(rec.chrom), ref_sweeps[rec.chrom], mono_exon_hits.get(rec.id))
+        add_junction_stats(isoform_hit, junc_rows)
+        results.append((rec.id, fp, isoform_hit.as_dict(), list(junc_rows)))
+    return bucket_index, results, timer.stop(isoforms=len(records),
+                                             chain_memo_hits=chain_memo.hits-memo_hits,
+                                             chain_memo_misses=chain_memo.misses-memo_misses)
+
+
+def add_junction_stats(isoform_hit, junc_rows):
+    """
+    Fill in the classification fields summarizing the isoform's junctions, as they are produced:
+    (1) "canonical": is "canonical" if all junctions are canonical, otherwise "non_canonical"
+    (2) "bite": is TRUE if any of the junction "bite_junction" field is TRUE
+    (3) nIndelsJunc, min_cov, min_cov_pos, min_samp_cov and sd (of total coverage)
+    :param junc_rows: junction rows (dicts, see FIELDS_JUNC) written for this isoform
+    """
+    covs = []
+    for r in junc_rows:
+        # only need to do assignment if:
+        # (1) the .canonical field is still "NA"
+        # (2) the junction is non-canonical
+        assert r['canonical'] in ('canonical', 'non_canonical')
+        if (isoform_hit.canonical == 'NA') or (r['canonical'] == 'non_canonical'):
+            isoform_hit.canonical = r['canonical']
+
+        if (isoform_hit.bite == 'NA') or (r['bite_junction'] == 'TRUE'):
+            isoform_hit.bite = r['bite_junction']
+
+        if r['indel_near_junct'] == 'TRUE':
+            if isoform_hit.nIndelsJunc == 'NA':
+                isoform_hit.nIndelsJunc = 0
+            isoform_hit.nIndelsJunc += 1
+
+        # min_cov: min( total_cov[j] for each junction j in this isoform )
+        # min_cov_pos: the junction [j] that attributed to argmin(total_cov[j])
+        # min_sample_cov: min( sample_cov[j] for each junction in this isoform )
+        # sd_cov: sd( total_cov[j] for each junction j in this isoform )
+        if r['sample_with_cov'] != 'NA':
+            sample_with_cov = int(r['sample_with_cov'])
+            if (isoform_hit.min_samp_cov == 'NA') or (isoform_hit.min_samp_cov > sample_with_cov):
+                isoform_hit.min_samp_cov = sample_with_cov
+
+        if r['total_coverage'] != 'NA':
+            total_cov = int(r['total_coverage'])
+            covs.append(total_cov)
+            if (isoform_hit.min_cov == 'NA') or (isoform_hit.min_cov > total_cov):
+                isoform_hit.min_cov = total_cov
+                isoform_hit.min_cov_pos = r['junction_number']
+
+    if len(covs) > 0:
+        isoform_hit.sd = pstdev(covs)
+
+
+def classify_isoform(rec, fout_junc, junction_table, ref_sweeps, mono_exon_hits):
+    """
+    Classify a single query isoform against the reference in classification_ctx
+    and write its junction records to <fout_junc>.
+    :param junction_table: unique junctions of the isoform's chromosome (see annotate_junctions), None if no known junctions on the chromosome
+    :param ref_sweeps: (single exon, multi exon) RefSweep of the isoform's chromosome, None where there are no references
+    :param mono_exon_hits: for single exon isoforms, see RefExonIndex.mono_exon_hits (None if no multi exon references on the chromosome)
+    :return: myQueryTranscripts object (novel gene names are assigned later by the caller)
+    """
+    ctx = classification_ctx
+    args = ctx['args']
+    genome_dict = ctx['genome_dict']
+    orfDict = ctx['orfDict']
+
+    # Find best reference hit
+    isoform_hit = transcriptsKnownSpliceSites(ref_sweeps[0], ref_sweeps[1], mono_exon_hits, ctx['chains_by_chr'], ctx['gene_index'], ctx['chain_memo'], rec, genome_dict, nPolyA=args.window)
+
+    if isoform_hit.str_class in ("anyKnownJunction", "anyKnownSpliceSite"):
+        # not FSM or ISM --> see if it is NIC, NNC, or fusion
+        isoform_hit = novelIsoformsKnownGenes(isoform_hit, rec, ctx['junctions_by_chr'], ctx['genes_by_junction'], ctx['gene_index'])
+    elif isoform_hit.str_class in ("", "geneOverlap"):
+        # possibly NNC, genic, genic intron, anti-sense, or intergenic
+        isoform_hit = associationOverlapping(isoform_hit, rec, ctx['junctions_by_chr'])
+
+    # write out junction information
+    write_junctionInfo(rec, junction_table, ctx['indelsJunc'], fout_junc)
+
+    # look at Cage Peak info (if available)
+    if ctx['cage_peak_obj'] is not None:
+        if rec.strand == '+':
+            within_cage, dist_cage = ctx['cage_peak_obj'].find(rec.chrom, rec.strand, rec.txStart)
+        else:
+            within_cage, dist_cage = ctx['cage_peak_obj'].find(rec.chrom, rec.strand, rec.txEnd)
+        isoform_hit.within_cage = within_cage
+        isoform_hit.dist_cage = dist_cage
+
+    # look at PolyA Peak info (if available)
+    if ctx['polya_peak_obj'] is not None:
+        if rec.strand == '+':
+            within_polya_site, dist_polya_site = ctx['polya_peak_obj'].find(rec.chrom, rec.strand, rec.txStart)
+        else:
+            within_polya_site, dist_polya_site = ctx['polya_peak_obj'].find(rec.chrom, rec.strand, rec.txEnd)
+        isoform_hit.within_polya_site = within_polya_site
+        isoform_hit.dist_polya_site = dist_polya_site
+
+    # polyA motif finding: look within 50 bp upstream of 3' end for the highest ranking polyA motif signal (user provided)
+    if ctx['polyA_motif_list'] is not None:
+        if rec.strand == '+':
+            polyA_motif, polyA_dist = find_polyA_motif(genome_dict.fetch(rec.chrom, rec.txEnd-50, rec.txEnd), ctx['polyA_motif_list'])
+        else:
+            polyA_motif, polyA_dist = find_polyA_motif(genome_dict.fetch_oriented(rec.chrom, rec.txStart, rec.txStart+50, '-'), ctx['polyA_motif_list'])
+        isoform_hit.polyA_motif = polyA_motif
+        isoform_hit.polyA_dist = polyA_dist
+
+    # Fill in ORF/coding info and NMD detection
+    if rec.id in orfDict:
+        isoform_hit.coding = "coding"
+        isoform_hit.ORFlen = orfDict[rec.id].orf_length
+        isoform_hit.CDS_start = orfDict[rec.id].cds_start  # 1-based start
+        isoform_hit.CDS_end = orfDict[rec.id].cds_end      # 1-based end
+
+        # transcript coord (0-based) --> genomic coord (0-based), -1 if outside the transcript
+        mapper = TranscriptCoordinateMapper(rec.exonStarts, rec.exonEnds, rec.strand)
+        g_start, g_end = mapper.to_genome([orfDict[rec.id].cds_start-1, orfDict[rec.id].cds_end-1])
+
+        orfDict[rec.id].cds_genomic_start = int(g_start) + 1 if g_start >= 0 else None  # make it 1-based
+        orfDict[rec.id].cds_genomic_end   = int(g_end) + 1 if g_end >= 0 else None      # make it 1-based
+
+        if orfDict[rec.id].cds_genomic_start is None or orfDict[rec.id].cds_genomic_end is None: # likely SAM CIGAR mapping issue coming from aligner
+            return isoform_hit # we have to skip the NMD, the CDS genomic start/end stay NA
+        isoform_hit.CDS_genomic_start = orfDict[rec.id].cds_genomic_start
+        isoform_hit.CDS_genomic_end = orfDict[rec.id].cds_genomic_end
+        # NMD detection
+        # if + strand, see if CDS stop is before the last junction
+        if rec.exonCount > 1:
+            if rec.strand == '+':
+                dist_to_last_junc = orfDict[rec.id].cds_genomic_end - rec.exonEnds[-2]
+            else: # - strand
+                dist_to_last_junc = rec.exonStarts[1] - orfDict[rec.id].cds_genomic_end
+            isoform_hit.is_NMD = "TRUE" if dist_to_last_junc < 0 else "FALSE"
+
+    return isoform_hit
+
+
+def isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_by_chr, chains_by_chr, exons_by_chr, junctions_by_chr, genes_by_junction, gene_index, genome_dict, indelsJunc, orfDict, prev_class_rows=None, new_class_rows=None):
+    """
+    Classify all query isoforms. With --chunks > 1 the isoforms are split into locus buckets
+    that are classified by a pool of forked worker processes sharing the reference and genome.
+    Rows are written back in the original (chromosome, start) order regardless of the number of workers.
+    Junction statistics are summarized per isoform as the junctions are produced and classification rows
+    are streamed to the _tmp file, so the full myQueryTranscripts objects are never all held in memory.
+    :param prev_class_rows: (--incremental) ClassRowStore of the fingerprints, classification and junction rows of the previous run
+    :param new_class_rows: (--incremental) ClassRowStore filled with the same information for this run
+    :return: isoforms_brief (dict of isoform id --> IsoformBrief),
+             gene_class_stats (dict of gene --> [number of isoforms, has FSM]),
+             class_chrom_offsets (dict of chrom --> position of its rows in the classification _tmp file),
+             unique_junctions (list of SpliceJunctions, first isoform having each junction in the junctions _tmp file, for the RTS check)
+    """
+    global classification_ctx
 
     ## read coverage files if provided
 
@@ -1414,19 +1874,40 @@ def isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_b
     else:
         polyA_motif_list = None
 
+    n_workers = max(1, args.chunks)
+    total = sum(len(records) for records in isoforms_by_chr.values())
+    # several buckets per worker so that large loci do not leave the other workers idle
+    buckets = make_classification_buckets(isoforms_by_chr, max(1, int(math.ceil(total / (n_workers * 4.)))))
+
+    classification_ctx = {'args': args,
+                          'buckets': buckets,
+                          'refs_1exon_by_chr': refs_1exon_by_chr,
+                          'refs_exons_by_chr': refs_exons_by_chr,
+                          'chains_by_chr': chains_by_chr,
+                          'exons_by_chr': exons_by_chr,
+                          'junctions_by_chr': junctions_by_chr,
+                          'genes_by_junction': genes_by_junction,
+                          'gene_index': gene_index,
+                          'genome_dict': genome_dict,
+                          'indelsJunc': indelsJunc,
+                          'orfDict': orfDict,
+                          'SJcovNames': SJcovNames,
+                          'SJcovInfo': SJcovInfo,
+                          'cage_peak_obj': cage_peak_obj,
+                          'polya_peak_obj': polya_peak_obj,
+                          'polyA_motif_list': polyA_motif_list,
+                          'accepted_canonical_sites': list(args.sites.split(",")),
+                          'phyloP_reader': None,
+                          'chain_memo': ChainMemo(args.chain_memo_size),
+                          'incremental': new_class_rows is not None,
+                          'class_cache': prev_class_rows if new_class_rows is not None else None}
 
     if args.phyloP_bed is not None:
         print("**** Reading PhyloP BED file.", file=sys.stdout)
-        phyloP_reader = LazyBEDPointReader(args.phyloP_bed)
-    else:
-        phyloP_reader = None
 
     # running classification
     print("**** Performing Classification of Isoforms....", file=sys.stdout)
 
-
-    accepted_canonical_sites = list(args.sites.split(","))
-
     handle_class = open(outputClassPath+"_tmp", "w")
     fout_class = DictWriter(handle_class, fieldnames=FIELDS_CLASS, delimiter='\t')
     fout_class.writeheader()
@@ -1436,103 +1917,102 @@ def isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_b
     fout_junc = DictWriter(handle_junc, fieldnames=fields_junc_cur, delimiter='\t')
     fout_junc.writeheader()
 
-    isoforms_info = {}
+    # only a brief summary of each isoform is kept in memory, the full records are streamed to the _tmp files
+    isoforms_brief = {}
+    gene_class_stats = defaultdict(lambda: [0, False])  # gene --> [number of isoforms, has a FSM isoform]
+    class_chrom_offsets = {}  # chrom --> position of its (contiguous) rows in the classification _tmp file
+    unique_junctions = {}  # (chrom, strand, start, end) --> SpliceJunctions of the first isoform with it
     novel_gene_index = 1
+    n_reused = 0
+    memo_hits, memo_misses = 0, 0
 
-    for chrom,records in isoforms_by_chr.items():
-        for rec in records:
-            # Find best reference hit
-            isoform_hit = transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends_by_gene, rec, genome_dict, nPolyA=args.window)
-
-            if isoform_hit.str_class in ("anyKnownJunction", "anyKnownSpliceSite"):
-                # not FSM or ISM --> see if it is NIC, NNC, or fusion
-                isoform_hit = novelIsoformsKnownGenes(isoform_hit, rec, junctions_by_chr, junctions_by_gene, start_ends_by_gene)
-            elif isoform_hit.str_class in ("", "geneOverlap"):
-                # possibly NNC, genic, genic intron, anti-sense, or intergenic
-                isoform_hit = associationOverlapping(isoform_hit, rec, junctions_by_chr)
-
-            # write out junction information
-            write_junctionInfo(rec, junctions_by_chr, accepted_canonical_sites, indelsJunc, genome_dict, fout_junc, covInf=SJcovInfo, covNames=SJcovNames, phyloP_reader=phyloP_reader)
-
-            if isoform_hit.str_class in ("intergenic", "genic_intron"):
-                # Liz: I don't find it necessary to cluster these novel genes. They should already be always non-overlapping.
-                if args.novel_gene_prefix is not None:  # used by splits to not have redundant novelGene IDs
-                    isoform_hit.genes = ['novelGene_' + str(args.novel_gene_prefix) + '_' + str(novel_gene_index)]
-                else:
-                    isoform_hit.genes = ['novelGene_' + str(novel_gene_index)]
-                isoform_hit.transcripts = ['novel']
-                novel_gene_index += 1
-
-            # look at Cage Peak info (if available)
-            if cage_peak_obj is not None:
-                if rec.strand == '+':
-                    within_cage, dist_cage = cage_peak_obj.find(rec.chrom, rec.strand, rec.txStart)
-                else:
-                    within_cage, dist_cage = cage_peak_obj.find(rec.chrom, rec.strand, rec.txEnd)
-                isoform_hit.within_cage = within_cage
-                isoform_hit.dist_cage = dist_cage
-
-            # look at PolyA Peak info (if available)
-            if polya_peak_obj is not None:
-                if rec.strand == '+':
-                    within_polya_site, dist_polya_site = polya_peak_obj.find(rec.chrom, rec.strand, rec.txStart)
-                else:
-                    within_polya_site, dist_polya_site = polya_peak_obj.find(rec.chrom, rec.strand, rec.txEnd)
-                isoform_hit.within_polya_site = within_polya_site
-                isoform_hit.dist_polya_site = dist_polya_site
-
-            # polyA motif finding: look within 50 bp upstream of 3' end for the highest ranking polyA motif signal (user provided)
-            if polyA_motif_list is not None:
-                if rec.strand == '+':
-                    polyA_motif, polyA_dist = find_polyA_motif(str(genome_dict[rec.chrom][rec.txEnd-50:rec.txEnd].seq), polyA_motif_list)
-                else:
-                    polyA_motif, polyA_dist = find_polyA_motif(str(genome_dict[rec.chrom][rec.txStart:rec.txStart+50].reverse_complement().seq), polyA_motif_list)
-                isoform_hit.polyA_motif = polyA_motif
-                isoform_hit.polyA_dist = polyA_dist
-
-            # Fill in ORF/coding info and NMD detection
-            if rec.id in orfDict:
-                isoform_hit.coding = "coding"
-                isoform_hit.ORFlen = orfDict[rec.id].orf_length
-                isoform_hit.CDS_start = orfDict[rec.id].cds_start  # 1-based start
-                isoform_hit.CDS_end = orfDict[rec.id].cds_end      # 1-based end
-
-                m = {} # transcript coord (0-based) --> genomic coord (0-based)
-                if rec.strand == '+':
-                    i = 0
-                    for exon in rec.exons:
-                        for c in range(exon.start, exon.end):
-                            m[i] = c
-                            i += 1
-                else: # - strand
-                    i = 0
-                    for exon in rec.exons:
-                        for c in range(exon.start, exon.end):
-                            m[rec.length-i-1] = c
-                            i += 1
-
-                orfDict[rec.id].cds_genomic_start = m[orfDict[rec.id].cds_start-1] + 1  # make it 1-based
-                orfDict[rec.id].cds_genomic_end   = m[orfDict[rec.id].cds_end-1] + 1    # make it 1-based
-
-                isoform_hit.CDS_genomic_start = orfDict[rec.id].cds_genomic_start
-                isoform_hit.CDS_genomic_end = orfDict[rec.id].cds_genomic_end
-                if orfDict[rec.id].cds_genomic_start is None: # likely SAM CIGAR mapping issue coming from aligner
-                    continue # we have to skip the NMD
-                # NMD detection
-                # if + strand, see if CDS stop is before the last junction
-                if len(rec.junctions) > 0:
-                    if rec.strand == '+':
-                        dist_to_last_junc = orfDict[rec.id].cds_genomic_end - rec.junctions[-1][0]
-                    else: # - strand
-                        dist_to_last_junc = rec.junctions[0][1] - orfDict[rec.id].cds_genomic_end
-                    isoform_hit.is_NMD = "TRUE" if dist_to_last_junc < 0 else "FALSE"
-
-            isoforms_info[rec.id] = isoform_hit
-            fout_class.writerow(isoform_hit.as_dict())
+    if n_workers == 1 or len(buckets) <= 1:
+        init_classification_worker()
+        bucket_results = map(classify_bucket, range(len(buckets)))
+        pool = None
+    else:
+        print("Classifying {0} isoforms in {1} buckets using {2} processes.".format(total, len(buckets), n_workers), file=sys.stdout)
+        pool = multiprocessing.get_context('fork').Pool(n_workers, initializer=init_classification_worker)
+        # largest buckets first for better load balancing, results are re-ordered below
+        by_size = sorted(range(len(buckets)), key=lambda i: len(buckets[i]), reverse=True)
+        bucket_results = pool.imap_unordered(classify_bucket, by_size)
+
+    pending = {}
+    next_bucket = 0
+    for bucket_index, results, bucket_stats in bucket_results:
+        run_profile.add_chunk('classification', bucket_index, bucket_stats)
+        memo_hits += bucket_stats['chain_memo_hits']
+        memo_misses += bucket_stats['chain_memo_misses']
+        pending[bucket_index] = results
+        # write out finished buckets in the original order
+        while next_bucket in pending:
+            for iso, fp, class_row, junc_rows in pending.pop(next_bucket):
+                for row in junc_rows:
+                    fout_junc.writerow(row)
+                    sj_key = (row['chrom'], row['strand'], row['genomic_start_coord'], row['genomic_end_coord'])
+                    if sj_key not in unique_junctions:
+                        unique_junctions[sj_key] = SpliceJunctions(iso,
+                                                                   sjn=row['junction_number'],
+                                                                   chromo=row['chrom'],
+                                                                   strand=row['strand'],
+                                                                   strpos=row['genomic_start_coord'],
+                                                                   endpos=row['genomic_end_coord'],
+                                                                   transpos=None,
+                                                                   category=row['junction_category'],
+                                                                   startCat=row['start_site_category'],
+                                                                   endCat=row['end_site_category'],
+                                                                   type=row['canonical'])
+                if new_class_rows is not None:
+                    # novel gene names depend on the other isoforms, keep the row as it was before naming
+                    new_class_rows.add(iso, fp, class_row, junc_rows)
+                    if prev_class_rows is not None and prev_class_rows.fingerprint(iso) == fp:
+                        n_reused += 1
+                if class_row['structural_category'] in ("intergenic", "genic_intron"):
+                    # Liz: I don't find it necessary to cluster these novel genes. They should already be always non-overlapping.
+                    class_row['associated_gene'] = 'novelGene_' + str(novel_gene_index)
+                    class_row['associated_transcript'] = 'novel'
+                    novel_gene_index += 1
+                gene = class_row['associated_gene']  # if multi-gene, "geneA_geneB_geneC..."
+                gene_class_stats[gene][0] += 1
+                gene_class_stats[gene][1] |= (class_row['structural_category'] == "full-splice_match")
+                isoforms_brief[iso] = IsoformBrief(gene, class_row['CDS_genomic_start'], class_row['CDS_genomic_end'])
+                if class_row['chrom'] not in class_chrom_offsets:
+                    class_chrom_offsets[class_row['chrom']] = handle_class.tell()
+                fout_class.writerow(class_row)
+            next_bucket += 1
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    classification_ctx = {}
+
+    if memo_hits + memo_misses > 0:
+        print("Intron chain memo: {0} hits, {1} misses ({2:.1f}% hit rate).".format(memo_hits, memo_misses, 100.*memo_hits/(memo_hits+memo_misses)), file=sys.stdout)
+
+    if new_class_rows is not None:
+        print("Incremental run: re-used the classification of {0} of {1} isoforms.".format(n_reused, total), file=sys.stdout)
 
     handle_class.close()
     handle_junc.close()
-    return isoforms_info
+    return isoforms_brief, dict(gene_class_stats), class_chrom_offsets, list(unique_junctions.values())
+
+
+def iter_classification_tmp_by_chrom(class_tmp_filename, class_chrom_offsets):
+    """
+    Read back the classification _tmp rows one chromosome at a time, in (chrom, isoform) order.
+    :param class_chrom_offsets: dict of chrom --> file position of its rows (see isoformClassification)
+    """
+    with open(class_tmp_filename) as h:
+        for chrom in sorted(class_chrom_offsets):
+            h.seek(class_chrom_offsets[chrom])
+            rows = []
+            for r in DictReader(h, fieldnames=FIELDS_CLASS, delimiter='\t'):
+                if r['chrom'] != chrom:
+                    break
+                rows.append(r)
+            rows.sort(key=lambda r: r['isoform'])
+            for r in rows:
+                yield r
 
 
 def pstdev(data):
@@ -1646,210 +2126,206 @@ def run(args):
     start3 = timeit.default_timer()
 
     print("**** Parsing provided files....", file=sys.stdout)
-    print("Reading genome fasta {0}....".format(args.genome), file=sys.stdout)
-    # NOTE: can't use LazyFastaReader because inefficient. Bring the whole genome in!
-    genome_dict = dict((r.name, r) for r in SeqIO.parse(open(args.genome), 'fasta'))
+    print("Opening genome fasta {0}....".format(args.genome), file=sys.stdout)
+    # NOTE: the genome is memory-mapped through a .fai index, not read into memory.
+    #       IndexedGenome still looks like a dict of chrom --> SeqRecord for err_correct.
+    with run_profile.stage('genome_load'):
+        genome_dict = IndexedGenome(args.genome, fallback_index_dir=args.dir)
+
+    ## incremental run: state (fingerprints and rows) of the previous run in the same output directory
+    prev_state, new_state = None, None
+    if args.incremental:
+        state_file = get_incremental_state_filename(args)
+        prev_state = load_state(state_file)
+        if prev_state is None:
+            print("No usable incremental state {0}. Processing all isoforms.".format(state_file), file=sys.stdout)
+        new_state = {}
 
     ## correction of sequences and ORF prediction (if gtf provided instead of fasta file, correction of sequences will be skipped)
-    orfDict = correctionPlusORFpred(args, genome_dict)
+    orfDict = correctionPlusORFpred(args, genome_dict, prev_state, new_state)
 
     ## parse reference id (GTF) to dicts
-    refs_1exon_by_chr, refs_exons_by_chr, junctions_by_chr, junctions_by_gene, start_ends_by_gene = reference_parser(args, list(genome_dict.keys()))
+    with run_profile.stage('reference_parser'):
+        refs_1exon_by_chr, refs_exons_by_chr, chains_by_chr, exons_by_chr, junctions_by_chr, genes_by_junction, gene_index = reference_parser(args, list(genome_dict.keys()))
 
     ## parse query isoforms
-    isoforms_by_chr = isoforms_parser(args)
+    with run_profile.stage('isoforms_parser'):
+        isoforms_by_chr = isoforms_parser(args)
 
     ## Run indel computation if sam exists
     # indelsJunc: dict of pbid --> list of junctions near indel (in Interval format)
     # indelsTotal: dict of pbid --> total indels count
     if os.path.exists(corrSAM):
-        (indelsJunc, indelsTotal) = calc_indels_from_sam(corrSAM)
+        with run_profile.stage('calc_indels_from_sam', chunks=max(1, args.chunks)):
+            (indelsJunc, indelsTotal) = calc_indels_from_sam(corrSAM, n_workers=args.chunks)
     else:
         indelsJunc = None
         indelsTotal = None
 
+    # incremental run: the previous classification rows are only valid for the same global inputs
+    # the rows are kept in a file next to the state (see ClassRowStore), only their positions are held in memory
+    prev_class_rows, new_class_rows = None, None
+    if new_state is not None:
+        new_state['class_key'] = classification_key(args)
+        new_class_rows = ClassRowStore.create(get_incremental_rows_prefix(args))
+        if prev_state is not None and prev_state.get('class_key') == new_state['class_key']:
+            prev_class_rows = load_class_rows(args.dir, prev_state)
+
     # isoform classification + intra-priming + id and junction characterization
-    isoforms_info = isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_by_chr, junctions_by_chr, junctions_by_gene, start_ends_by_gene, genome_dict, indelsJunc, orfDict)
+    with run_profile.stage('classification', chunks=max(1, args.chunks)):
+        isoforms_brief, gene_class_stats, class_chrom_offsets, unique_junctions = isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_by_chr, chains_by_chr, exons_by_chr, junctions_by_chr, genes_by_junction, gene_index, genome_dict, indelsJunc, orfDict,
+                                                                                      prev_class_rows=prev_class_rows,
+                                                                                      new_class_rows=new_class_rows)
+    if new_class_rows is not None:
+        save_class_rows(new_state, new_class_rows)
+    prev_state, prev_class_rows = None, None
 
-    print("Number of classified isoforms: {0}".format(len(isoforms_info)), file=sys.stdout)
+    print("Number of classified isoforms: {0}".format(len(isoforms_brief)), file=sys.stdout)
 
-    write_collapsed_GFF_with_CDS(isoforms_info, corrGTF, corrGTF+'.cds.gff')
-    os.rename(corrGTF+'.cds.gff', corrGTF)
+    with run_profile.stage('writing_gff'):
+        write_collapsed_GFF_with_CDS(isoforms_brief, corrGTF, corrGTF+'.cds.gff')
+        os.rename(corrGTF+'.cds.gff', corrGTF)
 
     ## RT-switching computation
     print("**** RT-switching computation....", file=sys.stderr)
 
-    # RTS_info: dict of (pbid) -> list of RT junction. if RTS_info[pbid] == [], means all junctions are non-RT.
-    RTS_info = rts([outputJuncPath+"_tmp", args.genome, "-a"], genome_dict)
-    for pbid in isoforms_info:
-        if pbid in RTS_info and len(RTS_info[pbid]) > 0:
-            isoforms_info[pbid].RT_switching = "TRUE"
+    # RTS_info: dict of (pbid) -> list of RT junction. pbids without RT junction are not in it.
+    # The unique junctions come straight from the classification, they are checked in parallel by chromosome.
+    with run_profile.stage('RTS', chunks=max(1, args.chunks)):
+        rts_dir = os.path.join(os.path.dirname(os.path.abspath(outputJuncPath)), "RTS")
+        if not os.path.exists(rts_dir):
+            os.makedirs(rts_dir)
+        rts_cache = None
+        if args.rts_cache_dir is not None:
+            rts_cache = open_rts_cache(args.rts_cache_dir, args.genome, min_match=8, allow_mismatch=True, wiggle_count=1)
+        RTS_info = rts_junctions(unique_junctions, genome_dict, allow_mismatch=True, n_workers=args.chunks,
+                                 output_filename=os.path.join(rts_dir, "sj.rts.results.tsv"), cache=rts_cache)
+    unique_junctions = None
+
+    with run_profile.stage('FL_expression_merge'):
+        fields_class_cur = FIELDS_CLASS
+        ## FL count file
+        fl_count_dict = None
+        if args.fl_count:
+            if not os.path.exists(args.fl_count):
+                print("FL count file {0} does not exist!".format(args.fl_count), file=sys.stderr)
+                sys.exit(-1)
+            print("**** Reading Full-length read abundance files...", file=sys.stderr)
+            fl_samples, fl_count_dict = FLcount_parser(args.fl_count)
+            for pbid in fl_count_dict:
+                if pbid not in isoforms_brief:
+                    print("WARNING: {0} found in FL count file but not in input fasta.".format(pbid), file=sys.stderr)
+            if len(fl_samples) == 1: # single sample from PacBio
+                print("Single-sample PacBio FL count format detected.", file=sys.stderr)
+            else: # multi-sample
+                print("Multi-sample PacBio FL count format detected.", file=sys.stderr)
+                fields_class_cur = FIELDS_CLASS + ["FL."+s for s in fl_samples]
         else:
-            isoforms_info[pbid].RT_switching = "FALSE"
-
-
-    ## FSM classification
-    geneFSM_dict = defaultdict(lambda: [])
-    for iso in isoforms_info:
-        gene = isoforms_info[iso].geneName()  # if multi-gene, returns "geneA_geneB_geneC..."
-        geneFSM_dict[gene].append(isoforms_info[iso].str_class)
-
-    fields_class_cur = FIELDS_CLASS
-    ## FL count file
-    if args.fl_count:
-        if not os.path.exists(args.fl_count):
-            print("FL count file {0} does not exist!".format(args.fl_count), file=sys.stderr)
-            sys.exit(-1)
-        print("**** Reading Full-length read abundance files...", file=sys.stderr)
-        fl_samples, fl_count_dict = FLcount_parser(args.fl_count)
-        for pbid in fl_count_dict:
-            if pbid not in isoforms_info:
-                print("WARNING: {0} found in FL count file but not in input fasta.".format(pbid), file=sys.stderr)
-        if len(fl_samples) == 1: # single sample from PacBio
-            print("Single-sample PacBio FL count format detected.", file=sys.stderr)
-            for iso in isoforms_info:
-                if iso in fl_count_dict:
-                    isoforms_info[iso].FL = fl_count_dict[iso]
+            print("Full-length read abundance files not provided.", file=sys.stderr)
+
+
+        ## Isoform expression information
+        if args.expression:
+            print("**** Reading Isoform Expression Information.", file=sys.stderr)
+            exp_dict = expression_parser(args.expression)
+            gene_exp_dict = {}
+            for iso in isoforms_brief:
+                if iso not in exp_dict:
+                    exp_dict[iso] = 0
+                    print("WARNING: isoform {0} not found in expression matrix. Assigning TPM of 0.".format(iso), file=sys.stderr)
+                gene = isoforms_brief[iso].gene
+                if gene not in gene_exp_dict:
+                    gene_exp_dict[gene] = exp_dict[iso]
                 else:
-                    print("WARNING: {0} not found in FL count file. Assign count as 0.".format(iso), file=sys.stderr)
-                    isoforms_info[iso].FL = 0
-        else: # multi-sample
-            print("Multi-sample PacBio FL count format detected.", file=sys.stderr)
-            fields_class_cur = FIELDS_CLASS + ["FL."+s for s in fl_samples]
-            for iso in isoforms_info:
-                if iso in fl_count_dict:
-                    isoforms_info[iso].FL_dict = fl_count_dict[iso]
-                else:
-                    print("WARNING: {0} not found in FL count file. Assign count as 0.".format(iso), file=sys.stderr)
-                    isoforms_info[iso].FL_dict = defaultdict(lambda: 0)
-    else:
-        print("Full-length read abundance files not provided.", file=sys.stderr)
-
-
-    ## Isoform expression information
-    if args.expression:
-        print("**** Reading Isoform Expression Information.", file=sys.stderr)
-        exp_dict = expression_parser(args.expression)
-        gene_exp_dict = {}
-        for iso in isoforms_info:
-            if iso not in exp_dict:
-                exp_dict[iso] = 0
-                print("WARNING: isoform {0} not found in expression matrix. Assigning TPM of 0.".format(iso), file=sys.stderr)
-            gene = isoforms_info[iso].geneName()
-            if gene not in gene_exp_dict:
-                gene_exp_dict[gene] = exp_dict[iso]
-            else:
-                gene_exp_dict[gene] = gene_exp_dict[gene]+exp_dict[iso]
-    else:
-        exp_dict = None
-        gene_exp_dict = None
-        print("Isoforms expression files not provided.", file=sys.stderr)
-
-
-    ## Adding indel, FSM class and expression information
-    for iso in isoforms_info:
-        gene = isoforms_info[iso].geneName()
-        if exp_dict is not None and gene_exp_dict is not None:
-            isoforms_info[iso].geneExp = gene_exp_dict[gene]
-            isoforms_info[iso].isoExp  = exp_dict[iso]
-        if len(geneFSM_dict[gene])==1:
-            isoforms_info[iso].FSM_class = "A"
-        elif "full-splice_match" in geneFSM_dict[gene]:
-            isoforms_info[iso].FSM_class = "C"
+                    gene_exp_dict[gene] = gene_exp_dict[gene]+exp_dict[iso]
         else:
-            isoforms_info[iso].FSM_class = "B"
-
-    if indelsTotal is not None:
-        for iso in isoforms_info:
-            if iso in indelsTotal:
-                isoforms_info[iso].nIndels = indelsTotal[iso]
-            else:
-                isoforms_info[iso].nIndels = 0
+            exp_dict = None
+            gene_exp_dict = None
+            print("Isoforms expression files not provided.", file=sys.stderr)
 
 
-    ## Read junction files and create attributes per id
-    # Read the junction information to fill in several remaining unfilled fields in classification
-    # (1) "canonical": is "canonical" if all junctions are canonical, otherwise "non_canonical"
-    # (2) "bite": is TRUE if any of the junction "bite_junction" field is TRUE
-
-    reader = DictReader(open(outputJuncPath+"_tmp"), delimiter='\t')
-    fields_junc_cur = reader.fieldnames
-
-    sj_covs_by_isoform = defaultdict(lambda: [])  # pbid --> list of total_cov for each junction so we can calculate SD later
-    for r in reader:
-        # only need to do assignment if:
-        # (1) the .canonical field is still "NA"
-        # (2) the junction is non-canonical
-        assert r['canonical'] in ('canonical', 'non_canonical')
-        if (isoforms_info[r['isoform']].canonical == 'NA') or \
-            (r['canonical'] == 'non_canonical'):
-            isoforms_info[r['isoform']].canonical = r['canonical']
-
-        if (isoforms_info[r['isoform']].bite == 'NA') or (r['bite_junction'] == 'TRUE'):
-            isoforms_info[r['isoform']].bite = r['bite_junction']
-
-        if r['indel_near_junct'] == 'TRUE':
-            if isoforms_info[r['isoform']].nIndelsJunc == 'NA':
-                isoforms_info[r['isoform']].nIndelsJunc = 0
-            isoforms_info[r['isoform']].nIndelsJunc += 1
-
-        # min_cov: min( total_cov[j] for each junction j in this isoform )
-        # min_cov_pos: the junction [j] that attributed to argmin(total_cov[j])
-        # min_sample_cov: min( sample_cov[j] for each junction in this isoform )
-        # sd_cov: sd( total_cov[j] for each junction j in this isoform )
-        if r['sample_with_cov'] != 'NA':
-            sample_with_cov = int(r['sample_with_cov'])
-            if (isoforms_info[r['isoform']].min_samp_cov == 'NA') or (isoforms_info[r['isoform']].min_samp_cov > sample_with_cov):
-                isoforms_info[r['isoform']].min_samp_cov = sample_with_cov
+    #### Printing output file:
+    # The junction statistics (canonical, bite, min_cov, sd...) were already summarized during classification,
+    # now stream the classification rows back (one chromosome at a time) and add the gene-level,
+    # RTS, FL count, expression and indel information.
+    print("**** Writing output files....", file=sys.stderr)
 
-        if r['total_coverage'] != 'NA':
-            total_cov = int(r['total_coverage'])
-            sj_covs_by_isoform[r['isoform']].append(total_cov)
-            if (isoforms_info[r['isoform']].min_cov == 'NA') or (isoforms_info[r['isoform']].min_cov > total_cov):
-                isoforms_info[r['isoform']].min_cov = total_cov
-                isoforms_info[r['isoform']].min_cov_pos = r['junction_number']
+    with run_profile.stage('writing'):
+        with open(outputClassPath, 'w') as h:
+            fout_class = DictWriter(h, fieldnames=fields_class_cur, delimiter='\t')
+            fout_class.writeheader()
+            for r in iter_classification_tmp_by_chrom(outputClassPath+"_tmp", class_chrom_offsets):
+                iso = r['isoform']
+                gene = isoforms_brief[iso].gene
 
+                if iso in RTS_info:
+                    r['RTS_stage'] = "TRUE"
+                else:
+                    r['RTS_stage'] = "FALSE"
+
+                if fl_count_dict is not None:
+                    if iso not in fl_count_dict:
+                        print("WARNING: {0} not found in FL count file. Assign count as 0.".format(iso), file=sys.stderr)
+                    if len(fl_samples) == 1:
+                        r['FL'] = fl_count_dict.get(iso, 0)
+                    elif iso in fl_count_dict:
+                        for sample,count in fl_count_dict[iso].items():
+                            r["FL."+sample] = count
+
+                ## Adding indel, FSM class and expression information
+                if exp_dict is not None and gene_exp_dict is not None:
+                    r['gene_exp'] = gene_exp_dict[gene]
+                    r['iso_exp'] = exp_dict[iso]
+                    r['ratio_exp'] = "NA" if gene_exp_dict[gene] == 0 else float(exp_dict[iso])/float(gene_exp_dict[gene])
+                n_isoforms, has_FSM = gene_class_stats[gene]
+                if n_isoforms == 1:
+                    r['FSM_class'] = "A"
+                elif has_FSM:
+                    r['FSM_class'] = "C"
+                else:
+                    r['FSM_class'] = "B"
 
-    for pbid, covs in sj_covs_by_isoform.items():
-        isoforms_info[pbid].sd = pstdev(covs)
+                if indelsTotal is not None:
+                    r['n_indels'] = indelsTotal[iso] if iso in indelsTotal else 0
 
-    #### Printing output file:
-    print("**** Writing output files....", file=sys.stderr)
+                fout_class.writerow(r)
 
-    # sort isoform keys
-    iso_keys = list(isoforms_info.keys())
-    iso_keys.sort(key=lambda x: (isoforms_info[x].chrom,isoforms_info[x].id))
-    with open(outputClassPath, 'w') as h:
-        fout_class = DictWriter(h, fieldnames=fields_class_cur, delimiter='\t')
-        fout_class.writeheader()
-        for iso_key in iso_keys:
-            fout_class.writerow(isoforms_info[iso_key].as_dict())
-
-    # Now that RTS info is obtained, we can write the final junctions.txt
-    with open(outputJuncPath, 'w') as h:
-        fout_junc = DictWriter(h, fieldnames=fields_junc_cur, delimiter='\t')
-        fout_junc.writeheader()
-        for r in DictReader(open(outputJuncPath+"_tmp"), delimiter='\t'):
-            if r['isoform'] in RTS_info:
-                if r['junction_number'] in RTS_info[r['isoform']]:
+        # Now that RTS info is obtained, we can write the final junctions.txt
+        with open(outputJuncPath, 'w') as h:
+            reader = DictReader(open(outputJuncPath+"_tmp"), delimiter='\t')
+            fout_junc = DictWriter(h, fieldnames=reader.fieldnames, delimiter='\t')
+            fout_junc.writeheader()
+            for r in reader:
+                if r['junction_number'] in RTS_info.get(r['isoform'], ()):
                     r['RTS_junction'] = 'TRUE'
                 else:
                     r['RTS_junction'] = 'FALSE'
-            fout_junc.writerow(r)
+                fout_junc.writerow(r)
 
     ## Generating report
     if not args.skip_report:
         print("**** Generating SQANTI2 report....", file=sys.stderr)
         cmd = RSCRIPTPATH + " {d}/{f} {c} {j} {p}".format(d=utilitiesPath, f=RSCRIPT_REPORT, c=outputClassPath, j=outputJuncPath, p=args.doc)
-        if subprocess.check_call(cmd, shell=True)!=0:
-            print("ERROR running command: {0}".format(cmd), file=sys.stderr)
-            sys.exit(-1)
+        with run_profile.stage('R_report'):
+            if subprocess.check_call(cmd, shell=True)!=0:
+                print("ERROR running command: {0}".format(cmd), file=sys.stderr)
+                sys.exit(-1)
     stop3 = timeit.default_timer()
 
     print("Removing temporary files....", file=sys.stderr)
     os.remove(outputClassPath+"_tmp")
     os.remove(outputJuncPath+"_tmp")
 
+    if new_state is not None:
+        # only written once all the outputs are, so an interrupted run is simply re-done next time
+        write_state(get_incremental_state_filename(args), new_state)
+        remove_stale_class_rows(new_class_rows, get_incremental_rows_prefix(args))
+        print("Incremental state written to {0}.".format(get_incremental_state_filename(args)), file=sys.stderr)
+
+    profile_prefix = os.path.join(args.dir, args.output)
+    run_profile.write(profile_prefix+".profile.json", profile_prefix+".profile.tsv")
+    print("Run profile (time and peak memory per stage) written to {0}.profile.json and {0}.profile.tsv:\n{1}".format(profile_prefix, run_profile.summary()), file=sys.stderr)
+
     print("SQANTI2 complete in {0} sec.".format(stop3 - start3), file=sys.stderr)
 
 
@@ -1960,110 +2436,6 @@ class PolyAPeak:
             return True, min_dist
 
 
-def split_input_run(args):
-    if os.path.exists(SPLIT_ROOT_DIR):
-        print("WARNING: {0} directory already exists! Abort!".format(SPLIT_ROOT_DIR), file=sys.stderr)
-        sys.exit(-1)
-    else:
-        os.makedirs(SPLIT_ROOT_DIR)
-
-    if args.gtf:
-        recs = [r for r in collapseGFFReader(args.isoforms)]
-        n = len(recs)
-        chunk_size = n//args.chunks + (n%args.chunks >0)
-        split_outs = []
-        #pdb.set_trace()
-        for i in range(args.chunks):
-            if i*chunk_size >= n:
-                break
-            d = os.path.join(SPLIT_ROOT_DIR, str(i))
-            os.makedirs(d)
-            f = open(os.path.join(d, os.path.basename(args.isoforms)+'.split'+str(i)), 'w')
-            for j in range(i*chunk_size, min((i+1)*chunk_size, n)):
-                write_collapseGFF_format(f, recs[j])
-            f.close()
-            split_outs.append((os.path.abspath(d), f.name))
-    else:
-        recs = [r for r in SeqIO.parse(open(args.isoforms),'fasta')]
-        n = len(recs)
-        chunk_size = n//args.chunks + (n%args.chunks >0)
-        split_outs = []
-        for i in range(args.chunks):
-            if i*chunk_size >= n:
-                break
-            d = os.path.join(SPLIT_ROOT_DIR, str(i))
-            os.makedirs(d)
-            f = open(os.path.join(d, os.path.basename(args.isoforms)+'.split'+str(i)), 'w')
-            for j in range(i*chunk_size, min((i+1)*chunk_size, n)):
-                SeqIO.write(recs[j], f, 'fasta')
-            f.close()
-            split_outs.append((os.path.abspath(d), f.name))
-
-    pools = []
-    for i,(d,x) in enumerate(split_outs):
-        print("launching worker on on {0}....".format(x))
-        args2 = copy.deepcopy(args)
-        args2.isoforms = x
-        args2.novel_gene_prefix = str(i)
-        args2.dir = d
-        args2.skip_report = True
-        p = Process(target=run, args=(args2,))
-        p.start()
-        pools.append(p)
-
-    for p in pools:
-        p.join()
-    return [d for (d,x) in split_outs]
-
-def combine_split_runs(args, split_dirs):
-    """
-    Combine .faa, .fasta, .gtf, .classification.txt, .junctions.txt
-    Then write out the PDF report
-    """
-    corrGTF, corrSAM, corrFASTA, corrORF = get_corr_filenames(args)
-    outputClassPath, outputJuncPath = get_class_junc_filenames(args)
-
-    if not args.skipORF:
-        f_faa = open(corrORF, 'w')
-    f_fasta = open(corrFASTA, 'w')
-    f_gtf = open(corrGTF, 'w')
-    f_class = open(outputClassPath, 'w')
-    f_junc = open(outputJuncPath, 'w')
-
-    for i,split_d in enumerate(split_dirs):
-        _gtf, _sam, _fasta, _orf = get_corr_filenames(args, split_d)
-        _class, _junc = get_class_junc_filenames(args, split_d)
-        if not args.skipORF:
-            with open(_orf) as h: f_faa.write(h.read())
-        with open(_gtf) as h: f_gtf.write(h.read())
-        with open(_fasta) as h: f_fasta.write(h.read())
-        with open(_class) as h:
-            if i == 0:
-                f_class.write(h.readline())
-            else:
-                h.readline()
-            f_class.write(h.read())
-        with open(_junc) as h:
-            if i == 0:
-                f_junc.write(h.readline())
-            else:
-                h.readline()
-            f_junc.write(h.read())
-
-    f_fasta.close()
-    f_gtf.close()
-    f_class.close()
-    f_junc.close()
-    if not args.skipORF:
-        f_faa.close()
-
-    if not args.skip_report:
-        print("**** Generating SQANTI2 report....", file=sys.stderr)
-        cmd = RSCRIPTPATH + " {d}/{f} {c} {j} {p}".format(d=utilitiesPath, f=RSCRIPT_REPORT, c=outputClassPath, j=outputJuncPath, p=args.doc)
-        if subprocess.check_call(cmd, shell=True)!=0:
-            print("ERROR running command: {0}".format(cmd), file=sys.stderr)
-            sys.exit(-1)
-
 def main():
     global utilitiesPath
 
@@ -2073,6 +2445,9 @@ def main():
     parser.add_argument('annotation', help='\t\tReference annotation file (GTF format)')
     parser.add_argument('genome', help='\t\tReference genome (Fasta format)')
     parser.add_argument("--min_ref_len", type=int, default=200, help="\t\tMinimum reference transcript length (default: 200 bp)")
+    parser.add_argument("--ref_cache_dir", help="\t\tDirectory for the parsed reference annotation cache (default: same directory as the annotation GTF)")
+    parser.add_argument("--no_ref_cache", default=False, action="store_true", help="\t\tDo not read or write the parsed reference annotation cache")
+    parser.add_argument("--rts_cache_dir", help="\t\tDirectory of the RT switching junction cache shared by runs against the same genome, ex: all samples of a cohort (default: no cache)")
     parser.add_argument("--force_id_ignore", action="store_true", default=False, help=argparse.SUPPRESS)
     parser.add_argument("--aligner_choice", choices=['minimap2', 'deSALT', 'gmap'], default='minimap2')
     parser.add_argument('--cage_peak', help='\t\tFANTOM5 Cage Peak (BED format, optional)')
@@ -2085,7 +2460,8 @@ def main():
     parser.add_argument('-e','--expression', help='\t\tExpression matrix (supported: Kallisto tsv)', required=False)
     parser.add_argument('-x','--gmap_index', help='\t\tPath and prefix of the reference index created by gmap_build. Mandatory if using GMAP unless -g option is specified.')
     parser.add_argument('-t', '--cpus', default=10, type=int, help='\t\tNumber of threads used during alignment by aligners. (default: 10)')
-    parser.add_argument('-n', '--chunks', default=1, type=int, help='\t\tNumber of chunks to split SQANTI2 analysis in for speed up (default: 1).')
+    parser.add_argument('-n', '--chunks', default=1, type=int, help='\t\tNumber of processes used to annotate indels, classify isoforms and check junctions for RT switching in parallel (default: 1).')
+    parser.add_argument('--chain_memo_size', default=100000, type=int, help='\t\tNumber of intron chains whose reference comparisons are remembered by each classification process, 0 to disable (default: 100000).')
     #parser.add_argument('-z', '--sense', help='\t\tOption that helps aligners know that the exons in you cDNA sequences are in the correct sense. Applicable just when you have a high quality set of cDNA sequences', required=False, action='store_true')
     parser.add_argument('-o','--output', help='\t\tPrefix for output files.', required=False)
     parser.add_argument('-d','--dir', help='\t\tDirectory for output files. Default: Directory where the script was run.', required=False)
@@ -2096,6 +2472,7 @@ def main():
     parser.add_argument('-fl', '--fl_count', help='\t\tFull-length PacBio abundance file', required=False)
     parser.add_argument("-v", "--version", help="Display program version number.", action='version', version='SQANTI2 '+str(__version__))
     parser.add_argument("--skip_report", action="store_true", default=False, help=argparse.SUPPRESS)
+    parser.add_argument("--incremental", default=False, action="store_true", help="\t\tRe-use the results of a previous --incremental run with the same output directory and prefix: only new or changed isoforms are aligned, run through GMST and classified")
 
     args = parser.parse_args()
 
@@ -2154,6 +2531,11 @@ def main():
         print("ERROR: Annotation doesn't exist. Abort!".format(args.annotation), file=sys.stderr)
         sys.exit()
 
+    if args.ref_cache_dir is not None:
+        args.ref_cache_dir = os.path.abspath(args.ref_cache_dir)
+        if not os.path.isdir(args.ref_cache_dir):
+            os.makedirs(args.ref_cache_dir)
+
     #if args.aligner_choice == "gmap":
     #    args.sense = "sense_force" if args.sense else "auto"
     #elif args.aligner_choice == "minimap2":
@@ -2167,7 +2549,6 @@ def main():
     #    args.sense = "--trans-strand"
 
 
-    args.novel_gene_prefix = None
     # Print out parameters so can be put into report PDF later
     args.doc = os.path.join(os.path.abspath(args.dir), args.output+".params.txt")
     print("Write arguments to {0}...".format(args.doc, file=sys.stdout))
@@ -2187,12 +2568,7 @@ def main():
     
     # Running functionality
     print("**** Running SQANTI2...", file=sys.stdout)
-    if args.chunks == 1:
-        run(args)
-    else:
-        split_dirs = split_input_run(args)
-        combine_split_runs(args, split_dirs)
-        shutil.rmtree(SPLIT_ROOT_DIR)
+    run(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,4 @@
+import os, sys
+
+# the utilities are imported by module name, as sqanti_qc2.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "utilities"))
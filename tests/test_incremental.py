@@ -0,0 +1,70 @@
+import os, multiprocessing
+
+from incremental import merge_sam, ClassRowStore, load_class_rows, save_class_rows, remove_stale_class_rows
+
+HEADER = "@HD\tVN:1.6\n@SQ\tSN:chr1\tLN:1000\n"
+
+
+def sam_line(qname, pos):
+    return "{0}\t0\tchr1\t{1}\t60\t10M\t*\t0\t0\tACGTACGTAC\t*\n".format(qname, pos)
+
+
+def read_body(filename):
+    return [line for line in open(filename) if not line.startswith('@')]
+
+
+def test_merge_sam_only_removals(tmp_path):
+    sam = str(tmp_path / "corrected.sam")
+    with open(sam, 'w') as f:
+        f.write(HEADER + sam_line("A", 1) + sam_line("B", 2) + sam_line("C", 3))
+    merge_sam(sam, {"A", "B"}, None, sam)
+    assert open(sam).read() == HEADER + sam_line("A", 1) + sam_line("B", 2)
+
+
+def test_merge_sam_new_and_removed(tmp_path):
+    old_sam = str(tmp_path / "corrected.sam")
+    new_sam = str(tmp_path / "delta.sam")
+    with open(old_sam, 'w') as f:
+        f.write(HEADER + sam_line("A", 1) + sam_line("B", 2) + sam_line("C", 3))
+    new_header = "@HD\tVN:1.6\n@SQ\tSN:chr1\tLN:1000\n@PG\tID:minimap2\n"
+    with open(new_sam, 'w') as f:
+        f.write(new_header + sam_line("B", 20) + sam_line("D", 4))
+    merge_sam(old_sam, {"A"}, new_sam, old_sam)
+    assert open(old_sam).read() == new_header + sam_line("A", 1) + sam_line("B", 20) + sam_line("D", 4)
+
+
+def read_rows_in_child(store, iso, fp, queue):
+    queue.put(store.get(iso, fp))
+
+
+def test_class_row_store(tmp_path):
+    prefix = str(tmp_path / "out_incremental_rows")
+    rows = {"PB.1.1": ({'isoform': "PB.1.1", 'structural_category': "full-splice_match"}, [{'junction_number': "junction_1"}]),
+            "PB.2.1": (None, [])}
+    store = ClassRowStore.create(prefix)
+    for iso, (class_row, junc_rows) in rows.items():
+        store.add(iso, "fp_" + iso, class_row, junc_rows)
+    state = {}
+    save_class_rows(state, store)
+    assert state['class_rows_file'] == os.path.basename(store.filename)
+
+    prev = load_class_rows(str(tmp_path), state)
+    for iso in rows:
+        assert prev.fingerprint(iso) == "fp_" + iso
+        assert prev.get(iso, "fp_" + iso) == rows[iso]
+    assert prev.get("PB.1.1", "changed") is None
+    assert prev.get("PB.3.1", None) is None
+
+    # forked classification workers read through their own handle
+    queue = multiprocessing.get_context('fork').Queue()
+    p = multiprocessing.get_context('fork').Process(target=read_rows_in_child, args=(prev, "PB.2.1", "fp_PB.2.1", queue))
+    p.start()
+    assert queue.get() == rows["PB.2.1"]
+    p.join()
+    assert prev.get("PB.1.1", "fp_PB.1.1") == rows["PB.1.1"]
+
+    # the next run replaces the rows file
+    store2 = ClassRowStore.create(prefix)
+    save_class_rows({}, store2)
+    remove_stale_class_rows(store2, prefix)
+    assert os.listdir(str(tmp_path)) == [os.path.basename(store2.filename)]
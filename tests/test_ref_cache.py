@@ -0,0 +1,25 @@
+import os
+
+from ref_cache import load_ref_cache, write_ref_cache
+
+
+def test_round_trip_writes_the_genepred(tmp_path):
+    genepred = tmp_path / "ref.genePred"
+    genepred.write_text("T1\tchr1\t+\t0\t100\n")
+    cache = str(tmp_path / "ref.cache")
+    assert write_ref_cache(cache, "key", {"a": [1, 2]}, str(genepred))
+
+    genepred.unlink()
+    assert load_ref_cache(cache, "key", str(genepred)) == {"a": [1, 2]}
+    assert genepred.read_text() == "T1\tchr1\t+\t0\t100\n"
+    assert load_ref_cache(cache, "other key", str(genepred)) is None
+
+
+def test_failed_write_is_skipped_and_cleaned_up(tmp_path, capsys):
+    genepred = tmp_path / "ref.genePred"
+    genepred.write_text("T1\tchr1\t+\t0\t100\n")
+    cache = str(tmp_path / "ref.cache")
+    # lambdas can not be pickled
+    assert not write_ref_cache(cache, "key", {"a": lambda: 0}, str(genepred))
+    assert "WARNING: unable to write reference cache" in capsys.readouterr().err
+    assert sorted(os.listdir(str(tmp_path))) == ["ref.genePred"]
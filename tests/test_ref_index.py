@@ -0,0 +1,15 @@
+import random
+
+from ref_index import IntronIndex
+
+
+def test_intron_queries_match_brute_force():
+    rng = random.Random(0)
+    for n in (0, 1, 2, 3, 7, 50, 300):
+        introns = sorted(set((d, d + rng.randint(0, 400)) for d in (rng.randint(0, 5000) for _ in range(n))))
+        index = IntronIndex(introns)
+        for _ in range(300):
+            start = rng.randint(-100, 5200)
+            end = start + rng.randint(0, 1000)
+            assert index.has_intron_within(start, end) == any(start <= d < a < end for d, a in introns)
+            assert index.has_intron_around(start, end) == any(d < a and d <= start and end <= a for d, a in introns)
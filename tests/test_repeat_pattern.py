@@ -0,0 +1,79 @@
+import random
+
+import pytest
+
+from repeat_pattern import checkForRepeatPat, checkForRepeatPatBatch
+from rt_switching import PATSEQLEN
+
+# junction windows are PATSEQLEN + 2 * --wiggle_count bases
+WINDOW_LENGTHS = [PATSEQLEN + 2 * wiggle_count for wiggle_count in range(0, 4)]
+MIN_MATCHES = range(4, 11)
+
+
+def random_window_pair(rng, cnt):
+    """
+    Low complexity windows and planted repeats (with 0-2 substitutions) so that matches show up, some with N.
+    """
+    alphabet = rng.choice(['ACGT', 'ACGT', 'AT', 'GC', 'ACGTN', 'ACGTNNNN'])
+    seq_exon = ''.join(rng.choice(alphabet) for p in range(cnt))
+    seq_intron = ''.join(rng.choice(alphabet) for p in range(cnt))
+    if rng.random() < 0.5:
+        L = rng.randint(2, cnt)
+        i, j = rng.randint(0, cnt-L), rng.randint(0, cnt-L)
+        planted = list(seq_exon[i:i+L])
+        for p in rng.sample(range(L), min(L, rng.randint(0, 2))):
+            planted[p] = rng.choice('ACGTN')
+        seq_intron = seq_intron[:j] + ''.join(planted) + seq_intron[j+L:]
+    return seq_exon, seq_intron
+
+
+def planted_window_pairs(rng, cnt, min_match):
+    """
+    A <min_match> repeat at every (exon, intron) offset, exact or with one substitution (or N) at every position.
+    """
+    pairs = []
+    for i in range(cnt-min_match+1):
+        for j in range(cnt-min_match+1):
+            for p in [None] + list(range(min_match)):
+                seq_exon = ''.join(rng.choice('ACGT') for k in range(cnt))
+                seq_intron = list(''.join(rng.choice('ACGT') for k in range(cnt)))
+                seq_intron[j:j+min_match] = seq_exon[i:i+min_match]
+                if p is not None:
+                    seq_intron[j+p] = rng.choice('ACGTN'.replace(seq_exon[i+p], ''))
+                pairs.append((seq_exon, ''.join(seq_intron)))
+    return pairs
+
+
+def check_same_results(pairs, min_match, allow_mismatch):
+    exon_seqs, intron_seqs = [e for e, i in pairs], [i for e, i in pairs]
+    got = checkForRepeatPatBatch(exon_seqs, intron_seqs, min_match, allow_mismatch)
+    for seq_exon, seq_intron, result in zip(exon_seqs, intron_seqs, got):
+        assert result == checkForRepeatPat(seq_exon, seq_intron, min_match, allow_mismatch), (seq_exon, seq_intron)
+    return sum(result[0] for result in got)
+
+
+@pytest.mark.parametrize("cnt", WINDOW_LENGTHS)
+@pytest.mark.parametrize("allow_mismatch", [False, True])
+def test_random_windows(cnt, allow_mismatch):
+    rng = random.Random(cnt)
+    n_rts = 0
+    for min_match in MIN_MATCHES:
+        n_rts += check_same_results([random_window_pair(rng, cnt) for p in range(1000)], min_match, allow_mismatch)
+    assert n_rts > 0
+
+
+@pytest.mark.parametrize("cnt", WINDOW_LENGTHS)
+@pytest.mark.parametrize("allow_mismatch", [False, True])
+def test_planted_repeats(cnt, allow_mismatch):
+    rng = random.Random(cnt)
+    for min_match in MIN_MATCHES:
+        check_same_results(planted_window_pairs(rng, cnt, min_match), min_match, allow_mismatch)
+
+
+def test_mixed_lengths_in_one_batch():
+    rng = random.Random(0)
+    pairs = [random_window_pair(rng, rng.choice(WINDOW_LENGTHS)) for p in range(2000)]
+    pairs += [('', ''), ('ACGTACGTAC', '')]
+    for min_match in MIN_MATCHES:
+        for allow_mismatch in (False, True):
+            check_same_results(pairs, min_match, allow_mismatch)
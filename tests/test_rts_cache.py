@@ -0,0 +1,37 @@
+import ref_cache
+from rts_cache import open_rts_cache, MISSING
+from rt_switching import SpliceJunctions
+
+
+def sj(start, end):
+    return SpliceJunctions("PB.1.1", "junction_1", "chr1", "+", start, end, None, "novel", "known", "novel", "canonical")
+
+
+def test_genome_checksum_is_only_computed_when_the_genome_changes(tmp_path, monkeypatch):
+    genome = tmp_path / "genome.fa"
+    genome.write_text(">chr1\nACGTACGTAC\n")
+    cache_dir = str(tmp_path / "cache")
+    calls = []
+    file_checksum = ref_cache.file_checksum
+    monkeypatch.setattr(ref_cache, "file_checksum", lambda filename: calls.append(filename) or file_checksum(filename))
+
+    key = open_rts_cache(cache_dir, str(genome), 8, True, 1).key
+    assert open_rts_cache(cache_dir, str(genome), 8, True, 1).key == key
+    assert len(calls) == 1
+
+    genome.write_text(">chr1\nACGTACGTACGT\n")
+    assert open_rts_cache(cache_dir, str(genome), 8, True, 1).key != key
+    assert len(calls) == 2
+
+
+def test_cache_round_trip(tmp_path):
+    genome = tmp_path / "genome.fa"
+    genome.write_text(">chr1\nACGTACGTAC\n")
+    cache = open_rts_cache(str(tmp_path), str(genome), 8, True, 1)
+    cache.append([(sj(100, 200), None), (sj(300, 400), ("ACGTACGTAC", "ACGTACGTAA", 8, "ACGTACGT", 1))])
+
+    cache = open_rts_cache(str(tmp_path), str(genome), 8, True, 1)
+    assert cache.load([sj(100, 200), sj(300, 400), sj(500, 600)]) == 2
+    assert cache.get(sj(100, 200)) is None
+    assert cache.get(sj(300, 400)) == ("ACGTACGTAC", "ACGTACGTAA", 8, "ACGTACGT", 1)
+    assert cache.get(sj(500, 600)) is MISSING
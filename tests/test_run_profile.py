@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+from run_profile import RunProfile, StageTimer
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/clear_refs'), reason="needs /proc/self/clear_refs (Linux)")
+
+
+def test_stage_peaks_are_per_stage():
+    profile = RunProfile()
+    with profile.stage('large'):
+        block = bytearray(200 * 1024 * 1024)
+        del block
+    with profile.stage('small'):
+        pass
+    large, small = profile.stages
+    assert large['peak_rss_mb'] > small['peak_rss_mb'] + 150
+    assert small['cumulative_peak_rss_mb'] >= large['peak_rss_mb']
+
+
+def test_nested_timers_keep_the_outer_peak():
+    outer = StageTimer()
+    block = bytearray(200 * 1024 * 1024)
+    del block
+    inner = StageTimer().stop()
+    record = outer.stop()
+    assert record['peak_rss_mb'] > inner['peak_rss_mb'] + 150
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from transcript_compare import match_type, compare_to_refs, random_transcript, ChainMemo
+
+# reference with 4 exons: [100,200) [300,400) [500,600) [700,800)
+REF = ([100, 300, 500, 700], [200, 400, 600, 800])
+
+
+@pytest.mark.parametrize("starts, ends, expected", [
+    # same intron chain, different TSS/TTS
+    ([150, 300, 500, 700], [200, 400, 600, 850], 'exact'),
+    # query starts inside the 2nd ref exon: contiguous, shorter part of the ref chain
+    ([350, 500, 700], [400, 600, 780], 'subset'),
+    # query stops in the 3rd ref exon
+    ([120, 300, 500], [200, 400, 550], 'subset'),
+    # query adds an exon before the ref
+    ([10, 100, 300, 500, 700], [50, 200, 400, 600, 800], 'super'),
+    # one internal boundary differs
+    ([100, 300, 510, 700], [200, 400, 600, 800], 'partial'),
+    # shifted agreeing stretch: cupcake's 'concordant', reported as 'partial'
+    ([10, 150, 300], [50, 200, 400], 'partial'),
+    # no exon overlap
+    ([900, 1100], [1000, 1200], 'nomatch'),
+])
+def test_match_type_cases(starts, ends, expected):
+    assert match_type(starts, ends, REF[0], REF[1]) == expected
+
+
+def random_pairs(num_queries, num_refs, seed=0):
+    random.seed(seed)
+    sites = sorted(random.sample(range(100, 30000, 7), 200))
+    refs = [random_transcript(sites) for i in range(num_refs)]
+    queries = [random_transcript(sites) for i in range(num_queries)]
+    return queries, refs
+
+
+def test_match_type_same_as_cupcake():
+    cj = pytest.importorskip("cupcake.tofu.compare_junctions")
+    queries, refs = random_pairs(500, 40)
+    for q in queries:
+        for r in refs:
+            expected = cj.compare_junctions(q, r, internal_fuzzy_max_dist=0, max_5_diff=999999, max_3_diff=999999)
+            assert match_type(q.exonStarts, q.exonEnds, r.exonStarts, r.exonEnds) == \
+                   (expected if expected != 'concordant' else 'partial'), (q.segments, r.segments)
+
+
+def test_compare_to_refs_memo_is_transparent():
+    queries, refs = random_pairs(300, 40, seed=1)
+    memo = ChainMemo(100)
+    for q in queries:
+        same_strand = [r for r in refs if r.strand == q.strand]
+        key = (q.strand, tuple(q.exonEnds[:-1]), tuple(q.exonStarts[1:]))
+        assert compare_to_refs(q, same_strand, memo_entry=memo.lookup(key, q)) == compare_to_refs(q, same_strand)
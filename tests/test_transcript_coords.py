@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+from transcript_coords import TranscriptCoordinateMapper
+
+
+def random_exons(rng):
+    starts, ends = [], []
+    pos = rng.randint(0, 1000)
+    for k in range(rng.randint(1, 8)):
+        starts.append(pos)
+        pos += rng.randint(1, 30)
+        ends.append(pos)
+        pos += rng.randint(1, 50)
+    return starts, ends
+
+
+def per_base_map(starts, ends, strand):
+    """
+    transcript coord (0-based) --> genomic coord (0-based), as classify_isoform used to build it
+    """
+    length = sum(e - s for s, e in zip(starts, ends))
+    m = {}
+    i = 0
+    for s, e in zip(starts, ends):
+        for c in range(s, e):
+            m[i if strand == '+' else length-i-1] = c
+            i += 1
+    return m
+
+
+def exon_walk(starts, ends, s, e):
+    """
+    CDS exon pieces, as write_collapsed_GFF_with_CDS used to cut them
+    """
+    for i, (exon_start, exon_end) in enumerate(zip(starts, ends)):
+        if exon_end > s: break
+    pieces = [(s, min(e, exon_end))]
+    for exon_start, exon_end in zip(starts[i+1:], ends[i+1:]):
+        if exon_start > e: break
+        pieces.append((exon_start, min(e, exon_end)))
+    return pieces
+
+
+@pytest.mark.parametrize("strand", ['+', '-'])
+def test_to_genome_matches_per_base_map(strand):
+    rng = random.Random(0)
+    for _ in range(300):
+        starts, ends = random_exons(rng)
+        m = per_base_map(starts, ends, strand)
+        mapper = TranscriptCoordinateMapper(starts, ends, strand)
+        positions = list(range(-3, len(m) + 3))
+        assert list(mapper.to_genome(positions)) == [m.get(p, -1) for p in positions]
+
+
+@pytest.mark.parametrize("strand", ['+', '-'])
+def test_to_genome_out_of_range(strand):
+    mapper = TranscriptCoordinateMapper([100, 300], [200, 400], strand)
+    assert list(mapper.to_genome([-1, 200, 10**9])) == [-1, -1, -1]
+    assert list(mapper.to_genome([0, 199])) == ([100, 399] if strand == '+' else [399, 100])
+
+
+@pytest.mark.parametrize("strand", ['+', '-'])
+def test_clip_to_exons_matches_exon_walk(strand):
+    rng = random.Random(1)
+    for _ in range(300):
+        starts, ends = random_exons(rng)
+        m = per_base_map(starts, ends, strand)
+        mapper = TranscriptCoordinateMapper(starts, ends, strand)
+        # CDS ends are always exonic bases, as they come from the transcript --> genome mapping
+        a, b = sorted(rng.sample(range(len(m)), 2)) if len(m) > 1 else (0, 0)
+        s, e = sorted((m[a], m[b]))
+        e += 1
+        assert mapper.clip_to_exons(s, e) == exon_walk(starts, ends, s, e)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Interval arithmetic on exon lists used by the classification in sqanti_qc2.py.
+
+Exons are anything with .start (0-based) and .end (1-based) attributes, ex: bx Interval.
+
+Running this module directly runs a micro-benchmark of calc_exon_overlap against
+the per-base counting it replaced:
+
+    python exon_compare.py [num_exons] [num_refs]
+"""
+
+import sys, random, timeit
+
+
+def merge_exons(exons):
+    """
+    :param exons: list of exons, not necessarily sorted or disjoint
+    :return: sorted list of disjoint (start, end) covering the same bases
+    """
+    merged = []
+    for s, e in sorted((e.start, e.end) for e in exons):
+        if s >= e:
+            continue
+        if merged and s <= merged[-1][1]:
+            if e > merged[-1][1]:
+                merged[-1][1] = e
+        else:
+            merged.append([s, e])
+    return merged
+
+
+def merged_overlap(q_merged, r_merged):
+    """
+    Sweep two sorted lists of disjoint [start, end) intervals.
+    :return: number of bases shared by both
+    """
+    i, j, total = 0, 0, 0
+    nq, nr = len(q_merged), len(r_merged)
+    while i < nq and j < nr:
+        qs, qe = q_merged[i]
+        rs, re = r_merged[j]
+        s = qs if qs > rs else rs
+        e = qe if qe < re else re
+        if e > s:
+            total += e - s
+        if qe < re:
+            i += 1
+        else:
+            j += 1
+    return total
+
+
+def calc_exon_overlap(query_exons, ref_exons):
+    """
+    :return: number of query (exonic) bases that are covered by at least one reference exon
+    """
+    return merged_overlap(merge_exons(query_exons), merge_exons(ref_exons))
+
+
+if __name__ == "__main__":
+    from bx.intervals import Interval
+
+    def calc_exon_overlap_per_base(query_exons, ref_exons):
+        # the original per-base dict implementation, kept here for comparison only
+        q_bases = {}
+        for e in query_exons:
+            for b in range(e.start, e.end): q_bases[b] = 0
+        for e in ref_exons:
+            for b in range(e.start, e.end):
+                if b in q_bases: q_bases[b] = 1
+        return sum(q_bases.values())
+
+    def random_transcript(start, num_exons, exon_len, intron_len):
+        exons, pos = [], start
+        for i in range(num_exons):
+            e = pos + random.randint(exon_len//2, exon_len*3//2)
+            exons.append(Interval(pos, e))
+            pos = e + random.randint(intron_len//2, intron_len*3//2)
+        return exons
+
+    num_exons = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    num_refs = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    random.seed(0)
+    # ~10 kb of exonic sequence for the query with the defaults
+    query = random_transcript(100000, num_exons, 500, 2000)
+    refs = [random_transcript(100000 + random.randint(-5000, 5000), random.randint(2, num_exons*2), 500, 2000) for i in range(num_refs)]
+
+    for r in refs:
+        assert calc_exon_overlap(query, r) == calc_exon_overlap_per_base(query, r)
+
+    t_old = timeit.timeit(lambda: [calc_exon_overlap_per_base(query, r) for r in refs], number=3) / 3
+    t_new = timeit.timeit(lambda: [calc_exon_overlap(query, r) for r in refs], number=3) / 3
+    print("query: {0} exons, {1} bp exonic; {2} refs".format(num_exons, sum(e.end-e.start for e in query), num_refs))
+    print("per-base dict: {0:.4f} sec".format(t_old))
+    print("interval sweep: {0:.6f} sec ({1:.0f}x faster)".format(t_new, t_old/t_new))
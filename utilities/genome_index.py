@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Indexed, memory-mapped access to a reference genome FASTA.
+
+A samtools-compatible .fai index is built once next to the FASTA (or in a fallback
+directory if that is not writable) and sequence slices are served straight from a
+read-only memory map of the FASTA file. The file pages are shared by every process
+on the box (including forked --chunks workers) instead of each one holding its own
+copy of the genome as Biopython objects.
+
+IndexedGenome can be used where a dict of chrom --> SeqRecord was used before:
+    genome[chrom].seq[start:end]       --> Bio.Seq.Seq
+    genome[chrom][start:end].seq       --> Bio.Seq.Seq (via a sliced SeqRecord)
+but internal callers should prefer genome.fetch(chrom, start, end) which returns a plain str.
+"""
+
+import os, sys, mmap
+from collections import namedtuple
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+FaiEntry = namedtuple('FaiEntry', 'name, length, offset, linebases, linewidth')
+
+_RC_TABLE = str.maketrans("ACGTMRWSYKVHDBNacgtmrwsykvhdbn",
+                          "TGCAKYWSRMBDHVNtgcakywsrmbdhvn")
+
+
+def reverse_complement(seq):
+    """
+    :param seq: DNA sequence as str (IUPAC codes allowed)
+    :return: reverse complement of <seq> as str, case is preserved
+    """
+    return seq.translate(_RC_TABLE)[::-1]
+
+
+def build_fai(fasta_filename):
+    """
+    Scan a FASTA file once and compute the samtools faidx index.
+    All sequence lines of a record, except the last one, must have the same length.
+    :return: list of FaiEntry in file order
+    """
+    entries = []
+    name, length, offset, linebases, linewidth = None, 0, 0, None, None
+    short_line_seen = False
+    pos = 0
+    with open(fasta_filename, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    entries.append(FaiEntry(name, length, offset, linebases or 0, linewidth or 0))
+                name = line[1:].split()[0].decode() if len(line.strip()) > 1 else ''
+                length, offset, linebases, linewidth = 0, pos + len(line), None, None
+                short_line_seen = False
+            elif name is not None:
+                nbases = len(line.rstrip(b'\r\n'))
+                if nbases > 0:
+                    if linebases is None:
+                        linebases, linewidth = nbases, len(line)
+                    elif short_line_seen or nbases > linebases or len(line) - nbases != linewidth - linebases:
+                        raise ValueError("Genome fasta {0} has inconsistent line lengths in sequence {1}! "
+                                         "Please reformat it (ex: `seqtk seq -l 60`) so all lines are the same length.".format(fasta_filename, name))
+                    elif nbases < linebases:
+                        short_line_seen = True
+                    length += nbases
+            pos += len(line)
+    if name is not None:
+        entries.append(FaiEntry(name, length, offset, linebases or 0, linewidth or 0))
+    return entries
+
+
+def write_fai(entries, fai_filename):
+    with open(fai_filename, 'w') as f:
+        for e in entries:
+            f.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(e.name, e.length, e.offset, e.linebases, e.linewidth))
+
+
+def read_fai(fai_filename):
+    entries = []
+    for line in open(fai_filename):
+        raw = line.strip().split('\t')
+        entries.append(FaiEntry(raw[0], int(raw[1]), int(raw[2]), int(raw[3]), int(raw[4])))
+    return entries
+
+
+class IndexedSeq(object):
+    """
+    Stand-in for SeqRecord.seq: slicing returns a Bio.Seq.Seq read from the memory map.
+    """
+    def __init__(self, genome, name):
+        self.genome = genome
+        self.name = name
+
+    def __len__(self):
+        return self.genome.index[self.name].length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(len(self))
+            seq = self.genome.fetch(self.name, start, end)
+            return Seq(seq[::step] if step != 1 else seq)
+        return self.genome.fetch(self.name, key, key+1)
+
+    def __str__(self):
+        return self.genome.fetch(self.name, 0, len(self))
+
+
+class IndexedRecord(object):
+    """
+    Stand-in for a genome SeqRecord. Slicing returns a (small) SeqRecord.
+    """
+    def __init__(self, genome, name):
+        self.id = name
+        self.name = name
+        self.seq = IndexedSeq(genome, name)
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError("IndexedRecord only supports slicing")
+        return SeqRecord(self.seq[key], id=self.id, name=self.name, description='')
+
+
+class IndexedGenome(object):
+    """
+    Read-only, memory-mapped genome FASTA behaving like a dict of chrom --> SeqRecord.
+    """
+    def __init__(self, fasta_filename, fallback_index_dir=None):
+        """
+        :param fasta_filename: uncompressed genome FASTA
+        :param fallback_index_dir: where to write the .fai if the FASTA directory is not writable
+        """
+        self.fasta_filename = fasta_filename
+        with open(fasta_filename, 'rb') as h:
+            if h.read(2) == b'\x1f\x8b':
+                raise ValueError("Genome fasta {0} is gzipped. Please provide an uncompressed fasta.".format(fasta_filename))
+
+        self.fai_filename = self._find_or_build_index(fallback_index_dir)
+        self.index = dict((e.name, e) for e in read_fai(self.fai_filename))
+
+        self._handle = open(fasta_filename, 'rb')
+        self._mm = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _find_or_build_index(self, fallback_index_dir):
+        candidates = [self.fasta_filename + '.fai']
+        if fallback_index_dir is not None:
+            candidates.append(os.path.join(fallback_index_dir, os.path.basename(self.fasta_filename) + '.fai'))
+        fasta_mtime = os.path.getmtime(self.fasta_filename)
+        for fai in candidates:
+            if os.path.exists(fai) and os.path.getmtime(fai) >= fasta_mtime:
+                print("Using genome index {0}.".format(fai), file=sys.stdout)
+                return fai
+
+        print("Indexing genome fasta {0}....".format(self.fasta_filename), file=sys.stdout)
+        entries = build_fai(self.fasta_filename)
+        for fai in candidates:
+            try:
+                write_fai(entries, fai)
+                return fai
+            except OSError:
+                print("WARNING: cannot write genome index {0}.".format(fai), file=sys.stderr)
+        print("ERROR: unable to write a genome index for {0}. Use a writable output directory. Abort!".format(self.fasta_filename), file=sys.stderr)
+        sys.exit(-1)
+
+    def fetch(self, chrom, start, end):
+        """
+        :param start: 0-based start
+        :param end: 1-based end (exclusive); both are clipped to the chromosome
+        :return: genomic sequence as str, in the case stored in the FASTA
+        """
+        e = self.index[chrom]
+        start, end = max(0, start), min(e.length, end)
+        if start >= end:
+            return ''
+        b0 = e.offset + (start // e.linebases) * e.linewidth + start % e.linebases
+        b1 = e.offset + ((end-1) // e.linebases) * e.linewidth + (end-1) % e.linebases + 1
+        raw = self._mm[b0:b1]
+        if e.linewidth != e.linebases:
+            raw = raw.replace(b'\n', b'').replace(b'\r', b'')
+        return raw.decode('ascii')
+
+    def fetch_batch(self, chrom, starts, width):
+        """
+        Fetch many short slices of the same chromosome, ex: the splice sites of all junctions.
+        :param starts: list of 0-based starts
+        :param width: length of every slice (clipped to the chromosome like fetch())
+        :return: list of str, one per start
+        """
+        e = self.index[chrom]
+        mm, offset, linebases, linewidth, length = self._mm, e.offset, e.linebases, e.linewidth, e.length
+        seqs = []
+        for start in starts:
+            end = min(length, start + width)
+            start = max(0, start)
+            if start >= end:
+                seqs.append('')
+                continue
+            b0 = offset + (start // linebases) * linewidth + start % linebases
+            b1 = offset + ((end-1) // linebases) * linewidth + (end-1) % linebases + 1
+            raw = mm[b0:b1]
+            if b1 - b0 != end - start:
+                raw = raw.replace(b'\n', b'').replace(b'\r', b'')
+            seqs.append(raw.decode('ascii'))
+        return seqs
+
+    def fetch_oriented(self, chrom, start, end, strand):
+        """
+        Same as fetch() but reverse complemented when <strand> is '-'.
+        """
+        seq = self.fetch(chrom, start, end)
+        return reverse_complement(seq) if strand == '-' else seq
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, chrom):
+        return chrom in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, chrom):
+        if chrom not in self.index:
+            raise KeyError(chrom)
+        return IndexedRecord(self, chrom)
+
+    def chrom_length(self, chrom):
+        return self.index[chrom].length
+
+    def close(self):
+        self._mm.close()
+        self._handle.close()
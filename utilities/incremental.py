@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+State kept between runs of sqanti_qc2.py with --incremental.
+
+After a run, the state file (<output>_incremental.pkl in the output directory) records:
+    - a fingerprint of every input isoform sequence (to re-align only new/changed isoforms)
+    - a fingerprint of every corrected isoform sequence (to re-run GMST only on those)
+    - for every isoform, a fingerprint of everything its classification depends on and the
+      position of its classification and junction rows in the rows file (see ClassRowStore)
+    - keys summarizing the global inputs (genome, aligner, reference annotation cache key,
+      optional peak/coverage files and parameters). If a key changes, the stage it
+      covers is re-run for all isoforms.
+
+Fingerprints are md5 digests, the state is pickled and written atomically.
+"""
+
+import os, sys, glob, pickle, hashlib, tempfile
+
+# bump whenever the content or layout of the state changes
+INCREMENTAL_VERSION = 3
+
+
+def fingerprint(*parts):
+    """
+    :param parts: any objects with a stable repr() (str, int, tuples, lists...)
+    :return: md5 hex digest of the parts
+    """
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def file_signature(filename):
+    """
+    Cheap signature for (potentially large) input files that are not worth hashing.
+    :return: (absolute path, size, modification time) or None if no file is given
+    """
+    if filename is None:
+        return None
+    return (os.path.abspath(filename), os.path.getsize(filename), int(os.path.getmtime(filename)))
+
+
+def fasta_fingerprints(fasta_filename):
+    """
+    :return: dict of sequence id --> md5 of the (upper case) sequence
+    """
+    fps = {}
+    seqid, h = None, None
+    with open(fasta_filename) as f:
+        for line in f:
+            if line.startswith('>'):
+                if seqid is not None:
+                    fps[seqid] = h.hexdigest()
+                seqid, h = line[1:].split()[0], hashlib.md5()
+            elif seqid is not None:
+                h.update(line.strip().upper().encode())
+    if seqid is not None:
+        fps[seqid] = h.hexdigest()
+    return fps
+
+
+def changed_ids(fingerprints, old_fingerprints):
+    """
+    :return: set of ids that are new or whose fingerprint differs from the previous run
+    """
+    return set(k for k,v in fingerprints.items() if old_fingerprints.get(k) != v)
+
+
+def write_fasta_subset(fasta_filename, ids, output_filename):
+    """
+    Write the records of <fasta_filename> whose id is in <ids> to <output_filename>.
+    :return: number of records written
+    """
+    count = 0
+    keep = False
+    with open(output_filename, 'w') as f:
+        for line in open(fasta_filename):
+            if line.startswith('>'):
+                keep = line[1:].split()[0] in ids
+                count += keep
+            if keep:
+                f.write(line)
+    return count
+
+
+def merge_sam(old_sam, keep_ids, new_sam, output_sam):
+    """
+    Combine the alignments of unchanged isoforms from a previous SAM with the alignments of the new/changed ones.
+    :param old_sam: SAM of the previous run
+    :param keep_ids: isoform ids whose alignments are taken from <old_sam>
+    :param new_sam: SAM of the new/changed isoforms, its header is used for the output.
+                    None if no isoform is new or changed: <old_sam> is only filtered down to <keep_ids>
+    """
+    tmp_name = output_sam + '.tmp'
+    with open(tmp_name, 'w') as f:
+        for line in open(new_sam if new_sam is not None else old_sam):
+            if line.startswith('@'):
+                f.write(line)
+        for line in open(old_sam):
+            if not line.startswith('@') and line.split('\t', 1)[0] in keep_ids:
+                f.write(line)
+        if new_sam is not None:
+            for line in open(new_sam):
+                if not line.startswith('@'):
+                    f.write(line)
+    os.replace(tmp_name, output_sam)
+
+
+class ClassRowStore(object):
+    """
+    Classification and junction rows of every isoform of an --incremental run.
+    The rows are pickled to a file as the isoforms are classified, only the fingerprint and the file
+    position of the rows of each isoform are kept in memory (and in the state).
+    """
+    def __init__(self, filename, index=None):
+        """
+        :param filename: rows file
+        :param index: dict of isoform id --> (fingerprint, position in the rows file), of a previous run
+        """
+        self.filename = filename
+        self.index = {} if index is None else index
+        self.handle = None
+        self.handle_pid = None
+        self.writer = None
+
+    @classmethod
+    def create(cls, prefix):
+        """
+        :return: new, empty ClassRowStore open for writing, in a new file <prefix>.<random>
+        """
+        fd, filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(prefix)), prefix=os.path.basename(prefix) + '.')
+        store = cls(filename)
+        store.writer = os.fdopen(fd, 'wb')
+        return store
+
+    def add(self, iso, fp, class_row, junc_rows):
+        self.index[iso] = (fp, self.writer.tell())
+        pickle.dump((class_row, junc_rows), self.writer, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def fingerprint(self, iso):
+        """
+        :return: fingerprint of the isoform, None if it is not in the store
+        """
+        return self.index[iso][0] if iso in self.index else None
+
+    def get(self, iso, fp):
+        """
+        :return: (classification row, junction rows) of the isoform if it is in the store with fingerprint <fp>, otherwise None
+        """
+        if iso not in self.index or self.index[iso][0] != fp:
+            return None
+        # a handle inherited through fork would share its file position with the other processes
+        if self.handle_pid != os.getpid():
+            self.handle = open(self.filename, 'rb')
+            self.handle_pid = os.getpid()
+        self.handle.seek(self.index[iso][1])
+        return pickle.load(self.handle)
+
+
+def load_class_rows(dirname, state):
+    """
+    :param state: state of the previous run
+    :return: ClassRowStore of the rows of the previous run, None if there are none
+    """
+    if state is None or state.get('class_rows_file') is None:
+        return None
+    filename = os.path.join(dirname, state['class_rows_file'])
+    if not os.path.exists(filename):
+        print("WARNING: incremental rows file {0} is missing. Re-classifying all isoforms.".format(filename), file=sys.stderr)
+        return None
+    return ClassRowStore(filename, state['class_rows_index'])
+
+
+def save_class_rows(state, store):
+    """
+    Close <store> and record its rows file and index in the state (to be written with write_state).
+    """
+    store.close()
+    state['class_rows_file'] = os.path.basename(store.filename)
+    state['class_rows_index'] = store.index
+
+
+def remove_stale_class_rows(store, prefix):
+    """
+    Remove the rows files of the previous (or of interrupted) runs, once the state pointing to <store> is written.
+    :param prefix: prefix given to ClassRowStore.create
+    """
+    for filename in glob.glob(glob.escape(prefix) + '.*'):
+        if os.path.abspath(filename) != os.path.abspath(store.filename):
+            os.remove(filename)
+
+
+def load_state(filename):
+    """
+    :return: state (dict) of the previous run or None if missing, from another SQANTI2 version or unreadable
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            header = pickle.load(f)
+            if header.get('version') != INCREMENTAL_VERSION:
+                print("Incremental state {0} is from another SQANTI2 version. Ignoring it.".format(filename), file=sys.stderr)
+                return None
+            return pickle.load(f)
+    except Exception as e:
+        print("WARNING: unable to read incremental state {0} ({1}). Ignoring it.".format(filename, e), file=sys.stderr)
+        return None
+
+
+def write_state(filename, state):
+    """
+    Write the state atomically (temp file + rename), an interrupted run leaves the previous state intact.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.tmp_incremental')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump({'version': INCREMENTAL_VERSION}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_name, filename)
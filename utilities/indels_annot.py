@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os, sys, csv, math, bisect, shutil, tempfile, multiprocessing
 import pysam
 from collections import defaultdict, Counter
 from csv import DictReader, DictWriter
@@ -25,85 +26,215 @@ MAX_DIST_FROM_JUNC = 10 # maximum distance from junction in which we label "inde
 CIGAR_TYPE_LIST = ['M', 'I', 'D', 'N', 'S', 'H', 'P', '=', 'X', 'B']
 FIELDS_INDEL = ['isoform', 'indelStart', 'indelEnd', 'nt', 'nearJunction', 'junctionStart', 'junctionEnd', 'indelType']
 
-def calc_indels_from_sam(samFile):
+REF_ADVANCING_CIGAR = (0, 2, 3, 6, 9)  # 'M', 'D', 'N', 'P', 'B'
+
+
+def read_indels(read):
+    """
+    Indels and splice junctions of one alignment, in a single pass over its CIGAR.
+    :return: list of (0-based indel start, 1-based indel end, length, 'I' or 'D'), list of splice junctions (Interval(donor, acceptor))
+    """
+    pos_start = read.reference_start # 0-based start
+    indels = []
+    spliceSites = []
+    for (cigarType,cigarLength) in read.cigartuples:
+        if cigarType == 1: # insertion
+            indels.append((pos_start, pos_start+1, cigarLength, 'I'))
+        elif cigarType in REF_ADVANCING_CIGAR:
+            pos_end = pos_start + cigarLength # 1-based end
+            if cigarType == 2: # deletion
+                indels.append((pos_start, pos_end, cigarLength, 'D'))
+            elif cigarType == 3: # skip (intron)
+                spliceSites.append(Interval(pos_start, pos_end))
+            pos_start = pos_end
+    return indels, spliceSites
+
+
+def splice_sites_near(spliceSites, sj_starts, sj_ends, pos_indel, pos_end_indel):
+    """
+    :param spliceSites: splice junctions of the read, in CIGAR (increasing start and end) order
+    :param sj_starts, sj_ends: their starts and ends
+    :return: splice junctions with an end less than MAX_DIST_FROM_JUNC from the indel, in the same order
+    """
+    # a junction is near if its start or (end-1) is within MAX_DIST_FROM_JUNC-1 of pos_indel or pos_end_indel-1
+    lo = min(pos_indel, pos_end_indel-1) - MAX_DIST_FROM_JUNC
+    hi = max(pos_indel, pos_end_indel-1) + MAX_DIST_FROM_JUNC
+    i = bisect.bisect_right(sj_ends, lo + 1)
+    j = bisect.bisect_left(sj_starts, hi)
+    return [sj for sj in spliceSites[i:j]
+            if abs(pos_indel-sj.start) < MAX_DIST_FROM_JUNC or abs(pos_indel-sj.end+1) < MAX_DIST_FROM_JUNC or
+               abs(pos_end_indel-1-sj.start) < MAX_DIST_FROM_JUNC or abs(pos_end_indel-sj.end) < MAX_DIST_FROM_JUNC]
+
+
+def indels_from_reads(reads, fout):
+    """
+    :param reads: iterable of pysam AlignedSegment
+    :param fout: csv writer of the _indels.txt rows (see FIELDS_INDEL)
+    :return: indelsJunc (dict of pbid --> list of junctions near indel), indelsTotal (Counter of pbid --> total indels count)
+    """
+    indelsJunc = defaultdict(lambda: [])
+    indelsTotal = Counter()
+    rows = []
+
+    for read in reads:
+        if read.is_unmapped:
+            continue
+        indels, spliceSites = read_indels(read)
+        if len(indels) == 0:
+            continue
+        name = str(read.query_name).split("|")[0]
+        # indels in the sequence
+        indelsTotal[name] += len(indels)
+
+        sj_starts = [sj.start for sj in spliceSites]
+        sj_ends = [sj.end for sj in spliceSites]
+        for pos_indel, pos_end_indel, nt, indelType in indels:
+            indelType = 'insertion' if indelType == 'I' else 'deletion'
+            # indels near spliceSties
+            spliceSitesNearIndel = splice_sites_near(spliceSites, sj_starts, sj_ends, pos_indel, pos_end_indel) if len(spliceSites) > 0 else []
+            if len(spliceSitesNearIndel)==0:
+                rows.append((name, pos_indel + 1, pos_end_indel, nt, "FALSE", 'NA', 'NA', indelType))  # make start 1-based
+            else:
+                for sj in spliceSitesNearIndel:
+                    # junction start now 1-based, end is already 1-based
+                    rows.append((name, pos_indel + 1, pos_end_indel, nt, 'TRUE', sj.start + 1, sj.end, indelType))
+                    indelsJunc[name].append(sj)
+        if len(rows) >= 100000:
+            fout.writerows(rows)
+            rows = []
+    fout.writerows(rows)
+    return indelsJunc, indelsTotal
+
+
+# Shared state of the indel workers, set by calc_indels_from_sam before the pool is forked
+indels_ctx = {}
+
+
+def make_indel_regions(bam, target_size):
+    """
+    Split the genome into regions of about <target_size> mapped reads (from the BAM index statistics),
+    packing consecutive contigs with few reads together.
+    :return: list of tasks, each a list of (contig, start, end) regions in genomic order
+    """
+    mapped = dict((s.contig, s.mapped) for s in bam.get_index_statistics())
+    tasks = []
+    cur, cur_size = [], 0
+    for contig, length in zip(bam.references, bam.lengths):
+        n = mapped.get(contig, 0)
+        if n == 0:
+            continue
+        n_windows = int(math.ceil(n / float(target_size)))
+        window = int(math.ceil(length / float(n_windows)))
+        for start in range(0, length, window):
+            cur.append((contig, start, min(length, start+window)))
+            cur_size += n / float(n_windows)
+            if cur_size >= target_size:
+                tasks.append(cur)
+                cur, cur_size = [], 0
+    if len(cur) > 0:
+        tasks.append(cur)
+    return tasks
+
+
+def calc_indels_task(task_index):
+    """
+    Indels of the reads starting in the regions of one task (see make_indel_regions), rows written to a part file.
+    :return: task_index, part filename, indelsJunc, indelsTotal
+    """
+    bam = pysam.AlignmentFile(indels_ctx['bam'], "rb")
+    fd, part_file = tempfile.mkstemp(dir=indels_ctx['tmp_dir'], prefix='.tmp_indels')
+    indelsJunc, indelsTotal = {}, Counter()
+    with os.fdopen(fd, 'w') as fhandle:
+        fout = csv.writer(fhandle, delimiter='\t', lineterminator='\r\n')
+        for contig, start, end in indels_ctx['tasks'][task_index]:
+            # reads overlapping the region that start before it belong to the previous region
+            reads = (read for read in bam.fetch(contig, start, end) if read.reference_start >= start)
+            region_junc, region_total = indels_from_reads(reads, fout)
+            for name, sjs in region_junc.items():
+                indelsJunc.setdefault(name, []).extend(sjs)
+            indelsTotal.update(region_total)
+    bam.close()
+    return task_index, part_file, indelsJunc, indelsTotal
+
+
+def sorted_indexed_bam(samFile, n_threads=1):
+    """
+    :return: coordinate sorted and indexed BAM of <samFile>: <samFile> itself if it already is one, otherwise
+             <prefix>.sorted.bam (re-used if it is newer than <samFile>). None if it can not be made.
+    """
+    if samFile.endswith('.bam'):
+        try:
+            with pysam.AlignmentFile(samFile, "rb") as bam:
+                if bam.check_index():
+                    return samFile
+        except (ValueError, OSError):
+            pass
+    bamFile = samFile[:samFile.rfind('.')]+".sorted.bam"
+    if os.path.exists(bamFile) and os.path.exists(bamFile+".bai") and \
+       os.path.getmtime(bamFile) >= os.path.getmtime(samFile) and os.path.getmtime(bamFile+".bai") >= os.path.getmtime(bamFile):
+        return bamFile
+    try:
+        pysam.sort("-@", str(n_threads), "-o", bamFile, samFile)
+        pysam.index(bamFile)
+    except pysam.utils.SamtoolsError as e:
+        print("WARNING: unable to sort and index {0} ({1}). Computing indels serially.".format(samFile, e), file=sys.stderr)
+        return None
+    return bamFile
+
+
+def calc_indels_from_sam(samFile, n_workers=1):
     """
     Given an aligned SAM file, calculate indel statistics.
-    :param samFile: aligned SAM file
+    With n_workers > 1, the alignments are sorted and indexed into a BAM (see sorted_indexed_bam) and
+    genomic regions are processed by a pool of forked worker processes. The indels are then written
+    in genomic order instead of the SAM order.
+    :param samFile: aligned SAM file (or sorted and indexed BAM file)
     :return: indelsJunc (dict of pbid --> list of junctions near indel), indelsTotal (dict of pbid --> total indels count)
     """
-    sam = pysam.AlignmentFile(samFile, "r")
+    global indels_ctx
+
     out_file = samFile[:samFile.rfind('.')]+"_indels.txt"
     fhandle = open(out_file, "w")
-    fout = DictWriter(fhandle, fieldnames=FIELDS_INDEL, delimiter='\t')
-    fout.writeheader()
+    DictWriter(fhandle, fieldnames=FIELDS_INDEL, delimiter='\t').writeheader()
+    fout = csv.writer(fhandle, delimiter='\t', lineterminator='\r\n')
+
+    bamFile = sorted_indexed_bam(samFile, n_workers) if n_workers > 1 else None
+    if bamFile is None:
+        sam = pysam.AlignmentFile(samFile, "r")
+        indelsJunc, indelsTotal = indels_from_reads(sam.fetch(until_eof=True), fout)
+        sam.close()
+        fhandle.close()
+        return dict(indelsJunc), indelsTotal
+
+    with pysam.AlignmentFile(bamFile, "rb") as bam:
+        total = sum(s.mapped for s in bam.get_index_statistics())
+        # several tasks per worker so that chromosomes with many reads do not leave the other workers idle
+        tasks = make_indel_regions(bam, max(1, int(math.ceil(total / (n_workers * 4.)))))
+    indels_ctx = {'bam': bamFile, 'tasks': tasks, 'tmp_dir': os.path.dirname(os.path.abspath(out_file))}
+    pool = multiprocessing.get_context('fork').Pool(n_workers)
 
     indelsJunc = defaultdict(lambda: [])
     indelsTotal = Counter()
-
-
-    for read in sam.fetch():
-        if read.is_unmapped:
-            continue
-        cigarLine = read.cigar
-        ## reading splice junctions and storing information
-        pos_start = read.pos # 0-based start
-        spliceSites = []  # list of splice junctions (Interval(donor, acceptor))
-
-        for (cigarType,cigarLength) in cigarLine:
-            if CIGAR_TYPE_LIST[cigarType] in ('M', 'D', 'N', 'P', 'B'):
-                pos_end = pos_start + cigarLength # 1-based end
-                if (CIGAR_TYPE_LIST[cigarType] == 'N'): # skip (intron)
-                    spliceSites.append(Interval(pos_start, pos_end))
-                pos_start = pos_end
-
-        ## reading indels, comparing with splice junctions and writing information
-        pos_start = read.pos # 0-based start
-
-        for (cigarType,cigarLength) in cigarLine:
-            if CIGAR_TYPE_LIST[cigarType] in ('M', 'D', 'N', 'P', 'B'):
-                pos_end = pos_start + cigarLength # 1-based end
-
-            if CIGAR_TYPE_LIST[cigarType] in ("I", "D"): # insertion or deletion
-                pos_indel = pos_start  # 0-based
-                pos_end_indel = pos_start+1 if CIGAR_TYPE_LIST[cigarType]=='I' else pos_end # 1-based
-                spliceSitesNearIndel = []
-                name = str(read.query_name).split("|")[0]
-
-                # indels in the sequence
-                indelsTotal[name] += 1
-
-                # indels near spliceSties
-                for sj in spliceSites:
-                    if abs(pos_indel-sj.start) < MAX_DIST_FROM_JUNC or abs(pos_indel-sj.end+1) < MAX_DIST_FROM_JUNC or \
-                       abs(pos_end_indel-1-sj.start) < MAX_DIST_FROM_JUNC or abs(pos_end_indel-sj.end) < MAX_DIST_FROM_JUNC:
-                        spliceSitesNearIndel.append(sj)
-
-                rec = {'isoform': name,
-                       'indelStart': pos_indel + 1, # make start 1-based
-                       'indelEnd': pos_end_indel,
-                       'nt': cigarLength,
-                       'nearJunction': "FALSE",
-                       'junctionStart': 'NA',
-                       'junctionEnd': 'NA',
-                       'indelType': 'insertion' if CIGAR_TYPE_LIST[cigarType]=='I' else 'deletion'}
-                if len(spliceSitesNearIndel)==0:
-                    fout.writerow(rec)
-                else:
-                    rec['nearJunction'] = 'TRUE'
-                    for sj in spliceSitesNearIndel:
-                        rec['junctionStart'] = sj.start + 1  # make start now 1-based
-                        rec['junctionEnd'] = sj.end          # end is already 1-based
-                        fout.writerow(rec)
-                        indelsJunc[name].append(sj)
-
-            if CIGAR_TYPE_LIST[cigarType] in ('M', 'D', 'N', 'P', 'B'):
-                pos_start = pos_end
-
-    sam.close()
+    pending = {}
+    next_task = 0
+    for task_index, part_file, task_junc, task_total in pool.imap_unordered(calc_indels_task, range(len(tasks))):
+        pending[task_index] = (part_file, task_junc, task_total)
+        # merge finished tasks in genomic order
+        while next_task in pending:
+            part_file, task_junc, task_total = pending.pop(next_task)
+            with open(part_file, newline='') as part:
+                shutil.copyfileobj(part, fhandle)
+            os.remove(part_file)
+            for name, sjs in task_junc.items():
+                indelsJunc[name].extend(sjs)
+            indelsTotal.update(task_total)
+            next_task += 1
+    pool.close()
+    pool.join()
+    indels_ctx = {}
     fhandle.close()
     return dict(indelsJunc), indelsTotal
 
 
 if __name__ == "__main__":
-    import sys
-    calc_indels_from_sam(sys.argv[1])
\ No newline at end of file
+    calc_indels_from_sam(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1)
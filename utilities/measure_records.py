@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Memory and access time of the compact genePredRecord / myQueryTranscripts of sqanti_qc2.py,
+against the layout they replaced (exons as a list of Intervals and junctions as a list of tuples,
+stored on every record, no __slots__), on <num_records> synthetic genePred records of 1-20 exons:
+
+    python measure_records.py [num_records]
+
+Needs the same environment as sqanti_qc2.py, which it imports.
+"""
+
+import os, sys, random, timeit, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from sqanti_qc2 import genePredRecord, myQueryTranscripts
+from bx.intervals import Interval
+
+
+class ListGenePredRecord(object):
+    """
+    genePredRecord before __slots__: exon Intervals and junctions built once and kept on the record.
+    """
+    def __init__(self, id, chrom, strand, txStart, txEnd, cdsStart, cdsEnd, exonCount, exonStarts, exonEnds, gene=None):
+        self.id = id
+        self.chrom = chrom
+        self.strand = strand
+        self.txStart = txStart
+        self.txEnd = txEnd
+        self.cdsStart = cdsStart
+        self.cdsEnd = cdsEnd
+        self.exonCount = exonCount
+        self.exonStarts = exonStarts
+        self.exonEnds = exonEnds
+        self.gene = gene
+        self.length = 0
+        self.exons = []
+        for s,e in zip(exonStarts, exonEnds):
+            self.length += e-s
+            self.exons.append(Interval(s, e))
+        self.junctions = [(self.exonEnds[i],self.exonStarts[i+1]) for i in range(self.exonCount-1)]
+
+
+def random_fields(num_records, seed=0):
+    random.seed(seed)
+    fields = []
+    for i in range(num_records):
+        n = random.randint(1, 20)
+        pos = random.randint(0, 2**28)
+        starts, ends = [], []
+        for k in range(n):
+            starts.append(pos)
+            pos += random.randint(50, 500)
+            ends.append(pos)
+            pos += random.randint(100, 20000)
+        fields.append(("T{0}".format(i), "chr1", "+", starts[0], ends[-1], starts[0], ends[-1], n, starts, ends, "G{0}".format(i)))
+    return fields
+
+
+def bytes_per_object(make, items):
+    tracemalloc.start()
+    objects = [make(x) for x in items]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / len(objects), objects
+
+
+def make_hit(r):
+    return myQueryTranscripts(id=r.id, tss_diff="NA", tts_diff="NA", num_exons=r.exonCount, length=r.length,
+                              str_class="", chrom=r.chrom, strand=r.strand, subtype="no_subcategory",
+                              percAdownTTS="10.0", seqAdownTTS="AAAA")
+
+
+def main():
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    fields = random_fields(num_records)
+
+    old_size, old_recs = bytes_per_object(lambda f: ListGenePredRecord(*f), fields)
+    new_size, new_recs = bytes_per_object(lambda f: genePredRecord(*f), fields)
+    hit_size, hits = bytes_per_object(make_hit, new_recs)
+    print("genePredRecord: {0:.0f} bytes/record (list layout: {1:.0f})".format(new_size, old_size))
+    print("myQueryTranscripts: {0:.0f} bytes/object".format(hit_size))
+
+    # first/last junction comparison of the FSM/ISM subtype (once per query and reference pair)
+    multi_old = [r for r in old_recs if r.exonCount > 1]
+    multi_new = [r for r in new_recs if r.exonCount > 1]
+    t_old = timeit.timeit(lambda: [r.junctions[0]==r.junctions[0] and r.junctions[-1]==r.junctions[-1] for r in multi_old], number=5)
+    t_new = timeit.timeit(lambda: [r.exonEnds[0]==r.exonEnds[0] and r.exonStarts[1]==r.exonStarts[1] and
+                                   r.exonEnds[-2]==r.exonEnds[-2] and r.exonStarts[-1]==r.exonStarts[-1] for r in multi_new], number=5)
+    t_prop = timeit.timeit(lambda: [r.junctions[0]==r.junctions[0] and r.junctions[-1]==r.junctions[-1] for r in multi_new], number=5)
+    print("first/last junction comparison, 5 x {0} records: {1:.3f}s arrays, {2:.3f}s junctions property "
+          "(list layout: {3:.3f}s)".format(len(multi_new), t_new, t_prop, t_old))
+
+
+if __name__ == "__main__":
+    main()
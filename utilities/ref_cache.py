@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Persistent cache of the parsed reference annotation.
+
+reference_parser() in sqanti_qc2.py converts the annotation GTF to genePred and
+rebuilds its per-chromosome structures on every run. The result only depends on
+the annotation file and on --min_ref_len / --geneid, so it is pickled once and
+re-used by later runs (and by every chunk worker) against the same annotation.
+
+The cache file name is derived from the annotation checksum and the parameters.
+A format version is stored inside the file, so caches written by an older SQANTI2
+are ignored (and rewritten) instead of being mis-read.
+
+The cache holds the reference indexes themselves (not the parsed records they are built
+from) and the annotation genePred, which is only read back when refAnnotation_<output>.genePred
+is missing from the output directory. The annotation checksum is kept in a small file in the
+cache directory and only recomputed when the size or modification time of the annotation changes.
+"""
+
+import os, sys, gc, pickle, hashlib, tempfile, zlib
+
+# bump whenever the content or layout of the cached structures changes
+REF_CACHE_VERSION = 3
+
+
+def file_checksum(filename, blocksize=1<<20):
+    """
+    :return: md5 hex digest of the file content
+    """
+    h = hashlib.md5()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def cached_file_checksum(filename, cache_dir):
+    """
+    file_checksum of <filename>, stored in <cache_dir> with the size and modification time of the file
+    and only recomputed when they change.
+    :return: md5 hex digest of the file content
+    """
+    st = os.stat(filename)
+    stamp = [str(st.st_size), str(st.st_mtime_ns)]
+    path_digest = hashlib.md5(os.path.abspath(filename).encode()).hexdigest()[:8]
+    sidecar = os.path.join(cache_dir, "{0}.{1}.sqanti2_md5".format(os.path.basename(filename), path_digest))
+    try:
+        with open(sidecar) as f:
+            raw = f.readline().rstrip('\n').split('\t')
+        if len(raw) == 3 and raw[:2] == stamp:
+            return raw[2]
+    except (IOError, OSError):
+        pass
+
+    checksum = file_checksum(filename)
+    try:
+        fd, tmp_name = tempfile.mkstemp(dir=cache_dir, prefix='.tmp_md5')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\t'.join(stamp + [checksum]) + '\n')
+        os.replace(tmp_name, sidecar)
+    except (IOError, OSError) as e:
+        print("WARNING: unable to save the checksum of {0} in {1} ({2}).".format(filename, cache_dir, e), file=sys.stderr)
+    return checksum
+
+
+def ref_cache_key(annotation, min_ref_len, geneid, cache_dir):
+    """
+    :return: key string identifying the parsed reference for these parameters
+    """
+    return "{0}.minlen{1}.{2}.v{3}".format(cached_file_checksum(annotation, cache_dir), min_ref_len,
+                                           'geneid' if geneid else 'genename', REF_CACHE_VERSION)
+
+
+def ref_cache_filename(cache_dir, annotation, key):
+    digest = hashlib.md5(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "{0}.sqanti2_refcache.{1}.pkl".format(os.path.basename(annotation), digest))
+
+
+def load_ref_cache(filename, key, genepred_file):
+    """
+    :param genepred_file: the cached annotation genePred is written there if the file does not exist
+    :return: cached data or None if the cache is missing, stale or unreadable
+    """
+    if not os.path.exists(filename):
+        return None
+    # the cyclic garbage collector would run over and over on the millions of objects being loaded
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(filename, 'rb') as f:
+            header = pickle.load(f)
+            if header.get('version') != REF_CACHE_VERSION or header.get('key') != key:
+                print("Reference cache {0} is out of date. Ignoring it.".format(filename), file=sys.stderr)
+                return None
+            data = pickle.load(f)
+            if not os.path.exists(genepred_file):
+                with open(genepred_file, 'wb') as out:
+                    out.write(zlib.decompress(pickle.load(f)))
+            return data
+    except Exception as e:
+        print("WARNING: unable to read reference cache {0} ({1}). Ignoring it.".format(filename, e), file=sys.stderr)
+        return None
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def write_ref_cache(filename, key, data, genepred_file):
+    """
+    Write the cache atomically (temp file + rename) so that concurrent jobs
+    never see a partially written file.
+    :param genepred_file: annotation genePred, stored (compressed) after the data
+    """
+    cache_dir = os.path.dirname(os.path.abspath(filename))
+    try:
+        fd, tmp_name = tempfile.mkstemp(dir=cache_dir, prefix='.tmp_refcache')
+    except OSError as e:
+        print("WARNING: unable to write reference cache in {0} ({1}). Skipping.".format(cache_dir, e), file=sys.stderr)
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'version': REF_CACHE_VERSION, 'key': key}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            with open(genepred_file, 'rb') as g:
+                pickle.dump(zlib.compress(g.read(), 1), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, filename)
+    except Exception as e:
+        # the cache is optional: a full disk or an unpicklable record must not stop the run
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        print("WARNING: unable to write reference cache in {0} ({1}). Skipping.".format(cache_dir, e), file=sys.stderr)
+        return False
+    return True
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""
+Indexes over the reference annotation used by the classification in sqanti_qc2.py.
+
+JunctionIndex keeps the known junctions of one chromosome twice:
+    - as sorted arrays, for nearest-site and range queries
+    - as hash sets, for O(1) membership tests (NIC/NNC, known junction, ...)
+
+IntronIndex (held by JunctionIndex) answers whether a known intron lies within, or around, an interval.
+
+ChainIndex maps the intron chains of the multi-exon references of one chromosome to the
+references, so that full-splice and incomplete-splice matches are found by lookup.
+
+GeneIndex keeps the annotated transcript starts/ends of every gene sorted, for nearest TSS/TTS
+searches, with the gene spans.
+
+RefSweep streams the (sorted) query isoforms of one chromosome against its references sorted
+by start, keeping only the references that can still overlap the next queries.
+
+RefExonIndex does the same for all the single exon queries of a chromosome at once against
+the exons of its multi-exon references.
+"""
+
+import bisect, itertools
+from array import array
+from collections import defaultdict
+
+import numpy as np
+
+
+class JunctionIndex(object):
+    """
+    Known junctions (and their donor/acceptor sites) of one chromosome.
+    Junctions are (d, a) with d the 1-based end of the donor exon and a the 0-based start of the acceptor exon.
+    NOTE: donor just means the start, not adjusted for strand
+    """
+    __slots__ = ('donors', 'acceptors', 'da_pairs', 'donor_set', 'acceptor_set', 'da_pair_set', 'introns')
+
+    def __init__(self, donors, acceptors, da_pairs):
+        """
+        :param donors: iterable of donor sites
+        :param acceptors: iterable of acceptor sites
+        :param da_pairs: iterable of (d, a) junctions
+        """
+        self.donor_set = set(donors)
+        self.acceptor_set = set(acceptors)
+        self.da_pair_set = set(da_pairs)
+        self.donors = np.array(sorted(self.donor_set), dtype=np.int64)
+        self.acceptors = np.array(sorted(self.acceptor_set), dtype=np.int64)
+        self.da_pairs = sorted(self.da_pair_set)
+        self.introns = IntronIndex(self.da_pairs)
+
+    def __len__(self):
+        return len(self.da_pairs)
+
+    def __contains__(self, junction):
+        return junction in self.da_pair_set
+
+    def has_known_sites(self, d, a):
+        """
+        :return: True if both the donor and the acceptor are known, not necessarily in the same junction
+        """
+        return d in self.donor_set and a in self.acceptor_set
+
+    def closest_donor_diffs(self, positions):
+        """
+        :param positions: numpy array of positions
+        :return: numpy array of (closest known donor - position)
+        """
+        return nearest_site_diffs(self.donors, positions)
+
+    def closest_acceptor_diffs(self, positions):
+        """
+        :param positions: numpy array of positions
+        :return: numpy array of (closest known acceptor - position)
+        """
+        return nearest_site_diffs(self.acceptors, positions)
+
+
+class IntronIndex(object):
+    """
+    Known introns [d, a) of one chromosome for interval queries:
+        - whether an intron lies within an interval (ex: intron retention by a query exon)
+        - whether an intron encloses an interval (ex: genic_intron query)
+    Introns are sorted by start, with the running maximum of their ends and a sparse table
+    of the minimum of their ends over ranges of 2**j introns, so both queries take O(log n).
+    """
+    __slots__ = ('starts', 'max_ends', 'min_ends')
+
+    def __init__(self, da_pairs):
+        """
+        :param da_pairs: sorted list of known (d, a) junctions
+        """
+        introns = [(d, a) for d, a in da_pairs if d < a]
+        self.starts = [d for d, a in introns]
+        ends = [a for d, a in introns]
+        self.max_ends = list(itertools.accumulate(ends, max))
+        # min_ends[j][k] = min(ends[k:k+2**j])
+        self.min_ends = [np.array(ends, dtype=np.int64)]
+        width = 1
+        while 2 * width <= len(ends):
+            prev = self.min_ends[-1]
+            self.min_ends.append(np.minimum(prev[:-width], prev[width:]))
+            width *= 2
+
+    def has_intron_within(self, start, end):
+        """
+        :return: True if a known intron (d, a) has start <= d < a < end
+        """
+        lo = bisect.bisect_left(self.starts, start)
+        hi = bisect.bisect_left(self.starts, end)
+        if lo >= hi:
+            return False
+        # two overlapping ranges of 2**j introns cover [lo, hi)
+        j = (hi - lo).bit_length() - 1
+        level = self.min_ends[j]
+        return min(level[lo], level[hi - (1 << j)]) < end
+
+    def has_intron_around(self, start, end):
+        """
+        :return: True if a known intron (d, a) has d <= start and end <= a
+        """
+        hi = bisect.bisect_right(self.starts, start)
+        return hi > 0 and self.max_ends[hi-1] >= end
+
+
+def nearest_site_diffs(sites, positions):
+    """
+    Vectorized nearest-site search.
+    :param sites: sorted numpy array of known sites (not empty)
+    :param positions: numpy array of query positions
+    :return: numpy array of (closest site - position), ties go to the downstream site
+    """
+    n = len(sites)
+    i = np.searchsorted(sites, positions, side='left')
+    lo = sites[np.clip(i-1, 0, n-1)] - positions
+    hi = sites[np.clip(i, 0, n-1)] - positions
+    return np.where(np.abs(lo) < np.abs(hi), lo, hi)
+
+
+def chain_key(rec):
+    """
+    :param rec: genePredRecord (exon starts/ends as int arrays)
+    :return: hashable key of the strand and intron chain of <rec>
+    """
+    return rec.strand, rec.exonEnds[:-1].tobytes(), rec.exonStarts[1:].tobytes()
+
+
+class ChainIndex(object):
+    """
+    Intron chains of the multi-exon references of one chromosome.
+
+    Exact chains are hashed. Indexing every contiguous sub-chain would be quadratic in the number
+    of junctions (ex: TTN), so sub-chains are found through the references that contain the first
+    junction of the query and verified by comparing the exon arrays.
+    """
+    __slots__ = ('by_chain', 'by_junction')
+
+    def __init__(self, refs):
+        """
+        :param refs: iterable of reference genePredRecord
+        """
+        self.by_chain = defaultdict(list)     # chain_key --> list of refs
+        self.by_junction = defaultdict(list)  # (d, a) --> list of refs using this junction
+        for r in refs:
+            if r.exonCount < 2:
+                continue
+            self.by_chain[chain_key(r)].append(r)
+            for junction in zip(r.exonEnds[:-1], r.exonStarts[1:]):
+                self.by_junction[junction].append(r)
+
+    def match_types(self, trec):
+        """
+        Find the references whose intron chain is the same as, or contains, the one of a multi-exon query.
+        Follows cupcake's compare_junctions(trec, ref, internal_fuzzy_max_dist=0) definitions:
+            exact  --- same intron chain
+            subset --- the query chain is a contiguous, shorter part of the ref chain and the first query
+                       exon does not also overlap the ref exon before (that would be a partial match)
+        :return: dict of ref --> 'exact' or 'subset', references not in it are neither
+        """
+        matches = {}
+        for r in self.by_chain.get(chain_key(trec), ()):
+            matches[r] = 'exact'
+
+        q_ends, q_starts = trec.exonEnds[:-1], trec.exonStarts[1:]
+        m = len(q_ends)
+        for r in self.by_junction.get((q_ends[0], q_starts[0]), ()):
+            if r.exonCount - 1 <= m or r.strand != trec.strand:
+                continue
+            k = bisect.bisect_left(r.exonEnds, q_ends[0])
+            if r.exonEnds[k:k+m] == q_ends and r.exonStarts[k+1:k+m+1] == q_starts:
+                if k == 0 or trec.exonStarts[0] >= r.exonEnds[k-1]:
+                    matches[r] = 'subset'
+        return matches
+
+
+class RefSweep(object):
+    """
+    Sweep-line overlap search of the references of one chromosome, for queries given by increasing start.
+    Every reference enters and leaves the active set once, instead of one interval tree search per query.
+    """
+    __slots__ = ('refs', 'next', 'active', 'last_start')
+
+    def __init__(self, refs):
+        """
+        :param refs: list of reference genePredRecord sorted by txStart
+        """
+        self.refs = refs
+        self.next = 0       # index of the first reference not yet seen by the sweep
+        self.active = []    # seen references (by txStart) that may still overlap a query
+        self.last_start = None
+
+    def overlapping(self, start, end):
+        """
+        Same hits as IntervalTree.find(start, end) (txStart < end and txEnd > start), ordered by txStart.
+        Queries must come by increasing <start>, the sweep restarts if they do not.
+        :return: list of reference genePredRecord
+        """
+        if self.last_start is not None and start < self.last_start:
+            self.next, self.active = 0, []
+        self.last_start = start
+
+        # references ending before <start> can not overlap this query nor the next ones
+        active = [r for r in self.active if r.txEnd > start]
+        refs, i, n = self.refs, self.next, len(self.refs)
+        while i < n and refs[i].txStart < end:
+            if refs[i].txEnd > start:
+                active.append(refs[i])
+            i += 1
+        self.next, self.active = i, active
+        # a longer earlier query may have activated references beyond the end of this one
+        return [r for r in active if r.txStart < end]
+
+
+def nearest_diff(sites, pos):
+    """
+    :param sites: sorted list of sites (not empty)
+    :return: pos - (closest site to pos), ties go to the upstream site
+    """
+    i = bisect.bisect_left(sites, pos)
+    if i == len(sites):
+        return pos - sites[-1]
+    if i == 0 or sites[i] - pos < pos - sites[i-1]:
+        return pos - sites[i]
+    return pos - sites[i-1]
+
+
+class GeneIndex(object):
+    """
+    Annotated transcript starts (begins) and ends of every reference gene, as sorted lists,
+    and the gene spans (smallest begin, largest end).
+    """
+    __slots__ = ('begins', 'ends', 'spans')
+
+    def __init__(self, known_5_3_by_gene):
+        """
+        :param known_5_3_by_gene: dict of gene --> {'begin': set of txStart, 'end': set of txEnd}
+        """
+        self.begins = {}
+        self.ends = {}
+        self.spans = {}
+        for gene, info in known_5_3_by_gene.items():
+            self.begins[gene] = sorted(info['begin'])
+            self.ends[gene] = sorted(info['end'])
+            self.spans[gene] = (self.begins[gene][0], self.ends[gene][-1])
+
+    def __contains__(self, gene):
+        return gene in self.spans
+
+    def span(self, gene):
+        return self.spans[gene]
+
+    def start(self, gene):
+        """
+        :return: smallest begin of the gene, used to order genes
+        """
+        return self.spans[gene][0]
+
+    def nearest_begin_diff(self, gene, pos):
+        """
+        :return: pos - closest transcript start of the gene
+        """
+        return nearest_diff(self.begins[gene], pos)
+
+    def nearest_end_diff(self, gene, pos):
+        """
+        :return: pos - closest transcript end of the gene
+        """
+        return nearest_diff(self.ends[gene], pos)
+
+
+class RefExonIndex(object):
+    """
+    All exons of the multi-exon references of one chromosome, sorted by start, for matching
+    single exon queries against reference exons in one sweep.
+    """
+    __slots__ = ('refs', 'starts', 'ends', 'ref_index')
+
+    def __init__(self, refs):
+        """
+        :param refs: list of multi-exon reference genePredRecord sorted by txStart
+        """
+        exons = sorted((s, e, k) for k, r in enumerate(refs) for s, e in zip(r.exonStarts, r.exonEnds))
+        self.refs = refs
+        self.starts = array('l', (x[0] for x in exons))
+        self.ends = array('l', (x[1] for x in exons))
+        self.ref_index = array('l', (x[2] for x in exons))
+
+    def mono_exon_hits(self, queries):
+        """
+        :param queries: list of (start, end) of single exon queries
+        :return: list with, for each query, the list of (ref, query is within one of the ref exons)
+                 of the references having an exon overlapping the query, ordered like the references
+        """
+        starts, ends, ref_index, n = self.starts, self.ends, self.ref_index, len(self.starts)
+        results = [None] * len(queries)
+        active = []  # exons seen by the sweep that may still overlap a query
+        i = 0
+        for q in sorted(range(len(queries)), key=lambda q: queries[q][0]):
+            s, e = queries[q]
+            active = [x for x in active if ends[x] > s]
+            while i < n and starts[i] < e:
+                if ends[i] > s:
+                    active.append(i)
+                i += 1
+            hits = {}  # ref index --> query within one of its exons
+            for x in active:
+                if starts[x] < e:
+                    k = ref_index[x]
+                    hits[k] = hits.get(k, False) or (starts[x] <= s and e <= ends[x])
+            results[q] = [(self.refs[k], hits[k]) for k in sorted(hits)]
+        return results
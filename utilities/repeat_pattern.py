@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+Search of the RT switching repeat between the exon and intron windows of a splice junction
+(see rt_switching.checkJunctionsForRTS).
+
+checkForRepeatPat is the string search. checkForRepeatPatBatch gives the same results for many
+window pairs at once (all the junctions of a chunk): windows are encoded as 2-bit integers (base p in
+bits 2p, 2p+1), seed hits are found by comparing tables of the k-mer codes at every window position,
+and the mismatches of two aligned stretches are counted on the XOR of the codes (one bit per base,
+then popcount), all as numpy operations over the windows. Windows with other bases than A/C/G/T
+(ex: N) use the string search.
+
+tests/test_repeat_pattern.py checks checkForRepeatPatBatch against checkForRepeatPat for every
+min_match/wiggle_count/allow_mismatch combination. Running this module directly times both on
+<num_windows> windows:
+
+    python repeat_pattern.py [num_windows]
+"""
+
+import sys, random, timeit
+
+import numpy as np
+
+# 2-bit code of each byte, 4 for anything else than A/C/G/T
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = code
+
+MAX_PACKED_LEN = 32  # windows of up to 32 bases fit in an uint64
+
+# LOW_BITS[n]: bit 2p set for p < n, i.e. one bit per base of the first n bases of a window
+LOW_BITS = np.array([int('01' * n, 2) if n > 0 else 0 for n in range(MAX_PACKED_LEN+1)], dtype=np.uint64)
+
+NO_REPEAT = (False, None, None, None)
+
+POPCOUNT_16 = np.array([bin(x).count('1') for x in range(1 << 16)], dtype=np.int64)
+
+
+def popcount(v):
+    """
+    :param v: numpy array of uint64
+    :return: numpy array of the number of bits set in each value
+    """
+    count = np.zeros(len(v), dtype=np.int64)
+    for shift in (0, 16, 32, 48):
+        count += POPCOUNT_16[(v >> np.uint64(shift)) & np.uint64(0xFFFF)]
+    return count
+
+
+def lowest_base(diff):
+    """
+    :param diff: numpy array of uint64, one bit per base (see LOW_BITS), not 0
+    :return: numpy array of the position of the first base with its bit set
+    """
+    lowest = diff & (~diff + np.uint64(1))
+    return (np.frexp(lowest.astype(np.float64))[1] - 1) // 2
+
+
+def encode_windows(seqs, n):
+    """
+    :param seqs: list of windows, all of length <n> (n <= MAX_PACKED_LEN)
+    :return: numpy array of uint64 2-bit codes (base p in bits 2p, 2p+1), numpy array of bool (window is only A/C/G/T)
+    """
+    codes = BASE_CODES[np.frombuffer(''.join(seqs).encode('ascii', 'replace'), dtype=np.uint8)].reshape(len(seqs), n)
+    valid = (codes < 4).all(axis=1)
+    packed = np.zeros(len(seqs), dtype=np.uint64)
+    for p in range(n):
+        packed |= (codes[:, p].astype(np.uint64) & np.uint64(3)) << np.uint64(2*p)
+    return packed, valid
+
+
+def checkForRepeatPatBatch(exon_seqs, intron_seqs, min_match, allow_mismatch=True):
+    """
+    checkForRepeatPat on many (exon, intron) window pairs at once, on the 2-bit codes of the windows.
+    Pairs of windows that can not be packed (different lengths, N...) go through checkForRepeatPat.
+    :param exon_seqs: list of exon windows
+    :param intron_seqs: list of intron windows, same order
+    :return: list of (is_RTS, matchLen, matchPattern, mismatch), one per window pair
+    """
+    results = [NO_REPEAT] * len(exon_seqs)
+    exon_lens = np.fromiter(map(len, exon_seqs), dtype=np.int64, count=len(exon_seqs))
+    intron_lens = np.fromiter(map(len, intron_seqs), dtype=np.int64, count=len(intron_seqs))
+    packable = (exon_lens == intron_lens) & (exon_lens > 0) & (exon_lens <= MAX_PACKED_LEN) & (int(min_match/2) > 0)
+    unpacked = np.flatnonzero(~packable).tolist()
+
+    for n in np.unique(exon_lens[packable]).tolist():
+        ws = np.flatnonzero(packable & (exon_lens == n))
+        if len(ws) == len(exon_seqs):
+            group_exon_seqs, group_intron_seqs = exon_seqs, intron_seqs
+        else:
+            group_exon_seqs, group_intron_seqs = [exon_seqs[w] for w in ws.tolist()], [intron_seqs[w] for w in ws.tolist()]
+        E, valid_e = encode_windows(group_exon_seqs, n)
+        I, valid_i = encode_windows(group_intron_seqs, n)
+        valid = valid_e & valid_i
+        start, mismatches = find_packed_repeats(E, I, n, min_match, allow_mismatch, ~valid)
+        unpacked.extend(ws[~valid].tolist())
+        hit = start >= 0
+        for w, s, mismatch in zip(ws[hit].tolist(), start[hit].tolist(), mismatches[hit].tolist()):
+            results[w] = (True, min_match, exon_seqs[w][s:s+min_match], mismatch)
+
+    for w in unpacked:
+        results[w] = checkForRepeatPat(exon_seqs[w], intron_seqs[w], min_match, allow_mismatch)
+    return results
+
+
+def find_packed_repeats(E, I, n, min_match, allow_mismatch, skip):
+    """
+    Same search as checkForRepeatPat, for all the 2-bit encoded window pairs (E[w], I[w]) of length <n> at once:
+    seed positions are tried in the same order, (i, j) by increasing exon position i then intron position j.
+    A match always spans min_match bases (the seed extension k plus the m = min_match - k bases
+    added after or before it), so only its start and number of mismatches are returned.
+    :param skip: numpy array of bool, pairs not to search
+    :return: numpy array of the start of the match in the exon window (-1 if none), numpy array of mismatches
+    """
+    seedsize = int(min_match/2)
+    max_mismatch = 1 if allow_mismatch else 0
+    seed_mask = np.uint64((1 << (2*seedsize)) - 1)
+    # k-mer tables: seed code at each position of the windows
+    exon_seeds = [(E >> np.uint64(2*i)) & seed_mask for i in range(n-seedsize+1)]
+    intron_seeds = [(I >> np.uint64(2*j)) & seed_mask for j in range(n-seedsize+1)]
+
+    start = np.full(len(E), -1, dtype=np.int64)
+    mismatches = np.zeros(len(E), dtype=np.int64)
+    found = skip.copy()
+    for i in range(n-seedsize+1):
+        for j in range(n-seedsize+1):
+            cand = np.flatnonzero((exon_seeds[i] == intron_seeds[j]) & ~found)
+            if len(cand) == 0:
+                continue
+            # one bit per base: set where seq_exon[i+p] != seq_intron[j+p], as far as both windows go
+            x = (E[cand] >> np.uint64(2*i)) ^ (I[cand] >> np.uint64(2*j))
+            diff = (x | (x >> np.uint64(1))) & LOW_BITS[n-max(i, j)]
+            # extend the seed match, then we need m = min_match - k more bases on either side
+            k = np.full(len(cand), n-max(i, j), dtype=np.int64)
+            k[diff != 0] = lowest_base(diff[diff != 0])
+            m = min_match - k
+            # forward: seq_exon[i+k:i+min_match] vs seq_intron[j+k:j+min_match] (bases before k all match)
+            fwd_mismatch = popcount(diff & LOW_BITS[min(min_match, n-max(i, j))])
+            fwd_ok = (i+min_match <= n) & (j+min_match <= n) & (fwd_mismatch <= max_mismatch)
+            # backward: seq_exon[i-m:i] vs seq_intron[j-m:j]
+            bwd_mismatch = np.zeros(len(cand), dtype=np.int64)
+            bwd = np.flatnonzero(~fwd_ok & (m <= min(i, j)))
+            if len(bwd) > 0:
+                mb = m[bwd].astype(np.uint64)
+                x = (E[cand[bwd]] >> (np.uint64(2*i) - np.uint64(2)*mb)) ^ (I[cand[bwd]] >> (np.uint64(2*j) - np.uint64(2)*mb))
+                bwd_mismatch[bwd] = popcount((x | (x >> np.uint64(1))) & LOW_BITS[m[bwd]])
+            bwd_ok = np.zeros(len(cand), dtype=bool)
+            bwd_ok[bwd] = bwd_mismatch[bwd] <= max_mismatch
+
+            ok = fwd_ok | bwd_ok
+            start[cand[fwd_ok]] = i
+            mismatches[cand[fwd_ok]] = fwd_mismatch[fwd_ok]
+            start[cand[bwd_ok]] = i - m[bwd_ok]
+            mismatches[cand[bwd_ok]] = bwd_mismatch[bwd_ok]
+            found[cand[ok]] = True
+    return start, mismatches
+
+
+# Check for possible RTS
+#
+# Because at most 1 mismatch is allowed, we can look for exact k-mer matches where k=<min_match>/2
+# As soon as we find a matching segment, return True
+#
+def checkForRepeatPat(seq_exon, seq_intron, min_match, allow_mismatch=True):
+    """
+    :return: is_RTS (bool), matchLen, matchPattern, mismatch
+    """
+    seedsize = int(min_match/2)
+    n = len(seq_exon)
+    for i in range(n-seedsize+1):
+        seed = seq_exon[i:i+seedsize]
+        offset = 0
+        while True:
+            j = seq_intron.find(seed, offset)
+            if j >= 0:
+                offset = j + 1
+                # try to extend the match
+                k = seedsize
+                while i+k < n and j+k < n and seq_exon[i+k]==seq_intron[j+k]: k += 1
+                # right now seq_exon[i:i+k] == seq_intron[j:j+k]
+                # we need (min_match - k) more matches on either side
+                m = min_match - k
+                if (i+k+m <= n) and (j+k+m <= n):
+                    flag, mismatch = seq_match(seq_exon[i+k:i+k+m], seq_intron[j+k:j+k+m], allow_mismatch)
+                    if flag:
+                        return True, k+m, seq_exon[i:i+k+m], mismatch
+                if (i-m >= 0) and (j-m >= 0): # try extending mismatch the other way
+                    flag, mismatch = seq_match(seq_exon[i-m:i], seq_intron[j-m:j], allow_mismatch)
+                    if flag:
+                        return True, k+m, seq_exon[i-m:i+k], mismatch
+            else:
+                break
+
+    return False, None, None, None
+
+#
+# Check if sequences match - sequences must have the same length
+#
+# Note: If mismatch flag is set, will allow 1 mismatch in comparison
+#       Regardless of mismacth flag value, indels are not allowed
+#
+def seq_match(exseq, inseq, allowMismatch):
+    """
+    Return True if <exseq> and <inseq> are same length and either
+    (1) identical OR
+    (2) has at most one mismatch (if allowMismatch is True)
+
+    :return: bool, num_mismatch
+    """
+    if len(exseq)!=len(inseq):
+        return False, None
+    elif exseq == inseq:
+        return True, 0
+    elif allowMismatch:
+        # allow at most one mismatch
+        num_mismatch = 0
+        for a,b in zip(exseq, inseq):
+            if a!=b:
+                if num_mismatch == 1: return False, None  # second mismatch, return False!
+                else: num_mismatch += 1
+        return True, num_mismatch
+    else:
+        return False, None
+
+
+if __name__ == "__main__":
+    PATSEQLEN = 10  # see rt_switching
+
+    # benchmark with the defaults of sqanti_qc2.py (min_match 8, wiggle_count 1, allow_mismatch)
+    num_windows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    random.seed(0)
+    cnt = PATSEQLEN + 2
+    exon_seqs = [''.join(random.choice('ACGT') for p in range(cnt)) for w in range(num_windows)]
+    intron_seqs = [''.join(random.choice('ACGT') for p in range(cnt)) for w in range(num_windows)]
+    t_old = timeit.timeit(lambda: [checkForRepeatPat(e, i, 8, True) for e, i in zip(exon_seqs, intron_seqs)], number=1)
+    t_new = timeit.timeit(lambda: checkForRepeatPatBatch(exon_seqs, intron_seqs, 8, True), number=1)
+    print("{0} junction windows".format(num_windows))
+    print("checkForRepeatPat: {0:.3f} sec".format(t_old))
+    print("checkForRepeatPatBatch (2-bit): {0:.3f} sec".format(t_new))
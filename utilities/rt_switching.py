@@ -1,9 +1,12 @@
 #!/usr/bin/env python
-import os, re, sys, time, subprocess, argparse, pdb
+import os, re, sys, time, math, subprocess, argparse, multiprocessing, pdb
 from collections import namedtuple, Counter, defaultdict
 from csv import DictReader, DictWriter
 
-from Bio import SeqIO
+from genome_index import IndexedGenome
+from repeat_pattern import checkForRepeatPatBatch
+from repeat_pattern import checkForRepeatPat, seq_match  # re-exported, they used to be defined here
+from rts_cache import open_rts_cache, MISSING
 
 # Written by Hector del Risco - hdelrisco@ufl.edu
 
@@ -68,144 +71,209 @@ def loadSpliceJunctions(filepath):
     return sj_dict, dict(sj_seen_counts)
 
 
-def checkSJforRTS(sj_dict, genome_dict, wiggle_count, include_category, include_type, min_match, allow_mismatch, output_filename):
+def checkSJforRTS(sj_dict, genome_dict, wiggle_count, include_category, include_type, min_match, allow_mismatch, output_filename, cache=None):
     """
     :param sj_dict: dict of (isoform --> junction info)
-    :param genome_dict: dict of (chr --> SeqRecord)
+    :param genome_dict: IndexedGenome
+    :param cache: (optional) RTSCache of the genome and parameters, consulted before checking a junction
     :return: dict of (isoform) -> list of RT junctions. NOTE: dict[isoform] = [] means all junctions are not RT.
     """
     RTS_info_by_isoform = {} # isoform -> list of junction numbers that have RT (ex: 'PB.1.1' --> ['junction_1'])
 
-    wiggle = wiggle_count
-    cnt = PATSEQLEN + (2 * wiggle)
-
     f = open(output_filename, 'w')
     fout = DictWriter(f, fieldnames=FIELDS_RTS, delimiter='\t')
     fout.writeheader()
 
+    sjs = [sj for isoform in sj_dict for sj in sj_dict[isoform]]
+    if cache is not None:
+        print("RTS cache: {0} of {1} junctions already checked.".format(cache.load(sjs), len(sjs)), file=sys.stderr)
+    recs = iter(checkJunctionsForRTS(sjs, genome_dict, wiggle_count, include_category, include_type, min_match, allow_mismatch, cache))
     for isoform in sj_dict:
         RTS_info_by_isoform[isoform] = []
-        #if isoform=='PB.3441.1': pdb.set_trace()
         # process all splice junctions
         for sj in sj_dict[isoform]:
-            if (include_type=='c' and sj.type!='canonical') or \
-                (include_type=='n' and sj.type!='non_canonical') or \
-                (include_category=='n' and sj.category!='novel') or \
-                (include_category=='k' and sj.category!='known'):
-                continue
-
-            # NOTE: sj.strpos and sj.endpos are both 1-based!!
-            # get sequences for pattern and search area
-            # the SJ start and end position are positioned at the start/end of the intron
-            # ths SJ start is always a lower position than the end regardless of strand
-            if sj.strand == "+":
-                # we always subtract to get to starting position
-                # the count includes 2 wiggles, both ends, so we adjust by 1 wiggle when positioning
-                # sequence data on disk: lowpos ----> hipos
-                # 5' -----exonSeq(SJstrpos)--------intronSeq(SJendpos) 3'
-                _start = sj.strpos - cnt + wiggle - 1
-                _end = sj.endpos - cnt + wiggle
-                seq_exon = str(genome_dict[sj.chromo].seq[_start:_start+cnt]).upper()
-                seq_intron = str(genome_dict[sj.chromo].seq[_end:_end+cnt]).upper()
-            else:
-                # we are almost on the starting position so just a minor adjustment
-                # sequence data on disk: lowpos ----> hipos
-                # 3' -----(SJstrpos)intronSeq--------(SJendpos)exonSeq 5'
-                _end = sj.strpos - wiggle - 1
-                seq_intron = str(genome_dict[sj.chromo][_end:_end+cnt].seq.reverse_complement()).upper()
-                _start = sj.endpos - wiggle
-                seq_exon = str(genome_dict[sj.chromo][_start:_start+cnt].seq.reverse_complement()).upper()
-
-            # check for RTS repeats and save results to file
-            if len(seq_exon) > 0 and len(seq_intron) > 0:
-                flag, matchLen, matchPat, mismatch = checkForRepeatPat(seq_exon, seq_intron, min_match, allow_mismatch)
-                if flag:
-                    RTS_info_by_isoform[isoform].append(sj.sjn)
-
-                    rec = {'isoform': isoform,
-                           'junction_number': sj.sjn,
-                           'chrom': sj.chromo,
-                           'strand': sj.strand,
-                           'genomic_start_coord': sj.strpos,
-                           'genomic_end_coord': sj.endpos,
-                           'category': sj.category,
-                           'type': sj.type,
-                           'exonSeq': seq_exon,
-                           'intronSeq': seq_intron,
-                           'matchLen': matchLen,
-                           'matchPat': matchPat,
-                           'mismatch': mismatch }
-                    fout.writerow(rec)
+            rec = next(recs)
+            if rec is not None:
+                RTS_info_by_isoform[isoform].append(sj.sjn)
+                fout.writerow(rec)
 
+    f.close()
     return RTS_info_by_isoform
 
-# Check for possible RTS
-#
-# Because at most 1 mismatch is allowed, we can look for exact k-mer matches where k=<min_match>/2
-# As soon as we find a matching segment, return True
-#
-def checkForRepeatPat(seq_exon, seq_intron, min_match, allow_mismatch=True):
+
+def getJunctionWindows(sj, genome_dict, wiggle_count):
     """
-    :return: is_RTS (bool), matchLen, matchPattern, mismatch
+    :param sj: SpliceJunctions
+    :param genome_dict: IndexedGenome
+    :return: (exon sequence, intron sequence) searched for RT switching repeats, both 5' to 3'
     """
-    #if seq_exon=='TAAATGTACAGG': pdb.set_trace()
-    seedsize = int(min_match/2)
-    n = len(seq_exon)
-    for i in range(n-seedsize+1):
-        seed = seq_exon[i:i+seedsize]
-        offset = 0
-        while True:
-            j = seq_intron.find(seed, offset)
-            if j >= 0:
-                offset = j + 1
-                # try to extend the match
-                k = seedsize
-                while i+k < n and j+k < n and seq_exon[i+k]==seq_intron[j+k]: k += 1
-                # right now seq_exon[i:i+k] == seq_intron[j:j+k]
-                # we need (min_match - k) more matches on either side
-                m = min_match - k
-                if (i+k+m <= n) and (j+k+m <= n):
-                    flag, mismatch = seq_match(seq_exon[i+k:i+k+m], seq_intron[j+k:j+k+m], allow_mismatch)
-                    if flag:
-                        return True, k+m, seq_exon[i:i+k+m], mismatch
-                if (i-m >= 0) and (j-m >= 0): # try extending mismatch the other way
-                    flag, mismatch = seq_match(seq_exon[i-m:i], seq_intron[j-m:j], allow_mismatch)
-                    if flag:
-                        return True, k+m, seq_exon[i-m:i+k], mismatch
-            else:
-                break
-
-    return False, None, None, None
+    wiggle = wiggle_count
+    cnt = PATSEQLEN + (2 * wiggle)
 
-#
-# Check if sequences match - sequences must have the same length
-#
-# Note: If mismatch flag is set, will allow 1 mismatch in comparison
-#       Regardless of mismacth flag value, indels are not allowed
-#
-def seq_match(exseq, inseq, allowMismatch):
+    # NOTE: sj.strpos and sj.endpos are both 1-based!!
+    # get sequences for pattern and search area
+    # the SJ start and end position are positioned at the start/end of the intron
+    # ths SJ start is always a lower position than the end regardless of strand
+    if sj.strand == "+":
+        # we always subtract to get to starting position
+        # the count includes 2 wiggles, both ends, so we adjust by 1 wiggle when positioning
+        # sequence data on disk: lowpos ----> hipos
+        # 5' -----exonSeq(SJstrpos)--------intronSeq(SJendpos) 3'
+        _start = sj.strpos - cnt + wiggle - 1
+        _end = sj.endpos - cnt + wiggle
+        seq_exon = genome_dict.fetch(sj.chromo, _start, _start+cnt).upper()
+        seq_intron = genome_dict.fetch(sj.chromo, _end, _end+cnt).upper()
+    else:
+        # we are almost on the starting position so just a minor adjustment
+        # sequence data on disk: lowpos ----> hipos
+        # 3' -----(SJstrpos)intronSeq--------(SJendpos)exonSeq 5'
+        _end = sj.strpos - wiggle - 1
+        seq_intron = genome_dict.fetch_oriented(sj.chromo, _end, _end+cnt, '-').upper()
+        _start = sj.endpos - wiggle
+        seq_exon = genome_dict.fetch_oriented(sj.chromo, _start, _start+cnt, '-').upper()
+    return seq_exon, seq_intron
+
+
+def checkJunctionsForRTS(sjs, genome_dict, wiggle_count, include_category, include_type, min_match, allow_mismatch, cache=None):
+    """
+    :param sjs: list of SpliceJunctions
+    :param genome_dict: IndexedGenome
+    :param cache: (optional) loaded RTSCache of the genome and parameters. Junctions in it are not checked again,
+                  the results of the others are appended to it.
+    :return: list with, for each junction, the results record (see FIELDS_RTS) if the junction has a RT switching pattern, otherwise None
+    """
+    results = [None] * len(sjs)  # None or (exonSeq, intronSeq, matchLen, matchPat, mismatch)
+    checked = []  # (junction, exon sequence, intron sequence)
+    new_results = []  # (junction, result) to add to the cache
+    for k, sj in enumerate(sjs):
+        if (include_type=='c' and sj.type!='canonical') or \
+            (include_type=='n' and sj.type!='non_canonical') or \
+            (include_category=='n' and sj.category!='novel') or \
+            (include_category=='k' and sj.category!='known'):
+            continue
+        if cache is not None:
+            result = cache.get(sj)
+            if result is not MISSING:
+                results[k] = result
+                continue
+        seq_exon, seq_intron = getJunctionWindows(sj, genome_dict, wiggle_count)
+        if len(seq_exon) > 0 and len(seq_intron) > 0:
+            checked.append((k, seq_exon, seq_intron))
+        elif cache is not None:
+            new_results.append((sj, None))
+
+    # check for RTS repeats, all junctions at once
+    repeats = checkForRepeatPatBatch([x[1] for x in checked], [x[2] for x in checked], min_match, allow_mismatch)
+    for (k, seq_exon, seq_intron), (flag, matchLen, matchPat, mismatch) in zip(checked, repeats):
+        if flag:
+            results[k] = (seq_exon, seq_intron, matchLen, matchPat, mismatch)
+        if cache is not None:
+            new_results.append((sjs[k], results[k]))
+    if cache is not None:
+        cache.append(new_results)
+
+    recs = [None] * len(sjs)
+    for k, sj in enumerate(sjs):
+        if results[k] is not None:
+            seq_exon, seq_intron, matchLen, matchPat, mismatch = results[k]
+            recs[k] = {'isoform': sj.trans,
+                       'junction_number': sj.sjn,
+                       'chrom': sj.chromo,
+                       'strand': sj.strand,
+                       'genomic_start_coord': sj.strpos,
+                       'genomic_end_coord': sj.endpos,
+                       'category': sj.category,
+                       'type': sj.type,
+                       'exonSeq': seq_exon,
+                       'intronSeq': seq_intron,
+                       'matchLen': matchLen,
+                       'matchPat': matchPat,
+                       'mismatch': mismatch }
+    return recs
+
+
+#### In-process, parallel RTS check of the junctions produced by the classification
+
+# Shared state of the RTS workers, set by rts_junctions before the pool is forked so that the
+# workers see the (memory-mapped) genome and the junctions copy-on-write.
+rts_ctx = {}
+
+
+def check_rts_chunk(chunk):
+    """
+    :param chunk: list of indices in rts_ctx['junctions'], all on the same chromosome
+    :return: list of (index, results record) of the RT switching junctions of the chunk
     """
-    Return True if <exseq> and <inseq> are same length and either
-    (1) identical OR
-    (2) has at most one mismatch (if allowMismatch is True)
+    junctions = rts_ctx['junctions']
+    recs = checkJunctionsForRTS([junctions[i] for i in chunk], rts_ctx['genome_dict'], cache=rts_ctx['cache'], **rts_ctx['params'])
+    return [(i, rec) for i, rec in zip(chunk, recs) if rec is not None]
 
-    :return: bool, num_mismatch
+
+def make_rts_chunks(junctions, target_size):
+    """
+    Group the junctions by chromosome, in chunks of at most <target_size> junctions.
+    :return: list of chunks (list of indices in <junctions>)
+    """
+    by_chr = defaultdict(list)
+    for i, sj in enumerate(junctions):
+        by_chr[sj.chromo].append(i)
+    chunks = []
+    for indices in by_chr.values():
+        for k in range(0, len(indices), target_size):
+            chunks.append(indices[k:k+target_size])
+    return chunks
+
+
+def rts_junctions(junctions, genome_dict, min_match=8, allow_mismatch=False, wiggle_count=1,
+                  include_category='a', include_type='a', n_workers=1, output_filename=None, cache=None):
     """
-    if len(exseq)!=len(inseq):
-        return False, None
-    elif exseq == inseq:
-        return True, 0
-    elif allowMismatch:
-        # allow at most one mismatch
-        num_mismatch = 0
-        for a,b in zip(exseq, inseq):
-            if a!=b:
-                if num_mismatch == 1: return False, None  # second mismatch, return False!
-                else: num_mismatch += 1
-        return True, num_mismatch
+    Check splice junctions for RT switching, same as checkSJforRTS but without the junctions file:
+    the junctions are split by chromosome between <n_workers> forked processes sharing the genome.
+    :param junctions: list of unique SpliceJunctions (the first isoform having each junction, see loadSpliceJunctions)
+    :param genome_dict: IndexedGenome
+    :param output_filename: (optional) results file (see FIELDS_RTS), rows are in the order of <junctions>
+    :param cache: (optional) RTSCache of the genome and parameters, consulted before checking a junction.
+                  It is loaded before the workers are forked, they append the junctions they check to it.
+    :return: dict of (isoform) -> list of RT junctions. Isoforms without RT junctions are not in it.
+    """
+    global rts_ctx
+
+    params = {'wiggle_count': wiggle_count, 'include_category': include_category, 'include_type': include_type,
+              'min_match': min_match, 'allow_mismatch': allow_mismatch}
+    if cache is not None:
+        print("RTS cache: {0} of {1} junctions already checked.".format(cache.load(junctions), len(junctions)), file=sys.stderr)
+    rts_ctx = {'junctions': junctions, 'genome_dict': genome_dict, 'params': params, 'cache': cache}
+
+    n_workers = max(1, n_workers)
+    # several chunks per worker so that large chromosomes do not leave the other workers idle
+    chunks = make_rts_chunks(junctions, max(1, int(math.ceil(len(junctions) / (n_workers * 4.)))))
+    if n_workers == 1 or len(chunks) <= 1:
+        chunk_results = map(check_rts_chunk, chunks)
+        pool = None
     else:
-        return False, None
-
+        pool = multiprocessing.get_context('fork').Pool(n_workers)
+        chunk_results = pool.imap_unordered(check_rts_chunk, chunks)
+
+    hits = []
+    for chunk_hits in chunk_results:
+        hits.extend(chunk_hits)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    rts_ctx = {}
+
+    hits.sort(key=lambda x: x[0])
+    RTS_info_by_isoform = defaultdict(list)
+    for i, rec in hits:
+        RTS_info_by_isoform[rec['isoform']].append(rec['junction_number'])
+
+    if output_filename is not None:
+        with open(output_filename, 'w') as f:
+            fout = DictWriter(f, fieldnames=FIELDS_RTS, delimiter='\t')
+            fout.writeheader()
+            fout.writerows(rec for i, rec in hits)
+
+    return dict(RTS_info_by_isoform)
 
 def rts(args, genome_dict):
     #
@@ -236,9 +304,13 @@ def rts(args, genome_dict):
     # load required data
     sjIdx, sjCounts = loadSpliceJunctions(args.sjFilepath)
 
+    cache = None
+    if args.cache_dir is not None:
+        cache = open_rts_cache(args.cache_dir, args.mmfaFilepath, args.min_match, args.allow_mismatch, args.wiggle_count)
+
     # perform RTS analysis
     RTSinfo = checkSJforRTS(sjIdx, genome_dict, args.wiggle_count, args.include_category, args.include_type,
-                            args.min_match, args.allow_mismatch, rtsResultsFilepath)
+                            args.min_match, args.allow_mismatch, rtsResultsFilepath, cache)
 
     return RTSinfo
 
@@ -252,6 +324,7 @@ def get_parser():
     parser.add_argument("-w", "--wiggle_count", type=int, default=1, choices=list(range(0, 4)), help="Number of bases allowed to wiggle on each side of ideal RTS sequence location. Default: 1")
     parser.add_argument("-t", "--include_type", default='a', choices=['a', 'c', 'n'], help="Type of splice junctions to include (a for all, c for canonical, and n for non-canonical). Default: a")
     parser.add_argument("-c", "--include_category", default='a', choices=['a', 'n', 'k'], help="Category of splice junctions to include (a for all, n for novel, and k for known). Default: a")
+    parser.add_argument("--cache_dir", help="Directory of the RTS cache shared between runs on the same genome (default: no cache)")
     parser.add_argument("-v", "--version", help="Display program version number", action='version', version='%(prog)s 0.1')
 
     return parser
@@ -260,5 +333,5 @@ if __name__ == "__main__":
     parser = get_parser()
     args = parser.parse_args()
 
-    print("Reading genome fasta into dict...", file=sys.stderr)
-    genome_dict = dict((r.id, r) for r in SeqIO.parse(open(args.mmfaFilepath), 'fasta'))
+    print("Opening indexed genome fasta...", file=sys.stderr)
+    genome_dict = IndexedGenome(args.mmfaFilepath)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Persistent cache of the RT switching check of splice junctions, shared across samples.
+
+Whether a junction looks like a RT switching artifact only depends on the genome, the junction
+(chrom, strand, start, end) and the --min_match / --allow_mismatch / --wiggle_count parameters,
+so the result of every junction checked is kept in a cache file named after the genome checksum
+and the parameters. Later runs (other samples against the same genome) only check the junctions
+not in it yet. The genome checksum is kept in the cache directory with the genome file size and
+modification time, so it is only computed again when the genome file changes.
+
+The cache file is an append-only tab-separated file, one junction per line after a header line
+with the cache key:
+
+    chrom  strand  start  end  RTS (0/1)  [exonSeq  intronSeq  matchLen  matchPat  mismatch]
+
+Any number of jobs can read and append to the same file at the same time: writers append whole
+lines under an exclusive lock (fcntl.flock) with O_APPEND, readers take no lock and skip an
+incomplete last line. A junction found twice (checked by two jobs at the same time) has the same
+result both times.
+"""
+
+import os, sys, fcntl, hashlib
+
+from ref_cache import cached_file_checksum
+
+# bump whenever the content or layout of the cached results changes
+RTS_CACHE_VERSION = 1
+
+HEADER_PREFIX = "#sqanti2_rts_cache\t"
+
+# returned by RTSCache.get for junctions that are not in the cache (None is a cached "not RTS")
+MISSING = object()
+
+
+def rts_cache_key(genome, min_match, allow_mismatch, wiggle_count, cache_dir):
+    """
+    :param cache_dir: the genome checksum is kept there and only recomputed when the genome file changes (see ref_cache.cached_file_checksum)
+    :return: key string identifying the RTS results for this genome and parameters
+    """
+    return "{0}.minmatch{1}.{2}.wiggle{3}.v{4}".format(cached_file_checksum(genome, cache_dir), min_match,
+                                                       'mismatch' if allow_mismatch else 'nomismatch',
+                                                       wiggle_count, RTS_CACHE_VERSION)
+
+
+def rts_cache_filename(cache_dir, genome, key):
+    digest = hashlib.md5(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "{0}.sqanti2_rtscache.{1}.tsv".format(os.path.basename(genome), digest))
+
+
+class RTSCache(object):
+    """
+    Cached RTS results of the junctions of one run, read from (and appended to) the cache file.
+    A result is None if the junction is not RTS, otherwise (exonSeq, intronSeq, matchLen, matchPat, mismatch).
+    """
+    def __init__(self, filename, key):
+        self.filename = filename
+        self.key = key
+        self.results = {}  # (chrom, strand, start, end) --> result
+        self.enabled = True
+
+    def load(self, junctions=None):
+        """
+        Read the cached results, only keeping those of <junctions> if given.
+        :param junctions: iterable of SpliceJunctions (see rt_switching)
+        :return: number of results read
+        """
+        wanted = None if junctions is None else set((sj.chromo, sj.strand, sj.strpos, sj.endpos) for sj in junctions)
+        self.results = {}
+        if not os.path.exists(self.filename):
+            return 0
+        try:
+            with open(self.filename) as f:
+                header = f.readline()
+                if header != HEADER_PREFIX + self.key + "\n":
+                    if header.endswith("\n"):
+                        print("WARNING: RTS cache {0} is for another genome or parameters. Not using it.".format(self.filename), file=sys.stderr)
+                        self.enabled = False
+                    return 0
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # being written by another job
+                    raw = line[:-1].split('\t')
+                    try:
+                        junction = (raw[0], raw[1], int(raw[2]), int(raw[3]))
+                        if wanted is not None and junction not in wanted:
+                            continue
+                        if raw[4] == '0' and len(raw) == 5:
+                            self.results[junction] = None
+                        elif raw[4] == '1' and len(raw) == 10:
+                            self.results[junction] = (raw[5], raw[6], int(raw[7]), raw[8], int(raw[9]))
+                    except (IndexError, ValueError):
+                        continue  # left over by an interrupted job
+        except (IOError, OSError) as e:
+            print("WARNING: unable to read RTS cache {0} ({1}). Not using it.".format(self.filename, e), file=sys.stderr)
+            self.enabled = False
+        return len(self.results)
+
+    def get(self, sj):
+        """
+        :param sj: SpliceJunctions
+        :return: cached result of the junction, MISSING if it is not in the cache
+        """
+        return self.results.get((sj.chromo, sj.strand, sj.strpos, sj.endpos), MISSING)
+
+    def append(self, items):
+        """
+        Append results to the cache file (and to this cache).
+        :param items: list of (SpliceJunctions, result)
+        """
+        if not self.enabled or len(items) == 0:
+            return
+        lines = []
+        for sj, result in items:
+            self.results[(sj.chromo, sj.strand, sj.strpos, sj.endpos)] = result
+            fields = [sj.chromo, sj.strand, str(sj.strpos), str(sj.endpos)]
+            if result is None:
+                fields.append('0')
+            else:
+                seq_exon, seq_intron, matchLen, matchPat, mismatch = result
+                fields += ['1', seq_exon, seq_intron, str(matchLen), matchPat, str(mismatch)]
+            lines.append('\t'.join(fields) + '\n')
+        try:
+            fd = os.open(self.filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o666)
+        except OSError as e:
+            print("WARNING: unable to write RTS cache {0} ({1}). Skipping.".format(self.filename, e), file=sys.stderr)
+            self.enabled = False
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            if size == 0:
+                lines.insert(0, HEADER_PREFIX + self.key + "\n")
+            elif os.pread(fd, 1, size-1) != b"\n":
+                lines.insert(0, "\n")  # terminate the incomplete line of an interrupted job
+            data = ''.join(lines).encode()
+            while len(data) > 0:
+                data = data[os.write(fd, data):]
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def open_rts_cache(cache_dir, genome, min_match, allow_mismatch, wiggle_count):
+    """
+    :return: RTSCache of this genome and parameters in <cache_dir> (not loaded yet)
+    """
+    os.makedirs(cache_dir, exist_ok=True)  # other jobs may be creating it too
+    key = rts_cache_key(genome, min_match, allow_mismatch, wiggle_count, cache_dir)
+    return RTSCache(rts_cache_filename(cache_dir, genome, key), key)
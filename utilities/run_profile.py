@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Stage timing and memory profile of a sqanti_qc2.py run.
+
+Each pipeline stage is timed (wall clock and CPU, including the CPU of external programs
+such as the aligner, GMST or Rscript) with its peak memory:
+    - peak_rss_mb: peak resident set size of SQANTI2 during the stage. On Linux the peak (VmHWM)
+      is reset when a stage starts (by writing 5 to /proc/self/clear_refs), elsewhere it is NA.
+    - cumulative_peak_rss_mb: peak resident set size of SQANTI2 since it started.
+    - children_cumulative_peak_rss_mb: peak resident set size of the largest child process
+      (aligner, GMST, Rscript...) terminated so far (RUSAGE_CHILDREN). The peak of a child can not
+      be reset from SQANTI2, so this only tells which stage ran the largest child so far. Worker
+      processes reset their own peak for every chunk and report it in the chunk rows.
+Classification buckets report the same numbers from the worker process that classified them.
+
+The profile is written as <output>.profile.json and <output>.profile.tsv next to <output>.params.txt.
+"""
+
+import os, sys, time, json, resource
+from contextlib import contextmanager
+
+PROFILE_FIELDS = ['stage', 'chunk', 'pid', 'isoforms', 'wall_sec', 'cpu_sec', 'children_cpu_sec',
+                  'peak_rss_mb', 'cumulative_peak_rss_mb', 'children_cumulative_peak_rss_mb']
+
+# StageTimers of this process that are not stopped yet, they keep the peaks seen before each reset
+active_timers = []
+# largest peak of this process before the last reset (resetting VmHWM also resets ru_maxrss)
+peak_before_reset = 0.
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    :param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN (largest terminated child)
+    :return: peak resident set size in MB since the process started
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(maxrss / (1024.*1024.) if sys.platform == 'darwin' else maxrss / 1024., 1)
+
+
+def current_peak_rss_mb():
+    """
+    :return: peak resident set size in MB since the last reset_peak_rss (VmHWM), None if not available
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024., 1)
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process, after handing the current peak to the active StageTimers.
+    :return: True if the peak could be reset
+    """
+    global peak_before_reset
+    peak = current_peak_rss_mb()
+    if peak is None:
+        return False
+    peak_before_reset = max(peak_before_reset, peak)
+    for timer in active_timers:
+        timer.peak = max(timer.peak, peak)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def cpu_sec(who=resource.RUSAGE_SELF):
+    r = resource.getrusage(who)
+    return r.ru_utime + r.ru_stime
+
+
+class StageTimer(object):
+    """
+    Measure wall clock and CPU time, and peak memory, of a piece of work from start (creation) to stop().
+    Timers can be nested (ex: classification buckets run in the main process).
+    """
+    def __init__(self):
+        self.t0 = time.time()
+        self.cpu0 = cpu_sec()
+        self.children_cpu0 = cpu_sec(resource.RUSAGE_CHILDREN)
+        self.peak = 0.
+        self.can_reset = reset_peak_rss()
+        active_timers.append(self)
+
+    def stop(self, **extra):
+        """
+        :return: dict of the measurements (see PROFILE_FIELDS), plus <extra>
+        """
+        if self in active_timers:
+            active_timers.remove(self)
+        record = {'pid': os.getpid(),
+                  'wall_sec': round(time.time() - self.t0, 3),
+                  'cpu_sec': round(cpu_sec() - self.cpu0, 3),
+                  'children_cpu_sec': round(cpu_sec(resource.RUSAGE_CHILDREN) - self.children_cpu0, 3),
+                  'peak_rss_mb': max(self.peak, current_peak_rss_mb()) if self.can_reset else 'NA',
+                  'cumulative_peak_rss_mb': max(peak_rss_mb(), peak_before_reset),
+                  'children_cumulative_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}
+        record.update(extra)
+        return record
+
+
+class RunProfile(object):
+    def __init__(self):
+        self.timer = StageTimer()
+        self.stages = []  # list of stage records, in the order they ran
+        self.chunks = []  # list of per-chunk records of parallel stages
+
+    @contextmanager
+    def stage(self, name, **extra):
+        """
+        Time the enclosed block as stage <name>, ex:
+            with run_profile.stage('alignment'):
+                ...
+        """
+        timer = StageTimer()
+        try:
+            yield
+        finally:
+            self.stages.append(timer.stop(stage=name, **extra))
+
+    def add_chunk(self, stage, chunk, record):
+        """
+        :param record: measurements of one chunk, as returned by StageTimer.stop() in the worker
+        """
+        record = dict(record)
+        record.update({'stage': stage, 'chunk': chunk})
+        self.chunks.append(record)
+
+    def summary(self):
+        return "\n".join("{0:<25}{1:>12.1f} sec{2:>12} MB".format(r['stage'], r['wall_sec'], r['peak_rss_mb']) for r in self.stages)
+
+    def write(self, json_filename, tsv_filename):
+        total = self.timer.stop(stage='total')
+        with open(json_filename, 'w') as f:
+            json.dump({'total': total, 'stages': self.stages, 'chunks': self.chunks}, f, indent=2)
+        with open(tsv_filename, 'w') as f:
+            f.write("\t".join(PROFILE_FIELDS) + "\n")
+            for r in self.stages + sorted(self.chunks, key=lambda r: (r['stage'], r['chunk'])) + [total]:
+                f.write("\t".join(str(r.get(k, 'NA')) for k in PROFILE_FIELDS) + "\n")
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Comparison of a query transcript against its candidate references, used by transcriptsKnownSpliceSites
+in sqanti_qc2.py.
+
+Records are genePredRecord-like: exonStarts/exonEnds int arrays (sorted), strand, txStart/txEnd,
+merged_exons and splice_sites (see sqanti_qc2.genePredRecord).
+
+compare_to_refs computes, in one call per query, everything the classification needs from each
+(query, reference) pair: the junction match type, the splice-site agreement, the exonic overlap and
+the TSS/TTS differences.
+
+ChainMemo remembers the parts of these comparisons that only depend on the query's intron chain,
+for collapsed isoforms that share a chain and differ only in their ends.
+
+Transcript and random_transcript make random transcripts sharing splice sites, so that all match types
+show up. tests/test_transcript_compare.py checks match_type against cupcake's compare_junctions (as
+called by SQANTI2 before) on them, running this module directly times both:
+
+    python transcript_compare.py [num_queries] [num_refs]
+"""
+
+import sys, random, timeit
+from collections import OrderedDict
+
+from exon_compare import merge_exons, merged_overlap
+
+
+def match_type(q_starts, q_ends, r_starts, r_ends):
+    """
+    Junction match of two multi-exon transcripts, same as cupcake's
+    compare_junctions(query, ref, internal_fuzzy_max_dist=0, max_5_diff=999999, max_3_diff=999999)
+    except that 'concordant' (the chains overlap by a shifted, agreeing stretch: neither starts at the
+    first exon of the other and neither contains the other) is reported as 'partial'. The only caller,
+    transcriptsKnownSpliceSites, has always classified 'partial', 'concordant' and 'super' the same way.
+
+    The first overlapping exons are looked for between the first query exon and every ref exon, then
+    between every other query exon and the first ref exon. From there, all internal exon boundaries must agree.
+
+    :param q_starts, q_ends: exon starts (0-based) and ends (1-based) of the query
+    :param r_starts, r_ends: exon starts (0-based) and ends (1-based) of the reference
+    :return: 'exact', 'subset', 'super', 'partial' or 'nomatch'
+    """
+    first = first_overlap(q_starts, q_ends, r_starts, r_ends)
+    if first is None:
+        return 'nomatch'
+    return walk_chains(q_starts, q_ends, r_starts, r_ends, first[0], first[1])
+
+
+def first_overlap(q_starts, q_ends, r_starts, r_ends):
+    """
+    :return: (i0, j0) indices of the first overlapping (query, ref) exons in compare_junctions' order, or None
+    """
+    nq, nr = len(q_starts), len(r_starts)
+    s, e = q_starts[0], q_ends[0]
+    j0 = 0
+    while j0 < nr and not (r_starts[j0] < e and s < r_ends[j0]):
+        j0 += 1
+    if j0 < nr:
+        return 0, j0
+    s, e = r_starts[0], r_ends[0]
+    i0 = 1
+    while i0 < nq and not (q_starts[i0] < e and s < q_ends[i0]):
+        i0 += 1
+    if i0 < nq:
+        return i0, 0
+    return None
+
+
+def walk_chains(q_starts, q_ends, r_starts, r_ends, i0, j0):
+    """
+    Match type from the first overlapping exons (see first_overlap).
+    Only internal exon boundaries are compared, so the result depends on the intron chains and (i0, j0) alone.
+    """
+    nq, nr = len(q_starts), len(r_starts)
+    # walk the aligned exons, terminal (TSS/TTS) ends are not compared
+    i, j = i0, j0
+    while i < nq and j < nr:
+        if i > i0 and q_starts[i] != r_starts[j]:
+            return 'partial'
+        if i < nq-1 and j < nr-1 and q_ends[i] != r_ends[j]:
+            return 'partial'
+        i += 1
+        j += 1
+    if i == nq and j == nr:
+        if i0 == 0:
+            return 'exact' if j0 == 0 else 'subset'
+        return 'super'
+    if i == nq: # ref continues
+        return 'subset' if i0 == 0 else 'partial'
+    return 'super' if j0 == 0 else 'partial'
+
+
+def compare_to_refs(trec, refs, known_types=None, memo_entry=None):
+    """
+    :param trec: query genePredRecord
+    :param refs: candidate reference genePredRecords on the same strand as <trec>
+    :param known_types: optional dict of ref --> match type already known (ex: from ChainIndex.match_types)
+    :param memo_entry: optional ChainMemo entry of trec's intron chain (multi-exon queries only)
+    :return: list of (match_type, splice-site agreement, exonic overlap, diff_tss, diff_tts), one per ref;
+             match_type is None for mono-exon queries or references
+    """
+    q_starts, q_ends = trec.exonStarts, trec.exonEnds
+    q_sites, q_merged = trec.splice_sites, trec.merged_exons
+    q_multi = trec.exonCount >= 2
+    plus = trec.strand == '+'
+    if memo_entry is not None:
+        chain_sites, by_ref = memo_entry
+        # the TSS/TTS count as splice sites too unless they are also an internal site
+        q_tss_tts = [x for x in (q_starts[0], q_ends[-1]) if x not in chain_sites]
+    results = []
+    for ref in refs:
+        m = None
+        if memo_entry is None:
+            if q_multi and ref.exonCount >= 2:
+                if known_types is not None:
+                    m = known_types.get(ref)
+                if m is None:
+                    m = match_type(q_starts, q_ends, ref.exonStarts, ref.exonEnds)
+            sites = len(q_sites.intersection(ref.splice_sites))
+        else:
+            memo = by_ref.get(ref)
+            if memo is None:
+                memo = by_ref[ref] = (len(chain_sites.intersection(ref.splice_sites)), {})
+            if ref.exonCount >= 2:
+                if known_types is not None:
+                    m = known_types.get(ref)
+                if m is None:
+                    first = first_overlap(q_starts, q_ends, ref.exonStarts, ref.exonEnds)
+                    if first is None:
+                        m = 'nomatch'
+                    else:
+                        m = memo[1].get(first)
+                        if m is None:
+                            m = memo[1][first] = walk_chains(q_starts, q_ends, ref.exonStarts, ref.exonEnds, first[0], first[1])
+            sites = memo[0] + sum(x in ref.splice_sites for x in q_tss_tts)
+        if plus:
+            diff_tss, diff_tts = trec.txStart - ref.txStart, ref.txEnd - trec.txEnd
+        else:
+            diff_tss, diff_tts = ref.txEnd - trec.txEnd, trec.txStart - ref.txStart
+        results.append((m, sites, merged_overlap(q_merged, ref.merged_exons), diff_tss, diff_tts))
+    return results
+
+
+class ChainMemo(object):
+    """
+    Bounded (least recently used) memo of the comparisons of one intron chain against the references:
+    the splice-site agreement of the internal sites and the match type walk of every (first overlap, ref).
+    The ends-dependent parts (first overlap, TSS/TTS sites, exonic overlap, TSS/TTS differences) are
+    always recomputed by compare_to_refs.
+    """
+    def __init__(self, maxsize):
+        """
+        :param maxsize: maximum number of intron chains remembered, 0 to disable
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key --> (frozenset of internal splice sites, dict of ref --> memo)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, trec):
+        """
+        :param key: (chrom, strand, intron chain) of <trec>, see ref_index.chain_key
+        :param trec: multi-exon query genePredRecord
+        :return: memo entry to pass to compare_to_refs, None if the memo is disabled
+        """
+        if self.maxsize <= 0:
+            return None
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        entry = (frozenset(trec.exonEnds[:-1]).union(trec.exonStarts[1:]), {})
+        self.entries[key] = entry
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+
+class Transcript(object):
+    """
+    Minimal genePredRecord look-alike for the tests and the benchmark, with the segments cupcake's compare_junctions reads.
+    """
+    def __init__(self, strand, starts, ends):
+        from bx.intervals import Interval
+        self.strand = strand
+        self.exonStarts, self.exonEnds = starts, ends
+        self.exonCount = len(starts)
+        self.txStart, self.txEnd = starts[0], ends[-1]
+        self.segments = [Interval(s, e) for s, e in zip(starts, ends)]
+        self.splice_sites = frozenset(starts).union(ends)
+        self.merged_exons = merge_exons(self.segments)
+
+
+def random_transcript(sites):
+    """
+    :param sites: sorted list of splice sites shared by the transcripts
+    :return: multi-exon Transcript on <sites> with random TSS/TTS
+    """
+    n = random.randint(2, 8)
+    idx = random.randint(1, len(sites) - 4*n - 2)
+    starts, ends = [], []
+    for k in range(n):
+        starts.append(sites[idx] if k > 0 else sites[idx] - random.choice([0, 5, 60, 500]))
+        idx += random.choice([1, 1, 1, 3])
+        ends.append(sites[idx] if k < n-1 else sites[idx] + random.randint(1, 30))
+        idx += 1
+    return Transcript(random.choice('+-'), starts, ends)
+
+
+if __name__ == "__main__":
+    from cupcake.tofu.compare_junctions import compare_junctions
+
+    num_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_refs = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    random.seed(0)
+    sites = sorted(random.sample(range(100, 30000, 7), 200))
+    refs = [random_transcript(sites) for i in range(num_refs)]
+    queries = [random_transcript(sites) for i in range(num_queries)]
+
+    t_old = timeit.timeit(lambda: [compare_junctions(q, r, internal_fuzzy_max_dist=0, max_5_diff=999999, max_3_diff=999999) for q in queries for r in refs], number=1)
+    t_new = timeit.timeit(lambda: [compare_to_refs(q, refs) for q in queries], number=1)
+    print("cupcake compare_junctions: {0:.4f} sec".format(t_old))
+    print("compare_to_refs (match type, splice sites, overlap, TSS/TTS): {0:.4f} sec".format(t_new))
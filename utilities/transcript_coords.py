@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Transcript <--> genome coordinate mapping of a spliced transcript, from cumulative exon lengths.
+
+Used by sqanti_qc2.py to place the predicted ORFs on the genome (CDS genomic start/end, NMD)
+and to cut the CDS into exon pieces for the .cds.gff output. Memory is one entry per exon
+instead of one per transcript base.
+"""
+
+import numpy as np
+
+
+class TranscriptCoordinateMapper(object):
+    """
+    Positions are 0-based. Transcript positions count from the 5' end, so on the - strand
+    transcript position 0 is the last base of the last exon.
+    """
+    __slots__ = ('strand', 'exon_starts', 'exon_ends', 'offsets', 'length')
+
+    def __init__(self, exon_starts, exon_ends, strand):
+        """
+        :param exon_starts: sorted exon starts (0-based)
+        :param exon_ends: exon ends (1-based), same order
+        :param strand: '+' or '-'
+        """
+        self.strand = strand
+        self.exon_starts = np.asarray(exon_starts, dtype=np.int64)
+        self.exon_ends = np.asarray(exon_ends, dtype=np.int64)
+        lengths = self.exon_ends - self.exon_starts
+        # offsets[k] = number of transcript bases before exon k, in genomic order
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+        self.length = int(self.offsets[-1])
+
+    def to_genome(self, positions):
+        """
+        :param positions: transcript positions (list or numpy array)
+        :return: numpy array of genomic positions, -1 for positions outside the transcript
+        """
+        pos = np.asarray(positions, dtype=np.int64)
+        inside = (pos >= 0) & (pos < self.length)
+        # position along the exons in genomic order
+        g_pos = pos if self.strand != '-' else self.length - 1 - pos
+        k = np.clip(np.searchsorted(self.offsets, g_pos, side='right') - 1, 0, len(self.exon_starts) - 1)
+        return np.where(inside, self.exon_starts[k] + (g_pos - self.offsets[k]), -1)
+
+    def clip_to_exons(self, start, end):
+        """
+        :param start: 0-based genomic start
+        :param end: 1-based genomic end
+        :return: list of (start, end) pieces of [start, end) that are exonic, in genomic order
+        """
+        k0 = int(np.searchsorted(self.exon_ends, start, side='right'))
+        k1 = int(np.searchsorted(self.exon_starts, end, side='left'))
+        return [(max(start, int(self.exon_starts[k])), min(end, int(self.exon_ends[k]))) for k in range(k0, k1)]